@@ -1,12 +1,40 @@
+"""Command line interface
+
+Subcommands import numpy and the modules they use when they run, so that
+--version, --help and the lighter subcommands start quickly. The option
+choices and defaults below mirror the library's constants for the same
+reason; the tests check that they match.
+"""
 import binascii
+import contextlib
+import sys
+import time
 
 import click
-import numpy as np
 import signal
 
 from . import __version__
-from . import ops
-from . import dfa
+
+
+# modes.MODES, modes.DEFAULT_CHUNK_SIZE
+MODES = ('ecb', 'cbc', 'ctr')
+CHUNK_SIZE = 1 << 20
+
+# faultsim.FAULTS, faultsim.POINTS
+FAULTS = ('bit', 'byte', 'random')
+POINTS = ('input', 's_box', 's_row', 'm_col', 'add_k')
+
+# tvla.TESTS, tvla.THRESHOLD, tvla.DEFAULT_CHUNK_SIZE
+TESTS = ('fixed', 'sbox_bit', 'last_hd')
+THRESHOLD = 4.5
+TRACE_CHUNK_SIZE = 1 << 14
+
+# bulk.FORMATS
+RESULT_FORMATS = ('json', 'csv')
+
+# service.DEFAULT_MAX_BATCH, service.DEFAULT_MAX_WAIT
+MAX_BATCH = 256
+MAX_WAIT = 0.002
 
 
 @click.group('aes-tools')
@@ -15,24 +43,84 @@ def cli():
     """AES Tools"""
 
 
+@contextlib.contextmanager
+def _profiled(enabled):
+    """Print a breakdown of the instrumented calls after the block"""
+    if not enabled:
+        yield
+        return
+    from . import profiling
+    with profiling.profile() as stats:
+        try:
+            yield
+        finally:
+            click.echo("\n" + stats.format(), err=True)
+
+
+_profile_option = click.option(
+    '--profile', is_flag=True,
+    help='Print a breakdown of calls and time in the hot paths')
+
+
 @cli.command('derive', short_help='Derive the AES key from a subkey')
 @click.option('--skey', type=str, help='Subkey (ASCII hex)')
 @click.option('--offset', type=int, help='Subkey 32-bit word offset')
-def derive(skey, offset):
+@_profile_option
+def derive(skey, offset, profile):
+    import numpy as np
+    from . import ops
+
     skey = np.array(bytearray.fromhex(skey.replace(' ', '')))
 
-    key = ops.derive_key(skey, offset)
+    with _profiled(profile):
+        key = ops.derive_key(skey, offset)
 
     print("Derived key: {key}".format(key=binascii.hexlify(key.data)))
 
 
+def _print_progress(session):
+    print("Faults: {faults}, resolved key bytes: {resolved_bytes}/16, "
+          "candidates: {candidates}".format(**session.progress()))
+
+
+def _listen_address(listen):
+    if listen.startswith('unix:'):
+        return {'path': listen[len('unix:'):]}
+    host, _, port = listen.rpartition(':')
+    if not port.isdigit():
+        raise click.UsageError("Invalid --listen address: %s" % (listen,))
+    return {'host': host or None, 'port': int(port)}
+
+
 @cli.command('dfa', short_help='Perform DFA against corrupted ciphertexts')
-@click.option('-f', '--filename', required=True, type=str, help='File path')
+@click.option('-f', '--filename', type=str, help='File path, or - for stdin')
 @click.option('-p', '--pause', is_flag=True, help='Pause upon completion')
 @click.option('-v', '--verbose', is_flag=True, help='Verbose DFA status')
-def dfa_file(filename, pause, verbose):
-    with open(filename, 'r') as f:
-        aes_key = dfa.stream(f, verbose)
+@click.option('--workers', type=int, default=1, show_default=True,
+              help='Worker processes for the column solvers')
+@click.option('--follow', is_flag=True,
+              help='Keep reading the file as it grows, until the key is found')
+@click.option('--listen', type=str,
+              help='Read ciphertexts from a socket, HOST:PORT or unix:PATH')
+@click.option('--plaintext', type=str,
+              help='Plaintext of the reference ciphertext (ASCII hex), to '
+                   'search any remaining key candidates (AES-128)')
+@click.option('--key-size', type=click.Choice(('128', '192', '256')),
+              default='128', show_default=True,
+              help='Key size in bits; 192 and 256 recover two round keys')
+@_profile_option
+def dfa_file(filename, pause, verbose, workers, follow, listen, plaintext,
+             key_size, profile):
+    if (filename is None) == (listen is None):
+        raise click.UsageError("Give one of --filename or --listen")
+    key_len = int(key_size) // 8
+    if key_len != 16 and (listen is not None or follow or filename == '-'):
+        raise click.UsageError("--key-size %s is only supported for files, "
+                               "without --follow" % (key_size,))
+
+    with _profiled(profile):
+        aes_key = _dfa(filename, verbose, workers, follow, listen, plaintext,
+                       key_len)
 
     click.secho("\nAES (not-so-)secret key:", bold=True)
     click.secho(bytearray(aes_key).hex(), fg="bright_red", bold=True)
@@ -41,5 +129,302 @@ def dfa_file(filename, pause, verbose):
         signal.pause()
 
 
+def _dfa(filename, verbose, workers, follow, listen, plaintext, key_len):
+    """Run the DFA from a file, stdin or a socket; returns the key"""
+    import numpy as np
+    from . import dfa
+
+    on_progress = _print_progress if verbose else None
+    if plaintext is not None:
+        plaintext = np.array(bytearray.fromhex(plaintext.replace(' ', '')))
+
+    if listen is not None:
+        import asyncio
+        session = dfa.Session()
+        aes_key = asyncio.run(session.serve(on_progress=on_progress,
+                                            **_listen_address(listen)))
+    elif filename == '-' or follow:
+        session = dfa.Session()
+        # Leave stdin open for the caller
+        source = (contextlib.nullcontext(sys.stdin) if filename == '-'
+                  else open(filename, 'r'))
+        with source as f:
+            aes_key = session.feed(dfa.follow(f) if follow else f,
+                                   on_progress)
+        if aes_key is None:
+            raise click.ClickException(
+                "Last round key not determined: %d candidates" %
+                (session.solution.count(),))
+    else:
+        with open(filename, 'rb') as f:
+            try:
+                aes_key = dfa.stream(f, verbose, workers, plaintext,
+                                     key_len)
+            except ValueError as e:
+                raise click.ClickException(str(e))
+    return aes_key
+
+
+@cli.command('dfa-batch', short_help='Perform DFA against many fault logs')
+@click.argument('targets', nargs=-1, required=True)
+@click.option('-o', '--output-dir', required=True,
+              type=click.Path(file_okay=False),
+              help='Directory for the result files, one per target')
+@click.option('--format', 'fmt', type=click.Choice(RESULT_FORMATS),
+              default='json', show_default=True, help='Result file format')
+@click.option('--workers', type=int, default=1, show_default=True,
+              help='Worker processes, each attacking one log at a time')
+@click.option('--plaintext', type=str,
+              help='Plaintext of the reference ciphertexts (ASCII hex), to '
+                   'search any remaining key candidates (AES-128)')
+@click.option('--key-size', type=click.Choice(('128', '192', '256')),
+              default='128', show_default=True, help='Key size in bits')
+@click.option('--force', is_flag=True,
+              help='Attack every log, even if its key was already '
+                   'recovered')
+def dfa_batch(targets, output_dir, fmt, workers, plaintext, key_size, force):
+    """Attack the fault logs in directories or matching glob patterns"""
+    import numpy as np
+    from . import bulk
+
+    paths = bulk.find_logs(targets)
+    if not paths:
+        raise click.UsageError("No fault logs found")
+    if plaintext is not None:
+        plaintext = np.array(bytearray.fromhex(plaintext.replace(' ', '')))
+
+    start = time.perf_counter()
+    statuses = []
+    try:
+        for result in bulk.run(paths, output_dir, fmt, workers,
+                               int(key_size) // 8, plaintext, force):
+            status = 'skipped' if result['skipped'] else result['status']
+            statuses.append(status)
+            print("{target}: {status} {detail}".format(
+                target=result['target'], status=status,
+                detail=result['key'] or result['error'] or ''))
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    elapsed = time.perf_counter() - start
+
+    print("{n} targets in {elapsed:.3f} s: {counts}".format(
+        n=len(statuses), elapsed=elapsed,
+        counts=', '.join('%d %s' % (statuses.count(s), s)
+                         for s in ('recovered', 'unresolved', 'error',
+                                   'skipped') if s in statuses)))
+
+
+@cli.command('serve', short_help='Serve batched block encryption')
+@click.option('--listen', required=True, type=str,
+              help='Socket address, HOST:PORT or unix:PATH')
+@click.option('--max-batch', type=int, default=MAX_BATCH, show_default=True,
+              help='Most blocks per batch')
+@click.option('--max-wait', type=float, default=MAX_WAIT, show_default=True,
+              help='Longest a request waits for a batch to fill, in seconds')
+@click.option('--workers', type=int, default=1, show_default=True,
+              help='Worker threads')
+def serve(listen, max_batch, max_wait, workers):
+    import asyncio
+    import json
+    from . import service
+
+    address = _listen_address(listen)
+    try:
+        batcher = service.Batcher(max_batch, max_wait, workers)
+    except ValueError as e:
+        raise click.UsageError(str(e))
+
+    async def run():
+        async with batcher:
+            await service.serve(batcher, **address)
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        click.echo(json.dumps(batcher.metrics.as_dict(), sort_keys=True),
+                   err=True)
+
+
+def _crypt_file(input, output, key, mode, iv, workers, chunk_size, decrypt):
+    if mode != 'ecb' and iv is None:
+        raise click.UsageError("--iv is required for %s mode" % (mode,))
+    from . import modes
+
+    key = bytearray.fromhex(key.replace(' ', ''))
+    if iv is not None:
+        iv = bytearray.fromhex(iv.replace(' ', ''))
+
+    start = time.perf_counter()
+    try:
+        size = modes.process_file(input, output, key, mode, iv, decrypt,
+                                  workers, chunk_size)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    elapsed = time.perf_counter() - start
+
+    print("Processed {size} bytes in {elapsed:.3f} s ({rate:.2f} MB/s)".format(
+        size=size, elapsed=elapsed, rate=size / 1e6 / max(elapsed, 1e-9)))
+
+
+def _crypt_options(f):
+    options = (
+        click.option('-i', '--input', required=True,
+                     type=click.Path(exists=True, dir_okay=False),
+                     help='Input file path'),
+        click.option('-o', '--output', required=True,
+                     type=click.Path(dir_okay=False),
+                     help='Output file path'),
+        click.option('--key', required=True, type=str,
+                     help='Key (ASCII hex)'),
+        click.option('--mode', type=click.Choice(MODES),
+                     default='ctr', show_default=True,
+                     help='Block cipher mode'),
+        click.option('--iv', type=str,
+                     help='IV or initial counter block (ASCII hex)'),
+        click.option('--workers', type=int, default=1, show_default=True,
+                     help='Worker processes'),
+        click.option('--chunk-size', type=int,
+                     default=CHUNK_SIZE, show_default=True,
+                     help='Chunk size in bytes, a multiple of 16'),
+    )
+    for option in reversed(options):
+        f = option(f)
+    return f
+
+
+@cli.command('encrypt', short_help='Encrypt a file')
+@_crypt_options
+def encrypt_file(input, output, key, mode, iv, workers, chunk_size):
+    _crypt_file(input, output, key, mode, iv, workers, chunk_size, False)
+
+
+@cli.command('decrypt', short_help='Decrypt a file')
+@_crypt_options
+def decrypt_file(input, output, key, mode, iv, workers, chunk_size):
+    _crypt_file(input, output, key, mode, iv, workers, chunk_size, True)
+
+
+@cli.command('faultsim', short_help='Simulate faulty encryptions')
+@click.option('-o', '--output', required=True, type=click.Path(dir_okay=False),
+              help='Output file path, or - for stdout (hex only)')
+@click.option('--key', required=True, type=str, help='Key (ASCII hex)')
+@click.option('--plaintext', type=str,
+              help='Plaintext of every block (ASCII hex); if omitted, one '
+                   'random plaintext for hex output, or a random plaintext '
+                   'per block for a trace set')
+@click.option('-n', '--count', type=int, default=1000, show_default=True,
+              help='Number of faulty ciphertexts')
+@click.option('--round', 'fault_round', type=int, default=9,
+              show_default=True, help='Round of the fault')
+@click.option('--stage', type=click.Choice(POINTS), default='s_row',
+              show_default=True,
+              help='Stage after which the fault is injected')
+@click.option('--fault', type=click.Choice(FAULTS), default='byte',
+              show_default=True, help='Fault model')
+@click.option('--position', type=int,
+              help='State byte index (0-15); random if omitted')
+@click.option('--seed', type=int, help='Random seed')
+@click.option('--workers', type=int, default=1, show_default=True,
+              help='Worker processes')
+@click.option('--format', 'fmt', type=click.Choice(('hex', 'binary')),
+              default='hex', show_default=True,
+              help='Hex lines for the dfa command, or a trace set')
+def faultsim_file(output, key, plaintext, count, fault_round, stage, fault,
+                  position, seed, workers, fmt):
+    from . import faultsim
+
+    key = bytearray.fromhex(key.replace(' ', ''))
+    if plaintext is not None:
+        plaintext = bytearray.fromhex(plaintext.replace(' ', ''))
+    elif fmt == 'hex':
+        # The dfa command takes one reference ciphertext, so one plaintext
+        plaintext = faultsim.random_plaintext(seed)
+    if fmt == 'binary' and output == '-':
+        raise click.UsageError("Binary output requires a file")
+
+    start = time.perf_counter()
+    batches = faultsim.simulate(count, key, plaintext, fault_round, stage,
+                                fault, position, seed, workers)
+    try:
+        if fmt == 'binary':
+            ts = faultsim.create_traceset(output)
+            for plaintexts, reference, faulty in batches:
+                ts.append(plaintexts, reference, samples=faulty)
+        else:
+            # Leave stdout open for the caller
+            out = (contextlib.nullcontext(sys.stdout) if output == '-'
+                   else open(output, 'w'))
+            last = None
+            with out as f:
+                for _, reference, faulty in batches:
+                    last = faultsim.write_hex(f, reference, faulty, last)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    elapsed = time.perf_counter() - start
+
+    click.echo("Simulated {count} faults in {elapsed:.3f} s".format(
+        count=count, elapsed=elapsed), err=True)
+
+
+@cli.command('tvla', short_help='Test a trace set for leakage')
+@click.option('-f', '--filename', required=True,
+              type=click.Path(exists=True, dir_okay=False),
+              help='Trace set path')
+@click.option('--test', type=click.Choice(TESTS), default='fixed',
+              show_default=True, help='Trace partition')
+@click.option('--key', type=str,
+              help='Key (ASCII hex); by default the keys in the trace set')
+@click.option('--fixed', type=str,
+              help='Fixed plaintext (ASCII hex), for the fixed test')
+@click.option('--byte', type=int, default=0, show_default=True,
+              help='State byte index, for the sbox_bit and last_hd tests')
+@click.option('--bit', type=int, default=0, show_default=True,
+              help='Bit index, for the sbox_bit test')
+@click.option('--order', type=int, default=1, show_default=True,
+              help='Highest order to test')
+@click.option('--threshold', type=float, default=THRESHOLD,
+              show_default=True, help='Leakage threshold on |t|')
+@click.option('--workers', type=int, default=1, show_default=True,
+              help='Worker processes')
+@click.option('--chunk-size', type=int, default=TRACE_CHUNK_SIZE,
+              show_default=True, help='Traces per chunk')
+@click.option('-o', '--output', type=click.Path(dir_okay=False),
+              help='Save the t-statistics, (order, samples), as .npy')
+def tvla_file(filename, test, key, fixed, byte, bit, order, threshold,
+              workers, chunk_size, output):
+    import numpy as np
+    from . import tvla
+
+    if key is not None:
+        key = bytearray.fromhex(key.replace(' ', ''))
+    if fixed is not None:
+        fixed = bytearray.fromhex(fixed.replace(' ', ''))
+
+    try:
+        result = tvla.assess(filename, test, order, key, fixed, byte, bit,
+                             workers, chunk_size)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+
+    t = result.t()
+    if output is not None:
+        np.save(output, t)
+
+    print("Traces: {n0} in group 0, {n1} in group 1".format(
+        n0=result.n[0], n1=result.n[1]))
+    for d, row in enumerate(np.abs(t), 1):
+        print("Order {d}: max |t| {t:.2f} at sample {i}, {n} samples over "
+              "{threshold}".format(d=d, t=row.max(), i=row.argmax(),
+                                   n=(row > threshold).sum(),
+                                   threshold=threshold))
+
+    if (np.abs(t) > threshold).any():
+        click.secho("Leakage detected", fg="bright_red", bold=True)
+    else:
+        click.secho("No leakage detected", bold=True)
+
+
 if __name__ == "__main__":
     cli(prog_name='aes-tools')
@@ -0,0 +1,235 @@
+"""Bitsliced AES engine
+
+Blocks are transposed into bit planes: planes[b, i, w] holds bit b of byte
+i of 64 blocks, one per bit of the uint64 word w. Every operation then
+processes 64 blocks per word with bitwise logic only:
+
+    SubBytes        GF(2^8) inversion as x^254 (AND/XOR multiplier circuit
+                    plus linear squarings), then the affine map
+    ShiftRows       a permutation of the byte axis
+    MixColumns      XORs of rotated rows and linear doubling
+    AddRoundKey     XOR with round key planes, which may differ per block
+
+Linear maps on a byte (squaring, doubling, the affine maps) are applied as
+XORs of the planes selected by an 8x8 bit matrix.
+"""
+from __future__ import division
+
+import numpy as np
+
+from .constants import GMUL, SHIFT_ROWS, SHIFT_ROWS_INV
+
+
+LANES = 64
+
+# Blocks per pass; larger batches are split into runs of this size
+CHUNK_SIZE = 128 * LANES
+
+_ONES = ~np.uint64(0)
+
+
+def _bit_matrix(f):
+    """8x8 matrix M of a GF(2)-linear byte map, f(x) bit m == M[m] . x"""
+    columns = np.array([f(1 << i) for i in range(8)])
+    return (columns[None, :] >> np.arange(8)[:, None]) & 1
+
+
+def _rotl(x, n):
+    return ((x << n) | (x >> (8 - n))) & 0xff
+
+
+def _selections(matrix):
+    return [np.flatnonzero(row) for row in matrix % 2]
+
+
+_SQUARE = _bit_matrix(lambda x: GMUL[x, x])
+_AFFINE = _bit_matrix(
+    lambda x: x ^ _rotl(x, 1) ^ _rotl(x, 2) ^ _rotl(x, 3) ^ _rotl(x, 4))
+
+# Product bits: bit m of a * b is the XOR of a_i & b_j over the (i, j)
+# selected by row m, flattened to 8 * i + j
+_PRODUCT = np.array([
+    [(GMUL[1 << i, 1 << j] >> m) & 1 for i in range(8) for j in range(8)]
+    for m in range(8)])
+
+# Repeated squarings are a single linear map, and the affine map is folded
+# into the final multiplication of the inversion
+_POW_2 = _selections(_SQUARE)
+_POW_4 = _selections(_SQUARE @ _SQUARE)
+_POW_16 = _selections(np.linalg.matrix_power(_SQUARE, 4))
+_MULTIPLY = _selections(_PRODUCT)
+_MULTIPLY_AFFINE = _selections(_AFFINE @ _PRODUCT)
+_AFFINE_INV = _selections(_bit_matrix(
+    lambda x: _rotl(x, 1) ^ _rotl(x, 3) ^ _rotl(x, 6)))
+_DOUBLE = _selections(_bit_matrix(lambda x: GMUL[2, x]))
+_QUADRUPLE = _selections(_bit_matrix(lambda x: GMUL[4, x]))
+
+# Byte indices of the next rows within each column
+_ROW_1 = np.array([4 * (i // 4) + (i + 1) % 4 for i in range(16)])
+_ROW_2 = np.array([4 * (i // 4) + (i + 2) % 4 for i in range(16)])
+_ROW_3 = np.array([4 * (i // 4) + (i + 3) % 4 for i in range(16)])
+
+
+def _linear(p, selections):
+    return np.stack([np.bitwise_xor.reduce(p[s], axis=0)
+                     for s in selections])
+
+
+def _add_constant(p, c):
+    p = p.copy()
+    for b in range(8):
+        if (c >> b) & 1:
+            p[b] = ~p[b]
+    return p
+
+
+def _multiply(a, b, selections=_MULTIPLY):
+    products = (a[:, None] & b[None, :]).reshape((64,) + a.shape[1:])
+    return _linear(products, selections)
+
+
+def _invert(x, selections=_MULTIPLY):
+    """x^254, the multiplicative inverse (0 maps to 0)
+
+    The last multiplication uses the given product selections.
+    """
+    x2 = _linear(x, _POW_2)
+    x3 = _multiply(x2, x)
+    x12 = _linear(x3, _POW_4)
+    x15 = _multiply(x12, x3)
+    x240 = _linear(x15, _POW_16)
+    x252 = _multiply(x240, x12)
+    return _multiply(x252, x2, selections)
+
+
+def sub_bytes(p):
+    return _add_constant(_invert(p, _MULTIPLY_AFFINE), 0x63)
+
+
+def sub_bytes_inv(p):
+    return _invert(_linear(_add_constant(p, 0x63), _AFFINE_INV))
+
+
+def shift_rows(p):
+    return p[:, SHIFT_ROWS]
+
+
+def shift_rows_inv(p):
+    return p[:, SHIFT_ROWS_INV]
+
+
+def mix_columns(p):
+    # 2 * a0 ^ 3 * a1 ^ a2 ^ a3 == 2 * (a0 ^ a1) ^ a1 ^ a2 ^ a3
+    r1 = p[:, _ROW_1]
+    return _linear(p ^ r1, _DOUBLE) ^ r1 ^ p[:, _ROW_2] ^ p[:, _ROW_3]
+
+
+def mix_columns_inv(p):
+    # InvMixColumns == MixColumns after a_r ^= 4 * (a_r ^ a_r+2)
+    return mix_columns(p ^ _linear(p ^ p[:, _ROW_2], _QUADRUPLE))
+
+
+def pack(blocks):
+    """Transpose (N, W) blocks into (8, W, ceil(N / 64)) uint64 planes
+
+    Blocks are padded with zeros to a multiple of 64.
+    """
+    blocks = np.asarray(blocks, dtype=np.uint8)
+    n, width = blocks.shape
+    k = -(-n // LANES)
+    columns = np.zeros((width, k * LANES), dtype=np.uint8)
+    columns[:, :n] = blocks.T
+
+    planes = np.empty((8, width, k), dtype=np.uint64)
+    for b in range(8):
+        bits = ((columns >> b) & 1).reshape(width, k, LANES)
+        words = np.packbits(bits, axis=-1, bitorder='little')
+        planes[b] = words.view('<u8')[..., 0]
+    return planes
+
+
+def unpack(planes, n):
+    """Transpose (8, W, k) planes back into (n, W) blocks"""
+    width, k = planes.shape[1:]
+    columns = np.zeros((width, k * LANES), dtype=np.uint8)
+    for b in range(8):
+        words = np.ascontiguousarray(planes[b], dtype='<u8').view(np.uint8)
+        bits = np.unpackbits(words, axis=-1, bitorder='little')
+        columns |= bits << b
+    return np.ascontiguousarray(columns[:, :n].T)
+
+
+def _key_planes(rk):
+    """Round key planes, (Nr + 1, 8, 16, k) or broadcastable to it"""
+    if rk.ndim == 2:
+        # Same key for every block: all-ones or all-zeros planes
+        bits = (rk[:, None, :] >> np.arange(8)[:, None]) & 1
+        return (bits.astype(np.uint64) * _ONES)[..., None]
+    n, rounds = rk.shape[:2]
+    planes = pack(rk.reshape(n, rounds * 16))
+    return planes.reshape(8, rounds, 16, -1).swapaxes(0, 1)
+
+
+def _encrypt(blocks, rk, Nr):
+    k = _key_planes(rk)
+    p = pack(blocks) ^ k[0]
+
+    for r in range(1, Nr + 1):
+        p = shift_rows(sub_bytes(p))
+        if r != Nr:
+            p = mix_columns(p)
+        p ^= k[r]
+
+    return unpack(p, len(blocks))
+
+
+def _decrypt(blocks, rk, Nr):
+    k = _key_planes(rk)
+    p = pack(blocks)
+
+    for r in reversed(range(1, Nr + 1)):
+        p ^= k[r]
+        if r != Nr:
+            p = mix_columns_inv(p)
+        p = sub_bytes_inv(shift_rows_inv(p))
+
+    p ^= k[0]
+
+    return unpack(p, len(blocks))
+
+
+def _chunked(fn, blocks, rk, Nr):
+    """Apply fn to runs of CHUNK_SIZE blocks, which keeps planes in cache"""
+    blocks = np.asarray(blocks, dtype=np.uint8)
+    rk = np.asarray(rk, dtype=np.uint8)
+    result = np.empty_like(blocks)
+    for start in range(0, len(blocks), CHUNK_SIZE):
+        stop = start + CHUNK_SIZE
+        result[start:stop] = fn(blocks[start:stop],
+                                rk if rk.ndim == 2 else rk[start:stop], Nr)
+    return result
+
+
+def encrypt_blocks(blocks, rk, Nr=10):
+    """Encrypt an (N, 16) array of blocks with the given round keys.
+
+    Args:
+        blocks: (N, 16) uint8 array
+        rk: (Nr + 1, 16) flattened round keys, or (N, Nr + 1, 16) for a
+            different key per block
+        Nr: Number of cipher rounds
+    """
+    return _chunked(_encrypt, blocks, rk, Nr)
+
+
+def decrypt_blocks(blocks, rk, Nr=10, dk=None):
+    """Decrypt an (N, 16) array of blocks with the given round keys.
+
+    Args:
+        blocks: (N, 16) uint8 array
+        rk: (Nr + 1, 16) flattened round keys, or (N, Nr + 1, 16) for a
+            different key per block
+        Nr: Number of cipher rounds
+        dk: Unused, accepted for compatibility with the other engines
+    """
+    return _chunked(_decrypt, blocks, rk, Nr)
@@ -0,0 +1,207 @@
+"""DFA of many fault logs, one per target
+
+find_logs() expands directories and glob patterns into log paths, and
+run() attacks them in a process pool, one log per worker, writing a result
+file per target to an output directory. A target is named after its log
+file, without the extension:
+
+    for result in bulk.run(bulk.find_logs(['logs/']), 'results'):
+        print(result['target'], result['status'])
+
+A result holds the FIELDS: the key, a status from STATUSES, the number of
+ciphertexts read and of faults used, the remaining candidates, the time
+taken, the SHA-256 of the log, and the key length and plaintext of the
+attack. A target whose earlier result file recovered the key from the same
+log, with the same key length and plaintext, is skipped and the earlier
+result returned; other targets are attacked again.
+"""
+from __future__ import division
+
+import collections
+import concurrent.futures
+import csv
+import glob
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+
+from . import dfa
+
+
+FORMATS = ('json', 'csv')
+
+STATUSES = ('recovered', 'unresolved', 'error')
+
+# Result fields, in CSV column order
+FIELDS = ('target', 'status', 'key', 'ciphertexts', 'faults', 'candidates',
+          'seconds', 'sha256', 'key_len', 'plaintext', 'path', 'error')
+
+
+def _hex(plaintext):
+    if plaintext is None:
+        return None
+    return np.asarray(plaintext, dtype=np.uint8).tobytes().hex()
+
+
+def find_logs(patterns):
+    """Sorted log paths: the files in each directory, or matching each glob
+    pattern"""
+    paths = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            names = [os.path.join(pattern, name)
+                     for name in os.listdir(pattern)]
+        else:
+            names = glob.glob(pattern)
+        paths.update(name for name in names if os.path.isfile(name))
+    return sorted(paths)
+
+
+def target_name(path):
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def file_hash(path):
+    """SHA-256 of a file's contents, as hex"""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(dfa.HEX_CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def attack(path, key_len=16, plaintext=None):
+    """DFA one log
+
+    Failures to read or parse the log are reported in the result, with
+    status 'error', rather than raised.
+
+    Returns:
+        A result dict with the FIELDS
+    """
+    start = time.perf_counter()
+    result = dict.fromkeys(FIELDS)
+    result.update(target=target_name(path), path=path, ciphertexts=0,
+                  faults=0, key_len=key_len, plaintext=_hex(plaintext))
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+        result['sha256'] = hashlib.sha256(data).hexdigest()
+
+        blocks = dfa.parse_hex(data)
+        result['ciphertexts'] = len(blocks)
+        if not len(blocks):
+            raise ValueError("No ciphertexts")
+
+        recovery = dfa.recover(blocks[0], blocks[1:], plaintext=plaintext,
+                               key_len=key_len)
+    except (OSError, ValueError) as e:
+        result.update(status='error', error=str(e))
+    else:
+        result.update(faults=recovery.faults(),
+                      candidates=recovery.candidates(), error=recovery.error)
+        if recovery.key is None:
+            result['status'] = 'unresolved'
+        else:
+            result.update(status='recovered',
+                          key=np.asarray(recovery.key).tobytes().hex())
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+
+def result_path(output_dir, path, fmt='json'):
+    """Path of the result file of a log"""
+    return os.path.join(output_dir, target_name(path) + '.' + fmt)
+
+
+def write_result(result, path, fmt='json'):
+    with open(path, 'w', newline='') as f:
+        if fmt == 'json':
+            json.dump({k: result[k] for k in FIELDS}, f, indent=1)
+            f.write('\n')
+        else:
+            writer = csv.DictWriter(f, FIELDS, extrasaction='ignore')
+            writer.writeheader()
+            writer.writerow(result)
+
+
+def read_result(path, fmt='json'):
+    """A result file's result; CSV values are read back as strings"""
+    with open(path, 'r', newline='') as f:
+        if fmt == 'json':
+            return json.load(f)
+        return next(csv.DictReader(f))
+
+
+def _earlier(path, out, fmt, key_len, plaintext):
+    """The earlier result of a log, if it recovered the key from the same
+    log with the same attack parameters"""
+    if not os.path.exists(out):
+        return None
+    try:
+        earlier = read_result(out, fmt)
+    except (ValueError, StopIteration):
+        return None
+    # CSV values are strings, and None is written as ''
+    if (earlier.get('status') != 'recovered' or
+            str(earlier.get('key_len')) != str(key_len) or
+            (earlier.get('plaintext') or None) != _hex(plaintext)):
+        return None
+    return earlier if earlier.get('sha256') == file_hash(path) else None
+
+
+def run(paths, output_dir, fmt='json', workers=1, key_len=16,
+        plaintext=None, force=False):
+    """Attack each log, writing a result file per target
+
+    Args:
+        paths: Log paths; their target names must be unique
+        output_dir: Directory for the result files, created if need be
+        fmt: Result file format, from FORMATS
+        workers: Worker processes, each attacking one log at a time
+        key_len: Key length in bytes
+        plaintext: Optional plaintext, to check the key candidates
+        force: Attack every log, even if its key was already recovered
+
+    Yields:
+        Result dicts, with 'skipped' True for earlier results that are
+        reused; skipped targets first, then in order of completion
+    """
+    if fmt not in FORMATS:
+        raise ValueError("Invalid result format: %r" % (fmt,))
+    counts = collections.Counter(target_name(path) for path in paths)
+    duplicates = sorted(name for name, n in counts.items() if n > 1)
+    if duplicates:
+        raise ValueError("Duplicate target names: %s" %
+                         (', '.join(duplicates),))
+    os.makedirs(output_dir, exist_ok=True)
+
+    pending = []
+    for path in paths:
+        earlier = None if force else _earlier(
+            path, result_path(output_dir, path, fmt), fmt, key_len,
+            plaintext)
+        if earlier is not None:
+            earlier['skipped'] = True
+            yield earlier
+        else:
+            pending.append(path)
+
+    def finish(result):
+        write_result(result, result_path(output_dir, result['path'], fmt),
+                     fmt)
+        result['skipped'] = False
+        return result
+
+    if workers > 1 and len(pending) > 1:
+        with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+            futures = [executor.submit(attack, path, key_len, plaintext)
+                       for path in pending]
+            for future in concurrent.futures.as_completed(futures):
+                yield finish(future.result())
+    else:
+        for path in pending:
+            yield finish(attack(path, key_len, plaintext))
@@ -1,10 +1,13 @@
 from __future__ import division
-import binascii
-import unittest
+import collections
+import threading
 
 import numpy as np
 
+from . import bitslice
 from . import ops
+from . import scalar
+from . import ttable
 
 
 KEY_LEN_TO_ROUNDS = {
@@ -14,125 +17,159 @@ KEY_LEN_TO_ROUNDS = {
 }
 
 
+# Recordable stages of each round, in the order of RoundState attributes
+STAGES = ('s_box', 's_row', 'm_col', 'k_sch', 'add_k')
+
+
 class RoundState:
-    """Dummy object to quickly hold and build up AES intermediate state
+    """View of one recorded round in a StateTracker
+
+    Each stage attribute is a view of the tracker's array, laid out as an AES
+    state (row, column), or None if the stage was not recorded. For a batch
+    tracker the states are stacked, with shape (N, 4, 4).
     """
-    s_box = None
-    s_row = None
-    m_col = None
-    k_sch = None
-    add_k = None
 
+    def __init__(self, tracker, index):
+        self._tracker = tracker
+        self._index = index
 
-class StateTracker:
-    """Object to aid in keeping track of round states
+    def _stage(self, stage):
+        t = self._tracker
+        si = t._stage_index.get(stage, None)
+        if si is None or not t.recorded[self._index, si]:
+            return None
+        return t._as_state(t.states[:, self._index, si])
+
+    s_box = property(lambda self: self._stage('s_box'))
+    s_row = property(lambda self: self._stage('s_row'))
+    m_col = property(lambda self: self._stage('m_col'))
+    k_sch = property(lambda self: self._stage('k_sch'))
+    add_k = property(lambda self: self._stage('add_k'))
 
-    Attributes, other than append(), start, and result, are retreived from the
-    latest round.
 
-    Each round's RoundState object can be retreived by index lookup.
+class StateTracker:
+    """Records AES intermediate states into a preallocated array
+
+    Only the selected rounds and stages are stored, in an array of shape
+    (N, len(rounds), len(stages), 16) holding flattened (column-major)
+    states. Rounds are numbered in the order they are processed, so for
+    decryption round 1 uses the round key Nr - 1.
+
+    Each round's RoundState view can be retrieved by round number.
+
+    Attributes:
+        states: The recorded states
+        recorded: (len(rounds), len(stages)) mask of slots that were written
+        rounds: Recorded round numbers
+        stages: Recorded stage names, from STAGES
+        start: The input state
+        result: The output block(s)
     """
 
-    def __init__(self):
-        self._rounds = []
+    def __init__(self, n=None, Nr=10, rounds=None, stages=STAGES):
+        """
+        Args:
+            n: Number of blocks, or None to track a single block
+            Nr: Number of cipher rounds
+            rounds: Round numbers to record, default all
+            stages: Stage names to record, default all
+        """
+        if rounds is None:
+            rounds = range(Nr + 1)
+        self.rounds = tuple(r % (Nr + 1) for r in rounds)
+        self.stages = tuple(stages)
+        for stage in self.stages:
+            if stage not in STAGES:
+                raise ValueError("Invalid stage: %r" % (stage,))
+
+        self.Nr = Nr
+        self._single = n is None
+        self._round_index = dict((r, i) for i, r in enumerate(self.rounds))
+        self._stage_index = dict((s, i) for i, s in enumerate(self.stages))
+
+        self.states = np.zeros(
+            (1 if n is None else n, len(self.rounds), len(self.stages), 16),
+            dtype=np.uint8)
+        self.recorded = np.zeros((len(self.rounds), len(self.stages)),
+                                 dtype=bool)
         self.start = None
         self.result = None
 
-    def new_round(self):
-        self._rounds.append(RoundState())
-
-    @property
-    def round(self):
-        """The latest round"""
-        return self._rounds[-1]
-
-    def __getitem__(self, i):
-        return self._rounds[i]
+    def _as_state(self, flat):
+        state = flat.reshape(flat.shape[:-1] + (4, 4)).swapaxes(-1, -2)
+        return state[0] if self._single else state
+
+    def record(self, r, stage, state):
+        """Store a state, if round r and the stage are being recorded"""
+        ri = self._round_index.get(r, None)
+        si = self._stage_index.get(stage, None)
+        if ri is not None and si is not None:
+            self.states[:, ri, si] = state
+            self.recorded[ri, si] = True
+
+    def __getitem__(self, r):
+        if r < 0:
+            r += self.Nr + 1
+        if r not in self._round_index:
+            raise IndexError("Round not recorded: %d" % (r,))
+        return RoundState(self, self._round_index[r])
 
     def __len__(self):
-        return len(self._rounds)
+        return len(self.rounds)
 
 
-def encrypt_explicit(inb, key, Nr=10, Nb=4):
+def encrypt_explicit(inb, key, Nr=10, Nb=4, w=None, rounds=None,
+                     stages=STAGES):
     """Encrypt the given block with the given key.
 
     Returns:
         A StateTracker object
 
-    The StateTracker contains an array of RoundState objects. This allows
-    for inspection of intermediate state of the AES encryption operation.
+    The StateTracker records the intermediate state of the AES encryption
+    operation, for the given rounds and stages (default all).
 
     To get the output, use state_tracker.result
+
+    A pre-expanded key schedule, w, skips the key expansion.
     """
     if len(inb) != 4 * Nb:
         raise ValueError("Invalid input block length: %d" % (len(inb),))
 
-    t = StateTracker()
-    w = ops.key_expansion(key, Nr, Nb)
-
-    t.new_round()
-
-    t.start = state = inb.reshape(4, Nb).T
-    t.round.k_sch = w[:Nb].T
-    t.round.add_k = state = ops.add_round_key(state, t.round.k_sch)
-
-    for r in range(1, Nr):
-        t.new_round()
-        t.round.s_box = state = ops.sub_bytes(state)
-        t.round.s_row = state = ops.shift_rows(state)
-        t.round.m_col = state = ops.mix_columns(state)
-        t.round.k_sch = w[r * Nb: (r + 1) * Nb].T
-        t.round.add_k = state = ops.add_round_key(state, t.round.k_sch)
-
-    t.new_round()
-    t.round.s_box = state = ops.sub_bytes(state)
-    t.round.s_row = state = ops.shift_rows(state)
-    t.round.k_sch = w[Nr * Nb: (Nr + 1) * Nb].T
-    t.round.add_k = state = ops.add_round_key(state, t.round.k_sch)
+    if w is None:
+        w = ops.key_expansion(key, Nr, Nb)
 
-    t.result = state.T.reshape(16,)
+    t = StateTracker(None, Nr, rounds, stages)
+    t.start = inb.reshape(4, Nb).T
+    t.result = encrypt_blocks(inb.reshape(1, 4 * Nb), _round_keys(w, Nr, Nb),
+                              Nr, t)[0]
 
     return t
 
 
-def decrypt_explicit(inb, key, Nr=10, Nb=4):
+def decrypt_explicit(inb, key, Nr=10, Nb=4, w=None, rounds=None,
+                     stages=STAGES):
     """Decrypt the given block with the given key.
 
     Returns:
         A StateTracker object
 
-    The StateTracker contains an array of RoundState objects. This allows
-    for inspection of intermediate state of the AES encryption operation.
+    The StateTracker records the intermediate state of the AES decryption
+    operation, for the given rounds and stages (default all).
 
     To get the output, use state_tracker.result
+
+    A pre-expanded key schedule, w, skips the key expansion.
     """
     if len(inb) != 4 * Nb:
         raise ValueError("Invalid input block length: %d" % (len(inb),))
 
-    w = ops.key_expansion(key, Nr, Nb)
-
-    t = StateTracker()
-    t.new_round()
-
-    t.start = state = inb.reshape(4, Nb).T
-    t.round.k_sch = w[Nr * Nb: (Nr + 1) * Nb].T
-    t.round.add_k = state = ops.add_round_key(state, t.round.k_sch)
-    t.round.s_row = state = ops.shift_rows_inv(state)
-    t.round.s_box = state = ops.sub_bytes_inv(state)
-
-    for r in reversed(range(1, Nr)):
-        t.new_round()
-        t.round.k_sch = w[r * Nb: (r + 1) * Nb].T
-        t.round.add_k = state = ops.add_round_key(state, t.round.k_sch)
-        t.round.m_col = state = ops.mix_columns_inv(state)
-        t.round.s_row = state = ops.shift_rows_inv(state)
-        t.round.s_box = state = ops.sub_bytes_inv(state)
+    if w is None:
+        w = ops.key_expansion(key, Nr, Nb)
 
-    t.new_round()
-    t.round.k_sch = w[:Nb].T
-    t.round.add_k = state = ops.add_round_key(state, t.round.k_sch)
-
-    t.result = state.T.reshape(16,)
+    t = StateTracker(None, Nr, rounds, stages)
+    t.start = inb.reshape(4, Nb).T
+    t.result = decrypt_blocks(inb.reshape(1, 4 * Nb), _round_keys(w, Nr, Nb),
+                              Nr, tracker=t)[0]
 
     return t
 
@@ -144,11 +181,410 @@ def _num_rounds(key):
     return rounds
 
 
-def encrypt(inb, key):
-    rounds = _num_rounds(key)
-    return encrypt_explicit(inb, key, rounds).result
+def check_blocks(blocks):
+    """Blocks as a uint8 array; raises ValueError unless (N, 16)"""
+    blocks = np.asarray(blocks, dtype=np.uint8)
+    if blocks.ndim != 2 or blocks.shape[1] != 16:
+        raise ValueError("Invalid block array shape: %s" % (blocks.shape,))
+    return blocks
+
+
+def _round_keys(w, Nr, Nb=4):
+    """View a key schedule as (Nr + 1, 16) flattened round keys"""
+    return w.reshape(Nr + 1, 4 * Nb)
 
 
-def decrypt(inb, key):
-    rounds = _num_rounds(key)
-    return decrypt_explicit(inb, key, rounds).result
+def encrypt_blocks(blocks, rk, Nr=10, tracker=None):
+    """Encrypt an (N, 16) array of blocks with the given round keys.
+
+    Args:
+        blocks: (N, 16) uint8 array
+        rk: (Nr + 1, 16) flattened round keys, or (N, Nr + 1, 16) for a
+            different key per block
+        Nr: Number of cipher rounds
+        tracker: Optional StateTracker to record intermediate states
+    """
+    t = tracker
+    state = blocks ^ rk[..., 0, :]
+    if t is not None:
+        t.record(0, 'k_sch', rk[..., 0, :])
+        t.record(0, 'add_k', state)
+
+    for r in range(1, Nr + 1):
+        state = ops.sub_bytes_batch(state)
+        if t is not None:
+            t.record(r, 's_box', state)
+        state = ops.shift_rows_batch(state)
+        if t is not None:
+            t.record(r, 's_row', state)
+        if r != Nr:
+            state = ops.mix_columns_batch(state)
+            if t is not None:
+                t.record(r, 'm_col', state)
+        state ^= rk[..., r, :]
+        if t is not None:
+            t.record(r, 'k_sch', rk[..., r, :])
+            t.record(r, 'add_k', state)
+
+    return state
+
+
+def decrypt_blocks(blocks, rk, Nr=10, dk=None, tracker=None):
+    """Decrypt an (N, 16) array of blocks with the given round keys.
+
+    Args:
+        blocks: (N, 16) uint8 array
+        rk: (Nr + 1, 16) flattened round keys, or (N, Nr + 1, 16) for a
+            different key per block
+        Nr: Number of cipher rounds
+        dk: Unused, accepted for compatibility with the other engines
+        tracker: Optional StateTracker to record intermediate states
+    """
+    t = tracker
+    state = blocks
+
+    for r in range(Nr):
+        k = rk[..., Nr - r, :]
+        state = state ^ k
+        if t is not None:
+            t.record(r, 'k_sch', k)
+            t.record(r, 'add_k', state)
+        if r:
+            state = ops.mix_columns_inv_batch(state)
+            if t is not None:
+                t.record(r, 'm_col', state)
+        state = ops.shift_rows_inv_batch(state)
+        if t is not None:
+            t.record(r, 's_row', state)
+        state = ops.sub_bytes_inv_batch(state)
+        if t is not None:
+            t.record(r, 's_box', state)
+
+    state ^= rk[..., 0, :]
+    if t is not None:
+        t.record(Nr, 'k_sch', rk[..., 0, :])
+        t.record(Nr, 'add_k', state)
+
+    return state
+
+
+# State boundaries within a round, in cipher order. 'input' is the state
+# entering a round, the same as 'add_k' of the previous round; round 0
+# 'input' is the plaintext.
+BOUNDARIES = ('input', 's_box', 's_row', 'm_col', 'add_k')
+
+_FORWARD = {
+    's_box': ops.sub_bytes_batch,
+    's_row': ops.shift_rows_batch,
+    'm_col': ops.mix_columns_batch,
+}
+
+_INVERSE = {
+    's_box': ops.sub_bytes_inv_batch,
+    's_row': ops.shift_rows_inv_batch,
+    'm_col': ops.mix_columns_inv_batch,
+}
+
+
+def _steps(Nr):
+    """Encryption steps as (stage, round); step i leads from boundary i"""
+    steps = [('add_k', 0)]
+    for r in range(1, Nr + 1):
+        steps += [('s_box', r), ('s_row', r)]
+        if r != Nr:
+            steps.append(('m_col', r))
+        steps.append(('add_k', r))
+    return steps
+
+
+def boundary_index(point, Nr=10):
+    """Position of a (round, stage) boundary in encryption order
+
+    The plaintext is 0 and the ciphertext is the last position.
+    """
+    r, stage = point
+    if stage == 'input':
+        if r == 0:
+            return 0
+        r, stage = r - 1, 'add_k'
+    try:
+        return _steps(Nr).index((stage, r)) + 1
+    except ValueError:
+        raise ValueError("Invalid boundary: round %d, %s" % point)
+
+
+def _round_key(rk, r):
+    if isinstance(rk, dict):
+        if r not in rk:
+            raise ValueError("Round key %d not given" % (r,))
+        return np.asarray(rk[r], dtype=np.uint8)
+    return rk[..., r, :]
+
+
+def evaluate(state, rk, start, stop, Nr=None):
+    """Run the cipher between two (round, stage) boundaries
+
+    Runs forwards (encryption) if stop follows start, else backwards. All
+    arguments broadcast: e.g. (N, 16) texts with (256, 1, 16) key guesses
+    give (256, N, 16) states.
+
+    Args:
+        state: (..., 16) states at start
+        rk: (..., Nr + 1, 16) round keys, or a dict of the (..., 16) round
+            keys that are needed, e.g. {10: last_round_key}
+        start: (round, stage) boundary of state, stage from BOUNDARIES
+        stop: (round, stage) boundary to stop at
+        Nr: Number of cipher rounds; required if rk is a dict
+
+    Returns:
+        (..., 16) states at stop
+    """
+    if Nr is None:
+        if isinstance(rk, dict):
+            raise ValueError("Nr is required with partial round keys")
+        Nr = rk.shape[-2] - 1
+    steps = _steps(Nr)
+    i = boundary_index(start, Nr)
+    j = boundary_index(stop, Nr)
+    state = np.asarray(state, dtype=np.uint8)
+
+    if i <= j:
+        for stage, r in steps[i:j]:
+            if stage == 'add_k':
+                state = state ^ _round_key(rk, r)
+            else:
+                state = _FORWARD[stage](state)
+    else:
+        for stage, r in reversed(steps[j:i]):
+            if stage == 'add_k':
+                state = state ^ _round_key(rk, r)
+            else:
+                state = _INVERSE[stage](state)
+
+    return state
+
+
+# Batch engines: name -> (encrypt_blocks, decrypt_blocks)
+ENGINES = {
+    'explicit': (encrypt_blocks, decrypt_blocks),
+    'table': (ttable.encrypt_blocks, ttable.decrypt_blocks),
+    'bitslice': (bitslice.encrypt_blocks, bitslice.decrypt_blocks),
+    'scalar': (scalar.encrypt_blocks, scalar.decrypt_blocks),
+}
+
+
+def _engine(name):
+    engine = ENGINES.get(name, None)
+    if engine is None:
+        raise ValueError("Invalid engine: %r" % (name,))
+    return engine
+
+
+class AES:
+    """AES cipher with an expanded key
+
+    The forward key schedule and the equivalent inverse cipher schedule are
+    computed once, at construction. encrypt_block() and decrypt_block() run
+    single blocks on the scalar engine, with its round keys also prepared
+    at construction.
+
+    Attributes:
+        key: The cipher key
+        rounds: Number of cipher rounds
+        w: Key schedule, as returned by ops.key_expansion()
+        rk: (rounds + 1, 16) flattened encryption round keys
+        dk: (rounds + 1, 16) equivalent inverse cipher round keys
+        engine: Default engine name, from ENGINES
+    """
+
+    def __init__(self, key, engine='explicit'):
+        _engine(engine)
+        self.key = np.array(key, dtype=np.uint8)
+        self.rounds = _num_rounds(self.key)
+        self.w = ops.key_expansion(self.key, self.rounds)
+        self.rk = _round_keys(self.w, self.rounds)
+        self.dk = ttable.inverse_round_keys(self.rk, self.rounds)
+        self.engine = engine
+        self._scalar_rk = scalar.round_keys(self.rk)
+        self._scalar_dk = scalar.round_keys(self.dk)
+
+    def encrypt(self, inb, engine=None):
+        engine = engine or self.engine
+        if engine == 'explicit':
+            return encrypt_explicit(inb, self.key, self.rounds,
+                                    w=self.w).result
+        if engine == 'scalar':
+            return self.encrypt_block(inb)
+        return self.encrypt_batch(inb.reshape(1, 16), engine)[0]
+
+    def decrypt(self, inb, engine=None):
+        engine = engine or self.engine
+        if engine == 'explicit':
+            return decrypt_explicit(inb, self.key, self.rounds,
+                                    w=self.w).result
+        if engine == 'scalar':
+            return self.decrypt_block(inb)
+        return self.decrypt_batch(inb.reshape(1, 16), engine)[0]
+
+    def _block(self, fn, block, keys):
+        if isinstance(block, np.ndarray):
+            if block.size != 16:
+                raise ValueError("Invalid block length: %d" % (block.size,))
+            out = fn(block.astype(np.uint8, copy=False).tobytes(), keys)
+            return np.frombuffer(bytearray(out), dtype=np.uint8)
+        if len(block) != 16:
+            raise ValueError("Invalid block length: %d" % (len(block),))
+        return fn(block, keys)
+
+    def encrypt_block(self, block):
+        """Encrypt a single block on the scalar engine
+
+        Args:
+            block: 16 bytes, as a bytes-like object or uint8 array
+
+        Returns:
+            bytes, or a (16,) uint8 array if block is an array
+        """
+        return self._block(scalar.encrypt_block, block, self._scalar_rk)
+
+    def decrypt_block(self, block):
+        """Decrypt a single block on the scalar engine, as encrypt_block()"""
+        return self._block(scalar.decrypt_block, block, self._scalar_dk)
+
+    def encrypt_batch(self, blocks, engine=None, tracker=None):
+        """ECB encrypt an (N, 16) array of blocks
+
+        Intermediate states can be recorded with a StateTracker, which
+        requires the explicit engine.
+        """
+        blocks = check_blocks(blocks)
+        if tracker is not None:
+            return self._tracked(encrypt_blocks, blocks, engine, tracker)
+        encrypt_fn, _ = _engine(engine or self.engine)
+        return encrypt_fn(blocks, self.rk, self.rounds)
+
+    def decrypt_batch(self, blocks, engine=None, tracker=None):
+        """ECB decrypt an (N, 16) array of blocks
+
+        Intermediate states can be recorded with a StateTracker, which
+        requires the explicit engine.
+        """
+        blocks = check_blocks(blocks)
+        if tracker is not None:
+            return self._tracked(decrypt_blocks, blocks, engine, tracker)
+        _, decrypt_fn = _engine(engine or self.engine)
+        return decrypt_fn(blocks, self.rk, self.rounds, dk=self.dk)
+
+    def _tracked(self, fn, blocks, engine, tracker):
+        if (engine or 'explicit') != 'explicit':
+            raise ValueError("State tracking requires the explicit engine")
+        tracker.start = blocks
+        tracker.result = fn(blocks, self.rk, self.rounds, tracker=tracker)
+        return tracker.result
+
+
+class KeyCache:
+    """Thread-safe LRU cache of AES objects, keyed on the key bytes
+
+    Attributes:
+        hits: Number of lookups served from the cache
+        misses: Number of lookups that expanded a new key
+    """
+
+    def __init__(self, maxsize=32):
+        self._lock = threading.Lock()
+        self._ciphers = collections.OrderedDict()
+        self._maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def maxsize(self):
+        return self._maxsize
+
+    @maxsize.setter
+    def maxsize(self, maxsize):
+        with self._lock:
+            self._maxsize = maxsize
+            self._evict()
+
+    def _evict(self):
+        while len(self._ciphers) > max(self._maxsize, 0):
+            self._ciphers.popitem(last=False)
+
+    def get(self, key):
+        """The AES object for the given key, expanding it on a miss"""
+        kb = np.asarray(key, dtype=np.uint8).tobytes()
+
+        with self._lock:
+            aes = self._ciphers.get(kb, None)
+            if aes is not None:
+                self._ciphers.move_to_end(kb)
+                self.hits += 1
+                return aes
+            self.misses += 1
+
+        aes = AES(key)
+
+        with self._lock:
+            self._ciphers[kb] = aes
+            self._evict()
+
+        return aes
+
+    def clear(self):
+        """Drop all cached keys and reset the counters"""
+        with self._lock:
+            self._ciphers.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'maxsize': self._maxsize,
+                'size': len(self._ciphers),
+            }
+
+    def __len__(self):
+        return len(self._ciphers)
+
+
+# Used by the module-level encrypt/decrypt functions
+key_cache = KeyCache()
+
+
+def encrypt(inb, key, engine='explicit'):
+    return key_cache.get(key).encrypt(inb, engine)
+
+
+def decrypt(inb, key, engine='explicit'):
+    return key_cache.get(key).decrypt(inb, engine)
+
+
+def encrypt_batch(blocks, key, engine='explicit', tracker=None):
+    """ECB encrypt an (N, 16) array of blocks with a single key.
+
+    Args:
+        engine: Name of the implementation to use, from ENGINES
+        tracker: Optional StateTracker(N, ...) to record intermediate states
+
+    Returns:
+        An (N, 16) uint8 array of ciphertexts
+    """
+    return key_cache.get(key).encrypt_batch(blocks, engine, tracker)
+
+
+def decrypt_batch(blocks, key, engine='explicit', tracker=None):
+    """ECB decrypt an (N, 16) array of blocks with a single key.
+
+    Args:
+        engine: Name of the implementation to use, from ENGINES
+        tracker: Optional StateTracker(N, ...) to record intermediate states
+
+    Returns:
+        An (N, 16) uint8 array of plaintexts
+    """
+    return key_cache.get(key).decrypt_batch(blocks, engine, tracker)
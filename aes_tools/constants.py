@@ -106,109 +106,31 @@ RCON = np.array((
     0xcc, 0x83, 0x1d, 0x3a, 0x74, 0xe8, 0xcb, 0x8d,
     ), dtype=np.uint8)
 
-GMUL = np.array((
-    (
-        0, 1, 2, 3, 4, 5, 6, 7,
-        8, 9, 10, 11, 12, 13, 14, 15,
-        16, 17, 18, 19, 20, 21, 22, 23,
-        24, 25, 26, 27, 28, 29, 30, 31,
-        32, 33, 34, 35, 36, 37, 38, 39,
-        40, 41, 42, 43, 44, 45, 46, 47,
-        48, 49, 50, 51, 52, 53, 54, 55,
-        56, 57, 58, 59, 60, 61, 62, 63,
-        64, 65, 66, 67, 68, 69, 70, 71,
-        72, 73, 74, 75, 76, 77, 78, 79,
-        80, 81, 82, 83, 84, 85, 86, 87,
-        88, 89, 90, 91, 92, 93, 94, 95,
-        96, 97, 98, 99, 100, 101, 102, 103,
-        104, 105, 106, 107, 108, 109, 110, 111,
-        112, 113, 114, 115, 116, 117, 118, 119,
-        120, 121, 122, 123, 124, 125, 126, 127,
-        128, 129, 130, 131, 132, 133, 134, 135,
-        136, 137, 138, 139, 140, 141, 142, 143,
-        144, 145, 146, 147, 148, 149, 150, 151,
-        152, 153, 154, 155, 156, 157, 158, 159,
-        160, 161, 162, 163, 164, 165, 166, 167,
-        168, 169, 170, 171, 172, 173, 174, 175,
-        176, 177, 178, 179, 180, 181, 182, 183,
-        184, 185, 186, 187, 188, 189, 190, 191,
-        192, 193, 194, 195, 196, 197, 198, 199,
-        200, 201, 202, 203, 204, 205, 206, 207,
-        208, 209, 210, 211, 212, 213, 214, 215,
-        216, 217, 218, 219, 220, 221, 222, 223,
-        224, 225, 226, 227, 228, 229, 230, 231,
-        232, 233, 234, 235, 236, 237, 238, 239,
-        240, 241, 242, 243, 244, 245, 246, 247,
-        248, 249, 250, 251, 252, 253, 254, 255
-    ),
-    (
-        0, 2, 4, 6, 8, 10, 12, 14,
-        16, 18, 20, 22, 24, 26, 28, 30,
-        32, 34, 36, 38, 40, 42, 44, 46,
-        48, 50, 52, 54, 56, 58, 60, 62,
-        64, 66, 68, 70, 72, 74, 76, 78,
-        80, 82, 84, 86, 88, 90, 92, 94,
-        96, 98, 100, 102, 104, 106, 108, 110,
-        112, 114, 116, 118, 120, 122, 124, 126,
-        128, 130, 132, 134, 136, 138, 140, 142,
-        144, 146, 148, 150, 152, 154, 156, 158,
-        160, 162, 164, 166, 168, 170, 172, 174,
-        176, 178, 180, 182, 184, 186, 188, 190,
-        192, 194, 196, 198, 200, 202, 204, 206,
-        208, 210, 212, 214, 216, 218, 220, 222,
-        224, 226, 228, 230, 232, 234, 236, 238,
-        240, 242, 244, 246, 248, 250, 252, 254,
-        27, 25, 31, 29, 19, 17, 23, 21,
-        11, 9, 15, 13, 3, 1, 7, 5,
-        59, 57, 63, 61, 51, 49, 55, 53,
-        43, 41, 47, 45, 35, 33, 39, 37,
-        91, 89, 95, 93, 83, 81, 87, 85,
-        75, 73, 79, 77, 67, 65, 71, 69,
-        123, 121, 127, 125, 115, 113, 119, 117,
-        107, 105, 111, 109, 99, 97, 103, 101,
-        155, 153, 159, 157, 147, 145, 151, 149,
-        139, 137, 143, 141, 131, 129, 135, 133,
-        187, 185, 191, 189, 179, 177, 183, 181,
-        171, 169, 175, 173, 163, 161, 167, 165,
-        219, 217, 223, 221, 211, 209, 215, 213,
-        203, 201, 207, 205, 195, 193, 199, 197,
-        251, 249, 255, 253, 243, 241, 247, 245,
-        235, 233, 239, 237, 227, 225, 231, 229
-    ),
-    (
-        0, 3, 6, 5, 12, 15, 10, 9,
-        24, 27, 30, 29, 20, 23, 18, 17,
-        48, 51, 54, 53, 60, 63, 58, 57,
-        40, 43, 46, 45, 36, 39, 34, 33,
-        96, 99, 102, 101, 108, 111, 106, 105,
-        120, 123, 126, 125, 116, 119, 114, 113,
-        80, 83, 86, 85, 92, 95, 90, 89,
-        72, 75, 78, 77, 68, 71, 66, 65,
-        192, 195, 198, 197, 204, 207, 202, 201,
-        216, 219, 222, 221, 212, 215, 210, 209,
-        240, 243, 246, 245, 252, 255, 250, 249,
-        232, 235, 238, 237, 228, 231, 226, 225,
-        160, 163, 166, 165, 172, 175, 170, 169,
-        184, 187, 190, 189, 180, 183, 178, 177,
-        144, 147, 150, 149, 156, 159, 154, 153,
-        136, 139, 142, 141, 132, 135, 130, 129,
-        155, 152, 157, 158, 151, 148, 145, 146,
-        131, 128, 133, 134, 143, 140, 137, 138,
-        171, 168, 173, 174, 167, 164, 161, 162,
-        179, 176, 181, 182, 191, 188, 185, 186,
-        251, 248, 253, 254, 247, 244, 241, 242,
-        227, 224, 229, 230, 239, 236, 233, 234,
-        203, 200, 205, 206, 199, 196, 193, 194,
-        211, 208, 213, 214, 223, 220, 217, 218,
-        91, 88, 93, 94, 87, 84, 81, 82,
-        67, 64, 69, 70, 79, 76, 73, 74,
-        107, 104, 109, 110, 103, 100, 97, 98,
-        115, 112, 117, 118, 127, 124, 121, 122,
-        59, 56, 61, 62, 55, 52, 49, 50,
-        35, 32, 37, 38, 47, 44, 41, 42,
-        11, 8, 13, 14, 7, 4, 1, 2,
-        19, 16, 21, 22, 31, 28, 25, 26
-    )), dtype=np.uint8)
+
+def _gf_tables():
+    """Antilog/log tables for GF(2^8) over the AES polynomial, generator 3
+    """
+    alog = np.zeros(255, dtype=np.uint8)
+    log = np.zeros(256, dtype=np.intp)
+    x = 1
+    for i in range(255):
+        alog[i] = x
+        log[x] = i
+        # x *= 3
+        x ^= ((x << 1) ^ (0x11b if x & 0x80 else 0))
+    return alog, log
+
+
+ALOG, LOG = _gf_tables()
+
+# Full multiplication table: GMUL[a, b] == a * b in GF(2^8)
+GMUL = ALOG[(LOG[:, None] + LOG[None, :]) % 255]
+GMUL[0, :] = 0
+GMUL[:, 0] = 0
+
+# Multiplicative inverse, with 0 mapped to 0
+GINV = ALOG[-LOG % 255]
+GINV[0] = 0
 
 
 MIX_COLS = np.array((
@@ -224,3 +146,24 @@ MIX_COLS_INV = np.array((
         (0x0d, 0x09, 0x0e, 0x0b),
         (0x0b, 0x0d, 0x09, 0x0e),
         ), dtype=np.uint8)
+
+# ShiftRows as a permutation of a flattened 16-byte state. The state is
+# flattened column-major, i.e. in the same byte order as the input block, so
+# byte 4 * c + r is row r of column c.
+SHIFT_ROWS = np.array((
+    0, 5, 10, 15,
+    4, 9, 14, 3,
+    8, 13, 2, 7,
+    12, 1, 6, 11,
+    ), dtype=np.intp)
+
+SHIFT_ROWS_INV = np.array((
+    0, 13, 10, 7,
+    4, 1, 14, 11,
+    8, 5, 2, 15,
+    12, 9, 6, 3,
+    ), dtype=np.intp)
+
+# Hamming weight of each byte value
+HW = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(
+    axis=1, dtype=np.uint8)
@@ -0,0 +1,180 @@
+"""Correlation power analysis (CPA)
+
+Correlates traces against Hamming weight (HW) or Hamming distance (HD)
+hypotheses for all 256 guesses of each of the 16 key bytes, either on the
+round 1 S-box output (plaintext known) or the last round S-box input
+(ciphertext known).
+
+Correlation sums are updated one chunk of traces at a time with the
+pairwise update of Chan et al., so memory depends only on the number of
+samples per trace.
+"""
+from __future__ import division
+
+import numpy as np
+
+from . import ops
+from .constants import SBOX, SBOX_INV, SHIFT_ROWS, HW
+
+
+MODELS = ('hw', 'hd')
+TARGETS = ('first', 'last')
+
+_GUESSES = np.arange(256, dtype=np.uint8)
+
+
+def hypotheses(texts, model='hw', target='first'):
+    """Leakage hypotheses for all key byte guesses
+
+    Round 1 (target 'first', texts are plaintexts):
+        hw: HW(SBOX[p ^ k])
+        hd: HW(SBOX[p ^ k] ^ (p ^ k))
+
+    Last round (target 'last', texts are ciphertexts):
+        hw: HW(SBOX_INV[c ^ k])
+        hd: HW(SBOX_INV[c ^ k] ^ c'), where c' is the ciphertext byte that
+            overwrites the same state byte
+
+    Args:
+        texts: (N, 16) uint8 array
+
+    Returns:
+        (N, 16, 256) uint8 array of hypotheses
+    """
+    if model not in MODELS:
+        raise ValueError("Invalid model: %r" % (model,))
+    if target not in TARGETS:
+        raise ValueError("Invalid target: %r" % (target,))
+
+    texts = np.asarray(texts, dtype=np.uint8)
+    x = texts[:, :, None] ^ _GUESSES
+
+    if target == 'first':
+        v = SBOX[x]
+        if model == 'hd':
+            v ^= x
+    else:
+        v = SBOX_INV[x]
+        if model == 'hd':
+            v ^= texts[:, SHIFT_ROWS, None]
+
+    return HW[v]
+
+
+class CPA:
+    """Running CPA over chunks of traces
+
+    Attributes:
+        n: Number of traces seen
+    """
+
+    def __init__(self, n_samples, model='hw', target='first'):
+        hypotheses(np.zeros((0, 16), dtype=np.uint8), model, target)
+        self.model = model
+        self.target = target
+        self.n_samples = n_samples
+
+        self.n = 0
+        self._mean_h = np.zeros(16 * 256)
+        self._mean_t = np.zeros(n_samples)
+        self._m2_h = np.zeros(16 * 256)
+        self._m2_t = np.zeros(n_samples)
+        self._c_ht = np.zeros((16 * 256, n_samples))
+
+    def update(self, traces, texts):
+        """Add a chunk of traces
+
+        Args:
+            traces: (N, n_samples) array
+            texts: (N, 16) plaintexts or ciphertexts, matching the target
+        """
+        t = np.asarray(traces, dtype=np.float64)
+        if t.ndim != 2 or t.shape[1] != self.n_samples:
+            raise ValueError("Invalid trace array shape: %s" % (t.shape,))
+        h = hypotheses(texts, self.model, self.target)
+        h = h.reshape(len(h), 16 * 256).astype(np.float64)
+        if len(h) != len(t):
+            raise ValueError("Trace and text counts differ: %d != %d" %
+                             (len(t), len(h)))
+        if not len(t):
+            return
+
+        mean_h = h.mean(axis=0)
+        mean_t = t.mean(axis=0)
+        h -= mean_h
+        t = t - mean_t
+
+        self._merge(len(t), mean_h, mean_t, (h * h).sum(axis=0),
+                    (t * t).sum(axis=0), h.T.dot(t))
+
+    def merge(self, other):
+        """Combine the sums of another CPA, e.g. from a worker process"""
+        if (other.model, other.target, other.n_samples) != (
+                self.model, self.target, self.n_samples):
+            raise ValueError("Incompatible CPA")
+        if other.n:
+            self._merge(other.n, other._mean_h, other._mean_t, other._m2_h,
+                        other._m2_t, other._c_ht)
+
+    def _merge(self, n_b, mean_h, mean_t, m2_h, m2_t, c_ht):
+        n_a = self.n
+        n = n_a + n_b
+        d_h = mean_h - self._mean_h
+        d_t = mean_t - self._mean_t
+        f = n_a * n_b / n
+
+        self._mean_h += d_h * (n_b / n)
+        self._mean_t += d_t * (n_b / n)
+        self._m2_h += m2_h + d_h * d_h * f
+        self._m2_t += m2_t + d_t * d_t * f
+        self._c_ht += c_ht
+        self._c_ht += np.outer(d_h * f, d_t)
+        self.n = n
+
+    def correlation(self):
+        """Pearson correlation of each hypothesis with each sample
+
+        Returns:
+            (16, 256, n_samples) array
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            r = self._c_ht / np.sqrt(np.outer(self._m2_h, self._m2_t))
+        return np.nan_to_num(r).reshape(16, 256, self.n_samples)
+
+    def scores(self):
+        """Peak absolute correlation of each guess, shape (16, 256)"""
+        return np.abs(self.correlation()).max(axis=-1)
+
+    def ranking(self):
+        """Guesses of each key byte, best first, shape (16, 256)"""
+        return np.argsort(-self.scores(), axis=-1, kind='stable').astype(
+            np.uint8)
+
+    def round_key(self):
+        """The best guess of the attacked round key
+
+        For target 'first' this is the first round key, i.e. the first 16
+        bytes of the cipher key. For 'last', it is the last round key.
+        """
+        return self.ranking()[:, 0]
+
+    def master_key(self, Nr=10):
+        """The AES-128 key, derived from the best round key guess"""
+        if Nr != 10:
+            raise ValueError("A single round key only determines AES-128")
+        rk = self.round_key()
+        if self.target == 'first':
+            return rk
+        return ops.derive_key(rk, 4 * Nr)
+
+
+def run(chunks, n_samples, model='hw', target='first'):
+    """Run CPA over an iterable of (traces, texts) chunks
+
+    Returns:
+        The CPA object
+    """
+    cpa = CPA(n_samples, model, target)
+    for traces, texts in chunks:
+        cpa.update(traces, texts)
+    return cpa
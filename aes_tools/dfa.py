@@ -1,8 +1,75 @@
-import click
+"""Differential fault analysis (DFA) of the last AES round
+
+A single-byte fault before the round 9 MixColumns (or a fault in round 8,
+which spreads to one byte of every column) changes one column of the state
+into a multiple of the MixColumns coefficients of the faulty row. After the
+last SubBytes and ShiftRows, that column lands on one of GROUPS in the
+ciphertext. For each group and key byte guess k, the differential table
+gives SBOX_INV[c ^ k] ^ SBOX_INV[c' ^ k], which must equal coef * e for
+some fault value e shared by all four bytes.
+
+Each faulty ciphertext yields a set of candidate 4-byte key tuples per
+column. Every fault votes for the candidates in its set, and the
+candidates with the most votes are kept: with good faults only, that is
+the intersection of their sets, and a bad fault, whose set misses the key,
+is outvoted wherever it falls in the sequence.
+
+AES-192 and AES-256 keys need the penultimate round key as well. With the
+last round key known, every ciphertext is peeled: the last round is undone
+and InvMixColumns applied to the output of the round before. A peeled
+ciphertext is then SubBytes and ShiftRows of the round Nr - 1 input, XORed
+with InvMixColumns of round key Nr - 1, the equivalent key: the same
+attack recovers it, one round earlier. Faults before the MixColumns of
+round Nr - 2 serve both stages, as round 8 faults do for AES-128.
+"""
+import concurrent.futures
+import time
+
 import numpy as np
-import phoenixAES
 
+from . import cipher
+from . import keysearch
 from . import ops
+from .constants import SBOX_INV, GMUL, GINV, MIX_COLS, SHIFT_ROWS_INV
+
+
+# Ciphertext byte positions of each state column before the last ShiftRows
+GROUPS = np.array((
+    (0, 13, 10, 7),
+    (4, 1, 14, 11),
+    (8, 5, 2, 15),
+    (12, 9, 6, 3),
+    ), dtype=np.intp)
+
+# DIFF_INV[d, u] == SBOX_INV[u] ^ SBOX_INV[u ^ d]
+_U = np.arange(256, dtype=np.uint8)
+DIFF_INV = SBOX_INV[_U] ^ SBOX_INV[_U[:, None] ^ _U]
+
+# Fault value from an output difference, per output row (r) and faulty row
+# (i) of a column: E_COEF[r, i] * diff == e
+E_COEF = GINV[MIX_COLS]
+
+# Word offset, per key length in bytes, of the last Nk words of the key
+# schedule: the end of round key Nr - 1 and all of round key Nr
+DERIVE_OFFSETS = {
+    key_len: 4 * (Nr + 1) - key_len // 4
+    for key_len, Nr in cipher.KEY_LEN_TO_ROUNDS.items()
+}
+
+
+# Bytes of hex input read at a time
+HEX_CHUNK_SIZE = 1 << 20
+
+# Value of each hex digit character, -1 for other bytes
+_HEX_VALUES = np.full(256, -1, dtype=np.int8)
+_HEX_VALUES[np.frombuffer(b'0123456789', dtype=np.uint8)] = np.arange(10)
+_HEX_VALUES[np.frombuffer(b'abcdef', dtype=np.uint8)] = np.arange(10, 16)
+_HEX_VALUES[np.frombuffer(b'ABCDEF', dtype=np.uint8)] = np.arange(10, 16)
+
+# ASCII bytes removed by str.strip()
+_SPACE = np.zeros(256, dtype=bool)
+_SPACE[np.frombuffer(b' \t\n\r\x0b\x0c\x1c\x1d\x1e\x1f',
+                     dtype=np.uint8)] = True
 
 
 def _filter(f):
@@ -18,16 +85,630 @@ def _filter(f):
             yield data
 
 
-def stream(f, verbose=False):
-    """DFA a file stream
+def parse_hex(data):
+    """Decode the lines of a buffer that are 16-byte hex strings
+
+    Accepts the same lines as _filter(), but decodes the whole buffer at
+    once. Lines of exactly 32 hex digits are decoded together; a longer
+    line can only be valid if it is 32 hex digits and whitespace, and only
+    those lines are passed to _filter().
+
+    Args:
+        data: bytes-like object or str
+
+    Returns:
+        (N, 16) uint8 array of the valid lines, in order
+    """
+    if isinstance(data, str):
+        data = data.encode('ascii', 'replace')
+    buf = np.frombuffer(data, dtype=np.uint8)
+    if not buf.size:
+        return np.zeros((0, 16), dtype=np.uint8)
+
+    # Line i is buf[starts[i]:ends[i]], without its \n or \r\n
+    ends = np.flatnonzero(buf == ord('\n'))
+    if buf[-1] != ord('\n'):
+        ends = np.append(ends, buf.size)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    ends -= (ends > starts) & (buf[np.maximum(ends - 1, 0)] == ord('\r'))
+    length = ends - starts
+
+    result = np.zeros((len(starts), 16), dtype=np.uint8)
+    valid = np.zeros(len(starts), dtype=bool)
+
+    lines = np.flatnonzero(length == 32)
+    digits = _HEX_VALUES[buf[starts[lines, None] + np.arange(32)]]
+    valid[lines] = (digits >= 0).all(axis=-1)
+    digits = digits.astype(np.uint8)
+    result[lines] = (digits[:, 0::2] << 4) | digits[:, 1::2]
+
+    lines = np.flatnonzero(length > 32)
+    if lines.size:
+        bounds = np.stack((starts[lines], ends[lines]), axis=-1).reshape(-1)
+        counts = [np.add.reduceat(np.append(x, False), bounds,
+                                  dtype=np.intp)[::2]
+                  for x in (_HEX_VALUES[buf] >= 0, _SPACE[buf])]
+        spaced = (counts[0] == 32) & (counts[1] == length[lines] - 32)
+        for i in lines[spaced]:
+            line = buf[starts[i]:ends[i]].tobytes().decode('ascii')
+            for block in _filter((line,)):
+                result[i] = block
+                valid[i] = True
+
+    return result[valid]
+
+
+def iter_hex(f, chunk_size=HEX_CHUNK_SIZE):
+    """Read a text or binary file of hex lines in chunks
+
+    An iterable of str lines is also accepted, and decoded at once.
+
+    Yields:
+        (N, 16) uint8 arrays of the valid lines, as parse_hex()
+    """
+    if not hasattr(f, 'read'):
+        yield parse_hex('\n'.join(f))
+        return
+
+    rest = f.read(0)
+    newline = '\n' if isinstance(rest, str) else b'\n'
+    while True:
+        data = f.read(chunk_size)
+        if not data:
+            break
+        data = rest + data
+        cut = data.rfind(newline) + 1
+        rest = data[cut:]
+        if cut:
+            yield parse_hex(data[:cut])
+    if rest:
+        yield parse_hex(rest)
+
+
+def read_hex(f, chunk_size=HEX_CHUNK_SIZE):
+    """All the valid lines of a file of hex lines, as an (N, 16) array"""
+    return np.concatenate([np.zeros((0, 16), dtype=np.uint8)] +
+                          list(iter_hex(f, chunk_size)))
+
+
+def classify(ref, faulty):
+    """Group faulty ciphertexts by the columns they constrain
+
+    A ciphertext constrains a column if it differs from the reference in
+    exactly that column's four bytes, or in all 16 bytes (a round 8 fault).
+
+    Args:
+        ref: (16,) reference ciphertext
+        faulty: (N, 16) faulty ciphertexts
+
+    Returns:
+        (N, 4) bool array, True where a ciphertext constrains a column
+    """
+    diff = np.asarray(faulty) != np.asarray(ref)
+    in_group = diff[:, GROUPS].all(axis=-1)
+    count = diff.sum(axis=-1)
+    return in_group & ((count == 4) | (count == 16))[:, None]
+
+
+def _join(e):
+    """All (k0, k1, k2, k3) with e[0, k0] == e[1, k1] == e[2, k2] == e[3, k3]
+
+    Args:
+        e: (4, 256) fault value implied by each row and key byte guess
+
+    Returns:
+        (M, 4) array of key byte tuples
+    """
+    order = np.argsort(e, axis=-1, kind='stable')
+    counts = np.stack([np.bincount(row, minlength=256) for row in e])
+    starts = np.cumsum(counts, axis=-1) - counts
+
+    valid = np.flatnonzero(counts.all(axis=0))
+    counts = counts[:, valid]
+    n = counts.prod(axis=0)
+
+    which = np.repeat(np.arange(len(valid)), n)
+    t = np.arange(len(which)) - np.repeat(np.cumsum(n) - n, n)
+
+    result = np.empty((len(which), 4), dtype=np.intp)
+    div = np.ones_like(t)
+    for r in range(4):
+        count = counts[r, which]
+        digit = (t // div) % count
+        div *= count
+        result[:, r] = order[r, starts[r, valid[which]] + digit]
+    return result
+
+
+def column_candidates(ref, faulty, column):
+    """Candidate last round key tuples of one column from one fault
+
+    Returns:
+        Sorted unique uint32 codes, k0 | k1 << 8 | k2 << 16 | k3 << 24,
+        where k0..k3 are the key bytes at GROUPS[column]
+    """
+    group = GROUPS[column]
+    c = np.asarray(ref, dtype=np.uint8)[group]
+    d = c ^ np.asarray(faulty, dtype=np.uint8)[group]
+
+    # diff[r, k] = SBOX_INV[c ^ k] ^ SBOX_INV[c' ^ k]
+    diff = DIFF_INV[d[:, None], c[:, None] ^ _U]
+
+    codes = []
+    for i in range(4):
+        k = _join(GMUL[E_COEF[:, i, None], diff]).astype(np.uint32)
+        codes.append(k[:, 0] | k[:, 1] << 8 | k[:, 2] << 16 | k[:, 3] << 24)
+    return np.unique(np.concatenate(codes))
+
+
+def decode(codes):
+    """uint32 tuple codes to an (M, 4) array of key bytes"""
+    return np.asarray(codes, dtype='<u4').view(np.uint8).reshape(-1, 4)
+
+
+def _vote(votes, new):
+    """Add one fault's candidate codes to the (codes, votes) tally"""
+    if votes is None:
+        return new, np.ones(new.size, dtype=np.intp)
+    codes, count = votes
+    codes, inverse = np.unique(np.concatenate((codes, new)),
+                               return_inverse=True)
+    total = np.zeros(codes.size, dtype=np.intp)
+    total[inverse[:count.size]] = count
+    total[inverse[count.size:]] += 1
+    return codes, total
+
+
+def _leaders(votes):
+    """The codes with the most votes, and that number of votes"""
+    codes, count = votes
+    most = count.max()
+    return codes[count == most], int(most)
+
+
+def solve_column(ref, faulty, column):
+    """Tally the candidates from each fault of one column
+
+    The candidates with the most votes are kept, so a bad fault does not
+    prevent a solution, wherever it is. Stops once a single candidate
+    leads.
+
+    Returns:
+        (codes, used): candidate tuple codes, or None without faults, and
+        the number of faults that agree on them
+    """
+    votes = None
+    codes, used = None, 0
+    for fault in faulty:
+        votes = _vote(votes, column_candidates(ref, fault, column))
+        codes, used = _leaders(votes)
+        if codes.size == 1:
+            break
+    return codes, used
+
+
+def _solve_column(args):
+    return solve_column(*args)
+
+
+class Solution:
+    """Last round key candidates recovered by DFA
+
+    Attributes:
+        columns: Candidate tuple codes for each column, or None if the
+            column had no usable faults
+        used: Number of faults used for each column
+    """
+
+    def __init__(self, columns, used):
+        self.columns = columns
+        self.used = used
+
+    def candidates(self):
+        """Candidate values of each of the 16 last round key bytes
+
+        Returns:
+            List of 16 sorted arrays; all 256 values for unsolved columns
+        """
+        result = [None] * 16
+        for column, codes in enumerate(self.columns):
+            values = decode(codes) if codes is not None else None
+            for r, pos in enumerate(GROUPS[column]):
+                result[pos] = (np.unique(values[:, r]) if values is not None
+                               else np.arange(256, dtype=np.uint8))
+        return result
+
+    def groups(self):
+        """Joint candidates of each column, for keysearch.search()
+
+        Returns:
+            (candidates, positions): an (M, 4) array of key byte tuples per
+            solved column, and one set of all 256 values per byte of
+            unsolved columns, with the key byte positions of each
+        """
+        candidates, positions = [], []
+        for column, codes in enumerate(self.columns):
+            if codes is None:
+                candidates += [np.arange(256, dtype=np.uint8)] * 4
+                positions += [(pos,) for pos in GROUPS[column]]
+            else:
+                candidates.append(decode(codes))
+                positions.append(tuple(GROUPS[column]))
+        return candidates, positions
+
+    def count(self):
+        """Number of full last round key candidates"""
+        return int(np.prod([2 ** 32 if codes is None else codes.size
+                            for codes in self.columns], dtype=object))
+
+    def key(self):
+        """The last round key, or None unless it is unique"""
+        if self.count() != 1:
+            return None
+        key = np.zeros(16, dtype=np.uint8)
+        for column, codes in enumerate(self.columns):
+            key[GROUPS[column]] = decode(codes)[0]
+        return key
+
+    def resolved(self):
+        """Number of last round key bytes with a single candidate"""
+        return sum(c.size == 1 for c in self.candidates())
+
+
+def solve(ref, faulty, workers=1):
+    """Recover last round key candidates from faulty ciphertexts
+
+    Args:
+        ref: (16,) reference ciphertext
+        faulty: (N, 16) faulty ciphertexts
+        workers: Number of worker processes; columns are solved in parallel
+
+    Returns:
+        A Solution object
+    """
+    ref = np.asarray(ref, dtype=np.uint8)
+    faulty = np.asarray(faulty, dtype=np.uint8).reshape(-1, 16)
+    mask = classify(ref, faulty)
+    jobs = [(ref, faulty[mask[:, column]], column) for column in range(4)]
+
+    if workers > 1:
+        with concurrent.futures.ProcessPoolExecutor(min(workers, 4)) as ex:
+            results = list(ex.map(_solve_column, jobs))
+    else:
+        results = [_solve_column(job) for job in jobs]
+
+    return Solution([codes for codes, _ in results],
+                    [used for _, used in results])
+
+
+def peel(ciphertexts, last_key):
+    """Undo the last round, and MixColumns of the round before
+
+    Args:
+        ciphertexts: (..., 16) ciphertexts
+        last_key: (16,) last round key
+
+    Returns:
+        (..., 16) array, which relates to the equivalent key of round
+        Nr - 1 as a ciphertext does to the last round key
+    """
+    state = np.asarray(ciphertexts, dtype=np.uint8) ^ np.asarray(
+        last_key, dtype=np.uint8)
+    state = SBOX_INV[state[..., SHIFT_ROWS_INV]]
+    return ops.mix_columns_inv_batch(state)
+
+
+def solve_penultimate(ref, faulty, last_key, workers=1):
+    """Recover round key Nr - 1 candidates, given the last round key
+
+    Args:
+        ref: (16,) reference ciphertext
+        faulty: (N, 16) faulty ciphertexts
+        last_key: (16,) last round key
+        workers: Number of worker processes
+
+    Returns:
+        A Solution for the equivalent key, InvMixColumns of round key
+        Nr - 1
+    """
+    return solve(peel(ref, last_key), peel(faulty, last_key), workers)
+
+
+def cipher_key(round_keys, key_len=16):
+    """Derive the cipher key from the last round keys
+
+    Args:
+        round_keys: The last round key for AES-128; round keys Nr - 1 and
+            Nr, concatenated, for AES-192 and AES-256
+        key_len: Cipher key length in bytes
+
+    Returns:
+        The cipher key
+    """
+    if key_len not in DERIVE_OFFSETS:
+        raise ValueError("Invalid key length: %d" % (key_len,))
+    round_keys = np.asarray(round_keys, dtype=np.uint8).reshape(-1)
+    if round_keys.size < key_len:
+        raise ValueError("%d round key bytes given, %d needed" %
+                         (round_keys.size, key_len))
+    return ops.derive_key(round_keys[-key_len:], DERIVE_OFFSETS[key_len])
+
+
+class Session:
+    """Incremental DFA, fed one ciphertext at a time
+
+    The first ciphertext is the reference, unless one is given. Candidate
+    votes are tallied as faults arrive, as in solve_column(), until the
+    last round key is unique.
+
+    Attributes:
+        ref: Reference ciphertext
+        seen: Number of faulty ciphertexts added
+        solution: The current Solution
     """
-    # For phoenixAES: 1 = Normal, 2 = Verbose
-    verbose = 1 + int(verbose)
 
-    filtered_input = _filter(f)
-    ref = next(filtered_input)
+    def __init__(self, ref=None):
+        self.ref = None if ref is None else np.asarray(ref, dtype=np.uint8)
+        self.seen = 0
+        self.solution = Solution([None] * 4, [0] * 4)
+        self._votes = [None] * 4
+
+    @property
+    def done(self):
+        return self.solution.count() == 1
+
+    def add(self, ciphertext):
+        """Add a ciphertext
+
+        Returns:
+            True if it narrowed down the candidates
+        """
+        ciphertext = np.asarray(ciphertext, dtype=np.uint8)
+        if self.ref is None:
+            self.ref = ciphertext
+            return False
+
+        self.seen += 1
+        columns = self.solution.columns
+        used = self.solution.used
+        narrowed = False
+        for column in np.flatnonzero(classify(self.ref, ciphertext[None])[0]):
+            if columns[column] is not None and columns[column].size == 1:
+                continue
+            self._votes[column] = _vote(
+                self._votes[column],
+                column_candidates(self.ref, ciphertext, column))
+            new, used[column] = _leaders(self._votes[column])
+            narrowed |= (columns[column] is None or
+                         new.size < columns[column].size)
+            columns[column] = new
+        return narrowed
+
+    def add_line(self, line):
+        """Add a ciphertext from a line of hex; other lines are ignored"""
+        for data in _filter((line,)):
+            return self.add(np.array(data))
+        return False
+
+    def progress(self):
+        return {
+            'ciphertexts': self.seen,
+            'faults': sum(self.solution.used),
+            'resolved_bytes': self.solution.resolved(),
+            'candidates': self.solution.count(),
+        }
+
+    def master_key(self):
+        """The AES-128 key, or None until the last round key is unique"""
+        skey = self.solution.key()
+        return None if skey is None else cipher_key(skey)
+
+    def feed(self, lines, on_progress=None):
+        """Add hex lines until the key is found or the lines run out
+
+        Args:
+            on_progress: Called with the session whenever a line narrows
+                down the candidates
+
+        Returns:
+            The AES-128 key, or None
+        """
+        for line in lines:
+            if self.add_line(line) and on_progress is not None:
+                on_progress(self)
+            if self.done:
+                break
+        return self.master_key()
+
+    async def serve(self, host=None, port=None, path=None, on_progress=None):
+        """Accept hex lines over TCP, or a Unix socket if path is given
 
-    skey = phoenixAES.crack_bytes(filtered_input, ref, verbose=verbose)
-    skey = np.array(bytearray.fromhex(skey))
+        Any number of clients may connect. Returns the AES-128 key as soon
+        as it is determined, closing the server and any open connections.
+        """
+        # Imported here: asyncio is slow to import and only needed to serve
+        import asyncio
+
+        found = asyncio.get_running_loop().create_future()
+        # Open connections: writer to handler task
+        clients = {}
+
+        async def handle(reader, writer):
+            clients[writer] = asyncio.current_task()
+            try:
+                while not found.done():
+                    line = await reader.readline()
+                    if not line:
+                        break
+                    if (self.add_line(line.decode('ascii', 'replace')) and
+                            on_progress is not None):
+                        on_progress(self)
+                    if self.done and not found.done():
+                        found.set_result(self.master_key())
+            except asyncio.CancelledError:
+                # By serve() below, once the key is found; Python 3.11 logs
+                # handlers that end cancelled
+                pass
+            finally:
+                writer.close()
+                clients.pop(writer, None)
+
+        if path is not None:
+            server = await asyncio.start_unix_server(handle, path)
+        else:
+            server = await asyncio.start_server(handle, host, port)
+
+        async with server:
+            try:
+                return await found
+            finally:
+                # The server waits for its connections when closed
+                handlers = list(clients.values())
+                for writer, task in list(clients.items()):
+                    writer.close()
+                    task.cancel()
+                await asyncio.gather(*handlers, return_exceptions=True)
+
+
+def follow(f, interval=0.2):
+    """Yield lines from a growing file, like tail -f
+
+    Partial lines are held back until they are complete. Never returns
+    for a regular file; a pipe or terminal, which cannot grow once it
+    reports end of file, is read until then.
+    """
+    growing = f.seekable()
+    partial = ''
+    while True:
+        line = f.readline()
+        if not line:
+            if not growing:
+                if partial:
+                    yield partial
+                return
+            time.sleep(interval)
+            continue
+        partial += line
+        if partial.endswith('\n'):
+            yield partial
+            partial = ''
+
+
+def _print_solution(solution):
+    for column, codes in enumerate(solution.columns):
+        print("Column {c}: {used} faults, {n} candidates".format(
+            c=column, used=solution.used[column],
+            n='all' if codes is None else codes.size))
+
+
+class Recovery:
+    """Outcome of a key recovery
+
+    Attributes:
+        key: The cipher key, or None if not determined
+        solutions: Solution of each round key attacked, the last round first
+        error: Why the key was not determined, or None
+        search: The keysearch.SearchResult of any residual key search
+    """
+
+    def __init__(self, key=None, solutions=(), error=None, search=None):
+        self.key = key
+        self.solutions = list(solutions)
+        self.error = error
+        self.search = search
+
+    def faults(self):
+        """Faults used for the last round key, counted once per column"""
+        return sum(self.solutions[0].used) if self.solutions else 0
+
+    def candidates(self):
+        """Remaining candidates for the last unsolved round key"""
+        return self.solutions[-1].count() if self.solutions else 0
+
+
+def recover(ref, faulty, workers=1, plaintext=None, key_len=16,
+            verbose=False):
+    """Recover the cipher key from a reference and faulty ciphertexts
+
+    For AES-128, if the last round key is not unique and the plaintext of
+    the reference is known, the remaining candidates are searched. For
+    AES-192 and AES-256 the last round key must be unique, and the
+    penultimate one is then recovered from the same ciphertexts.
+
+    Args:
+        ref: (16,) reference ciphertext
+        faulty: (N, 16) faulty ciphertexts
+        key_len: Cipher key length in bytes: 16, 24 or 32
+
+    Returns:
+        A Recovery
+    """
+    if key_len not in DERIVE_OFFSETS:
+        raise ValueError("Invalid key length: %d" % (key_len,))
+
+    solution = solve(ref, faulty, workers)
+    if verbose:
+        _print_solution(solution)
+
+    skey = solution.key()
+    if skey is not None and key_len == 16:
+        return Recovery(cipher_key(skey), [solution])
+
+    if skey is not None:
+        penultimate = solve_penultimate(ref, faulty, skey, workers)
+        if verbose:
+            print("Round key {r}:".format(
+                r=cipher.KEY_LEN_TO_ROUNDS[key_len] - 1))
+            _print_solution(penultimate)
+        equivalent = penultimate.key()
+        if equivalent is None:
+            return Recovery(None, [solution, penultimate],
+                            "Penultimate round key not determined: %d "
+                            "candidates" % (penultimate.count(),))
+        previous = ops.mix_columns_batch(equivalent)
+        return Recovery(cipher_key(np.concatenate((previous, skey)), key_len),
+                        [solution, penultimate])
+
+    if plaintext is not None and key_len == 16:
+        candidates, positions = solution.groups()
+        result = keysearch.search(candidates, 40, plaintext, ref, workers,
+                                  positions=positions)
+        if verbose:
+            print("Searched {tested} of {total} keys ({rate:.0f} keys/s)"
+                  .format(tested=result.tested, total=result.total,
+                          rate=result.rate))
+        if result.key is not None:
+            return Recovery(result.key, [solution], search=result)
+        return Recovery(None, [solution],
+                        "No key candidate matches the plaintext",
+                        search=result)
+
+    return Recovery(None, [solution],
+                    "Last round key not determined: %d candidates" %
+                    (solution.count(),))
+
+
+def stream(f, verbose=False, workers=1, plaintext=None, key_len=16):
+    """DFA a file stream
+
+    The first 16-byte line is the reference ciphertext; see recover().
+
+    Args:
+        f: Text or binary file of hex lines, or an iterable of lines
+        key_len: Cipher key length in bytes: 16, 24 or 32
+
+    Returns:
+        The cipher key
+
+    Raises:
+        ValueError if a round key is not determined
+    """
+    blocks = read_hex(f)
+    if not len(blocks):
+        raise ValueError("No ciphertexts")
 
-    return ops.derive_key(skey, 40)
+    recovery = recover(blocks[0], blocks[1:], workers, plaintext, key_len,
+                       verbose)
+    if recovery.key is None:
+        raise ValueError(recovery.error)
+    return recovery.key
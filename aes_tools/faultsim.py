@@ -0,0 +1,203 @@
+"""Fault injection simulator
+
+Encrypts batches of plaintexts with one key, XORs a fault into the state at
+a chosen round, stage and byte position, and finishes the encryption. The
+output pairs each reference ciphertext with its faulty one, for testing the
+dfa command without hardware.
+
+Fault models:
+
+    bit     one random bit of the byte is flipped
+    byte    the byte is XORed with a random non-zero value
+    random  the byte is replaced by a random value, which may leave it
+            unchanged
+
+Injection points are (round, stage) boundaries, as for cipher.evaluate():
+the state after a stage of a round, or 'input' for the round input, before
+SubBytes. The classic last round DFA fault is round 9 after 's_row', i.e.
+before MixColumns.
+
+Batches are seeded from a SeedSequence child per batch index, so output is
+reproducible for a given seed regardless of the number of workers.
+"""
+from __future__ import division
+
+import concurrent.futures
+
+import numpy as np
+
+from . import cipher
+from .traceset import TraceSet
+
+
+FAULTS = ('bit', 'byte', 'random')
+POINTS = cipher.BOUNDARIES
+
+DEFAULT_BATCH_SIZE = 1 << 16
+
+
+def fault_values(rng, n, fault='byte'):
+    """Random fault values, to XOR into a byte
+
+    For the 'random' model the values are the new byte values instead.
+    """
+    if fault == 'bit':
+        return (1 << rng.integers(0, 8, n)).astype(np.uint8)
+    if fault == 'byte':
+        return rng.integers(1, 256, n, dtype=np.uint8)
+    if fault == 'random':
+        return rng.integers(0, 256, n, dtype=np.uint8)
+    raise ValueError("Invalid fault model: %r" % (fault,))
+
+
+def random_plaintext(seed=None):
+    """A random (16,) plaintext, reproducible for a given seed
+
+    Drawn from the seed's root sequence, independent of the batches of
+    simulate(), which use its children.
+    """
+    rng = np.random.default_rng(seed)
+    return rng.integers(0, 256, 16, dtype=np.uint8)
+
+
+def inject(plaintexts, key, fault_round=9, stage='s_row', fault='byte',
+           position=None, rng=None):
+    """Encrypt plaintexts with and without a fault
+
+    Args:
+        plaintexts: (N, 16) plaintexts
+        key: Cipher key
+        fault_round: Round of the fault
+        stage: Stage after which the fault is injected, from POINTS
+        fault: Fault model, from FAULTS
+        position: State byte index (column-major, as the block), or None
+            for a random position per block
+        rng: np.random.Generator
+
+    Returns:
+        (reference, faulty) ciphertexts, each (N, 16)
+    """
+    plaintexts = cipher.check_blocks(plaintexts)
+    aes = cipher.key_cache.get(np.asarray(key, dtype=np.uint8))
+    rng = np.random.default_rng() if rng is None else rng
+    n = len(plaintexts)
+
+    point = (fault_round, stage)
+    state = cipher.evaluate(plaintexts, aes.rk, (0, 'input'), point)
+
+    if position is None:
+        position = rng.integers(0, 16, n)
+    elif not 0 <= position < 16:
+        raise ValueError("Invalid position: %d" % (position,))
+    values = fault_values(rng, n, fault)
+
+    # Finish the reference and faulty states together
+    state = np.concatenate((state, state))
+    rows = np.arange(n, 2 * n)
+    if fault == 'random':
+        state[rows, position] = values
+    else:
+        state[rows, position] ^= values
+
+    state = cipher.evaluate(state, aes.rk, point, (aes.rounds, 'add_k'))
+
+    return state[:n], state[n:]
+
+
+def _batch(job):
+    """Simulate one seeded batch; runs in a worker process"""
+    seed, plaintext, key, size, params = job
+    rng = np.random.default_rng(seed)
+    if plaintext is None:
+        plaintexts = rng.integers(0, 256, (size, 16), dtype=np.uint8)
+    else:
+        plaintexts = np.tile(plaintext, (size, 1))
+    return (plaintexts,) + inject(plaintexts, key, rng=rng, **params)
+
+
+def simulate(n, key, plaintext=None, fault_round=9, stage='s_row',
+             fault='byte', position=None, seed=None, workers=1,
+             batch_size=DEFAULT_BATCH_SIZE):
+    """Generate faulty encryptions in batches
+
+    Args:
+        n: Number of faulty ciphertexts
+        key: Cipher key
+        plaintext: Plaintext for every block, or None for random plaintexts
+        seed: Seed, or None for fresh entropy
+        workers: Number of worker processes
+        batch_size: Blocks per batch
+        Others: As for inject()
+
+    Yields:
+        (plaintexts, reference, faulty) batches, in order
+    """
+    key = np.asarray(key, dtype=np.uint8)
+    if plaintext is not None:
+        plaintext = np.asarray(plaintext, dtype=np.uint8).reshape(16)
+    params = {'fault_round': fault_round, 'stage': stage, 'fault': fault,
+              'position': position}
+
+    sizes = [min(batch_size, n - start) for start in range(0, n, batch_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    jobs = [(s, plaintext, key, size, params)
+            for s, size in zip(seeds, sizes)]
+
+    if workers > 1:
+        with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+            for result in executor.map(_batch, jobs):
+                yield result
+    else:
+        for job in jobs:
+            yield _batch(job)
+
+
+_HEX_DIGITS = np.frombuffer(b'0123456789abcdef', dtype=np.uint8)
+
+
+def hex_lines(blocks):
+    """(N, 16) blocks as an (N, 33) array of hex line characters"""
+    blocks = np.asarray(blocks, dtype=np.uint8)
+    lines = np.empty((len(blocks), 33), dtype=np.uint8)
+    lines[:, 0:32:2] = _HEX_DIGITS[blocks >> 4]
+    lines[:, 1:32:2] = _HEX_DIGITS[blocks & 0xf]
+    lines[:, 32] = ord('\n')
+    return lines
+
+
+def write_hex(f, reference, faulty, last=None):
+    """Write ciphertexts as hex lines, in the format read by the dfa command
+
+    Each faulty ciphertext follows its reference; a reference is only
+    written when it differs from the previous one, so a fixed plaintext
+    gives one reference line followed by all the faulty ones.
+
+    Args:
+        f: Text file
+        last: The previous batch's last reference, if any
+
+    Returns:
+        The last reference, to pass as last for the next batch
+    """
+    reference = np.asarray(reference, dtype=np.uint8)
+    if not len(reference):
+        return last
+
+    previous = np.empty_like(reference)
+    previous[1:] = reference[:-1]
+    new = (reference != previous).any(axis=-1)
+    new[0] = last is None or (reference[0] != last).any()
+
+    lines = np.stack((hex_lines(reference), hex_lines(faulty)), axis=1)
+    keep = np.stack((new, np.ones_like(new)), axis=1)
+    f.write(lines[keep].tobytes().decode('ascii'))
+    return reference[-1]
+
+
+def create_traceset(path):
+    """A trace set for simulated faults
+
+    Records hold the plaintext, the reference ciphertext, and the faulty
+    ciphertext as 16 uint8 samples.
+    """
+    return TraceSet.create(path, n_samples=16, dtype='u1')
@@ -0,0 +1,414 @@
+"""AES-GCM authenticated encryption (NIST SP 800-38D)
+
+The keystream is CTR mode from J0 + 1, with a 32-bit counter, generated in
+batches of blocks by the table engine. The tag is GHASH over the padded
+AAD, the padded ciphertext and their bit lengths, encrypted with J0.
+
+GHASH multiplies by H with 8-bit Shoup tables: for each of the 16 bytes
+of a block and each of its 256 values, the product with H as a table
+entry, so a product is the XOR of 16 lookups. Tables are kept for the
+powers H^0 to H^STRIDE, which lets runs of STRIDE blocks be hashed at once,
+
+    (((y ^ x1) * H ^ x2) * H ... ^ xk) * H
+        == y * H^k ^ (x1 * H^k ^ x2 * H^(k-1) ^ ... ^ xk * H)
+
+The runs' sums are then hashed the same way with H^k in place of H, in
+runs of STRIDE, leaving one sequential step per STRIDE^2 blocks. The
+tables, about 1 MB for each of the two levels, are built once per expanded
+key and cached alongside it.
+
+Field elements are kept as their 16 block bytes, viewed as two native
+uint64 words for XOR. Table entries are gathered as single 16-byte items
+(complex128, never used as numbers), which NumPy indexes several times
+faster than rows of words.
+"""
+from __future__ import division
+
+import hmac
+import threading
+import weakref
+
+import numpy as np
+
+from . import cipher
+from . import modes
+
+
+BLOCK_SIZE = 16
+
+# Blocks hashed together per table lookup pass
+STRIDE = 16
+
+# Blocks per keystream and GHASH batch
+DEFAULT_BATCH_SIZE = 1 << 12
+
+TAG_LENGTHS = (4, 8, 12, 13, 14, 15, 16)
+
+# x^0 is the most significant bit of the first byte; reduction modulo
+# x^128 + x^7 + x^2 + x + 1 folds x^128 back in as 0xe1 << 120
+_R = np.uint64(0xe1 << 56)
+
+# The field element 1
+_ONE = np.array([0x80] + [0] * 15, dtype=np.uint8)
+
+
+def _words(blocks):
+    """(..., 16) bytes as (..., 2) native uint64 words, for XOR"""
+    return np.ascontiguousarray(blocks, dtype=np.uint8).view(np.uint64)
+
+
+def _tables(powers):
+    """Shoup tables of (k, 16) byte field elements
+
+    Returns:
+        (k * 16 * 256,) 16-byte entries: entry (j * 16 + p) * 256 + v is
+        the product of powers[j] and the block whose byte p is v, others
+        zero
+    """
+    hi, lo = (np.ascontiguousarray(powers, dtype=np.uint8)
+              .view('>u8').astype(np.uint64).T)
+
+    # basis[b] = powers * x^b
+    basis = np.empty((128, len(hi), 2), dtype=np.uint64)
+    for b in range(128):
+        basis[b, :, 0], basis[b, :, 1] = hi, lo
+        carry = lo & np.uint64(1)
+        lo = (lo >> np.uint64(1)) | (hi << np.uint64(63))
+        hi = (hi >> np.uint64(1)) ^ (_R * carry)
+
+    # Byte p holds x^(8p) in its most significant bit
+    bits = ((np.arange(256)[:, None] >> (7 - np.arange(8))) & 1).astype(bool)
+    basis = basis.reshape(16, 8, len(hi), 2)
+    tables = np.zeros((len(hi), 16, 256, 2), dtype=np.uint64)
+    for t in range(8):
+        tables[:, :, bits[:, t]] ^= basis[:, t].swapaxes(0, 1)[:, :, None]
+
+    entries = _words(tables.astype('>u8').view(np.uint8))
+    return entries.view(np.complex128).reshape(-1)
+
+
+def _offsets(powers):
+    """Table offsets of the 16 bytes of blocks multiplied by the powers"""
+    powers = np.asarray(powers, dtype=np.intp)[:, None]
+    return (powers * 16 + np.arange(16)) * 256
+
+
+def _lookup(tables, index):
+    """XOR of the table entries along the last axes of index, as words"""
+    entries = tables[index.reshape(len(index), -1)]
+    x = entries.view(np.uint64).reshape(entries.shape + (2,))
+    # Pairwise halving is much faster than reduce along a strided axis
+    while x.shape[1] > 1 and x.shape[1] % 2 == 0:
+        half = x.shape[1] // 2
+        x = x[:, :half] ^ x[:, half:]
+    return np.bitwise_xor.reduce(x, axis=1)
+
+
+class GHashKey:
+    """Shoup tables for the powers of a hash key H
+
+    Attributes:
+        h: The hash key, as (16,) bytes
+    """
+
+    def __init__(self, h, levels=2):
+        self.h = np.asarray(h, dtype=np.uint8).reshape(BLOCK_SIZE)
+        powers = np.empty((STRIDE + 1, BLOCK_SIZE), dtype=np.uint8)
+        powers[0] = _ONE
+        powers[1] = self.h
+        first = _tables(powers[1:2])
+        for j in range(2, STRIDE + 1):
+            powers[j] = _lookup(first, powers[j - 1:j] + _offsets([0])
+                                ).view(np.uint8)
+        self.tables = _tables(powers)
+
+        # Runs of STRIDE blocks times H^STRIDE ... H^1 (shift 1), or
+        # H^(STRIDE - 1) ... H^0 (shift 0)
+        self._run_offsets = [_offsets(np.arange(STRIDE, 0, -1) - 1 + shift)
+                             for shift in (0, 1)]
+        self._levels = levels
+        self._power = powers[STRIDE]
+        self._outer = None
+
+    def multiply(self, blocks, power=1):
+        """Products of (N, 16) byte blocks with H^power, 0 <= power <= STRIDE
+
+        Returns:
+            (N, 16) uint8 array
+        """
+        blocks = np.asarray(blocks, dtype=np.uint8).reshape(-1, BLOCK_SIZE)
+        index = blocks + _offsets([power])
+        return _lookup(self.tables, index[:, None]).view(np.uint8)
+
+    def _horner(self, y, x, shift):
+        """y_i = y_(i-1) * H ^ x_i * H^shift over the (N, 16) blocks x"""
+        n = len(x)
+        full = n - n % STRIDE
+        if full:
+            index = x[:full].reshape(-1, STRIDE, BLOCK_SIZE) + (
+                self._run_offsets[shift])
+            sums = _lookup(self.tables, index).view(np.uint8)
+            if self._levels > 1:
+                if self._outer is None:
+                    self._outer = GHashKey(self._power, self._levels - 1)
+                y = self._outer._horner(y, sums, 0)
+            else:
+                for s in sums:
+                    y = self.multiply(y, STRIDE)[0] ^ s
+        if n > full:
+            m = n - full
+            index = x[full:] + _offsets(np.arange(m, 0, -1) - 1 + shift)
+            y = (self.multiply(y, m)[0] ^
+                 _lookup(self.tables, index[None]).view(np.uint8)[0])
+        return y
+
+    def update(self, y, blocks):
+        """Hash whole blocks into the state y
+
+        Args:
+            y: (16,) uint8 GHASH state
+            blocks: (N, 16) uint8 array
+
+        Returns:
+            The new (16,) state
+        """
+        y = np.asarray(y, dtype=np.uint8).reshape(BLOCK_SIZE)
+        blocks = np.asarray(blocks, dtype=np.uint8).reshape(-1, BLOCK_SIZE)
+        return self._horner(y, blocks, 1)
+
+
+# Hash keys of the AES objects they were derived from, kept as long as the
+# expanded key is
+_hash_keys = weakref.WeakKeyDictionary()
+_hash_keys_lock = threading.Lock()
+
+
+def hash_key(aes):
+    """The cached GHashKey of an AES object, H = E(K, 0^128)"""
+    with _hash_keys_lock:
+        key = _hash_keys.get(aes, None)
+    if key is None:
+        h = aes.encrypt_batch(np.zeros((1, BLOCK_SIZE), dtype=np.uint8),
+                              modes.DEFAULT_ENGINE)[0]
+        key = GHashKey(h)
+        with _hash_keys_lock:
+            _hash_keys[aes] = key
+    return key
+
+
+def _as_cipher(key):
+    if isinstance(key, cipher.AES):
+        return key
+    return cipher.key_cache.get(modes._as_array(key))
+
+
+def _length_block(aad_len, data_len):
+    return np.array((aad_len * 8, data_len * 8), dtype='>u8').view(np.uint8)
+
+
+def _padded(data):
+    """Bytes as (N, 16) blocks, zero padded"""
+    blocks = np.zeros(-(-data.size // BLOCK_SIZE) * BLOCK_SIZE, dtype=np.uint8)
+    blocks[:data.size] = data
+    return blocks.reshape(-1, BLOCK_SIZE)
+
+
+def initial_counter(aes, iv):
+    """The pre-counter block J0 for an IV of any non-zero length"""
+    iv = modes._as_array(iv)
+    if not iv.size:
+        raise ValueError("Invalid IV length: 0")
+    if iv.size == 12:
+        return np.concatenate((iv, np.array((0, 0, 0, 1), dtype=np.uint8)))
+    y = hash_key(aes).update(np.zeros(BLOCK_SIZE, dtype=np.uint8),
+                             _padded(iv))
+    return hash_key(aes).update(y, _length_block(0, iv.size)[None])
+
+
+def counters(j0, start, count):
+    """Counter blocks J0 + start ... J0 + start + count - 1
+
+    Only the last 32 bits are incremented, modulo 2^32.
+    """
+    blocks = np.tile(np.asarray(j0, dtype=np.uint8), (count, 1))
+    low = blocks[:, 12:].copy().view('>u4')[:, 0]
+    with np.errstate(over='ignore'):
+        low = low + np.arange(start, start + count, dtype=np.uint64).astype(
+            np.uint32)
+    blocks[:, 12:] = low.astype('>u4').view(np.uint8).reshape(-1, 4)
+    return blocks
+
+
+class GCM:
+    """Incremental AES-GCM encryption or decryption
+
+    AAD is added with authenticate(), before any data. Data of any length
+    is passed to update() in pieces; finalize() returns the tag, or checks
+    it when decrypting.
+
+    Attributes:
+        decrypt: True when decrypting
+    """
+
+    def __init__(self, key, iv, decrypt=False,
+                 batch_size=DEFAULT_BATCH_SIZE):
+        self._aes = _as_cipher(key)
+        self._hash_key = hash_key(self._aes)
+        self._j0 = initial_counter(self._aes, iv)
+        self.decrypt = decrypt
+        self._batch_size = batch_size
+
+        self._y = np.zeros(BLOCK_SIZE, dtype=np.uint8)
+        self._aad_len = 0
+        self._data_len = 0
+        # Bytes awaiting a whole block: AAD, then ciphertext
+        self._pending = np.zeros(0, dtype=np.uint8)
+        self._keystream = np.zeros(0, dtype=np.uint8)
+        # E(K, J0), generated with the first keystream batch
+        self._mask = None
+        self._finalized = False
+
+    def _check_open(self):
+        if self._finalized:
+            raise ValueError("GCM context already finalized")
+
+    def _hash(self, data):
+        data = np.concatenate((self._pending, data))
+        full = data.size - data.size % BLOCK_SIZE
+        for start in range(0, full, self._batch_size * BLOCK_SIZE):
+            stop = min(start + self._batch_size * BLOCK_SIZE, full)
+            self._y = self._hash_key.update(
+                self._y, data[start:stop].reshape(-1, BLOCK_SIZE))
+        self._pending = data[full:]
+
+    def _flush(self):
+        """Hash any partial block, zero padded"""
+        if self._pending.size:
+            self._y = self._hash_key.update(self._y, _padded(self._pending))
+            self._pending = self._pending[:0]
+
+    def authenticate(self, aad):
+        """Add additional authenticated data, before any update()"""
+        self._check_open()
+        if self._data_len:
+            raise ValueError("AAD must come before the data")
+        aad = modes._as_array(aad)
+        self._aad_len += aad.size
+        self._hash(aad)
+
+    def _keystream_bytes(self, n):
+        """The next n keystream bytes"""
+        result = [self._keystream[:n]]
+        self._keystream = self._keystream[n:]
+        n -= result[0].size
+        if n:
+            # The first counter block past J0 + 1 not yet generated, or J0
+            # itself the first time, saving a call for the tag
+            first = int(self._mask is None)
+            start = 1 + (self._data_len + result[0].size) // BLOCK_SIZE
+            start -= first
+            count = -(-n // BLOCK_SIZE) + first
+            blocks = []
+            for i in range(0, count, self._batch_size):
+                ctrs = counters(self._j0, start + i,
+                                min(self._batch_size, count - i))
+                blocks.append(self._aes.encrypt_batch(
+                    ctrs, modes.DEFAULT_ENGINE).reshape(-1))
+            stream = np.concatenate(blocks)
+            if first:
+                self._mask, stream = stream[:BLOCK_SIZE], stream[BLOCK_SIZE:]
+            result.append(stream[:n])
+            self._keystream = stream[n:]
+        return np.concatenate(result)
+
+    def update(self, data):
+        """Encrypt or decrypt a piece of data
+
+        Returns:
+            uint8 array of the same length
+        """
+        self._check_open()
+        data = modes._as_array(data)
+        if not self._data_len:
+            self._flush()
+        if self._data_len + data.size > ((1 << 32) - 2) * BLOCK_SIZE:
+            raise ValueError("Data too long for GCM")
+
+        out = data ^ self._keystream_bytes(data.size)
+        self._hash(data if self.decrypt else out)
+        self._data_len += data.size
+        return out
+
+    def _tag(self):
+        self._check_open()
+        self._finalized = True
+        self._flush()
+        y = self._hash_key.update(
+            self._y, _length_block(self._aad_len, self._data_len)[None])
+        if self._mask is None:
+            self._mask = self._aes.encrypt_batch(self._j0[None],
+                                                 modes.DEFAULT_ENGINE)[0]
+        return self._mask ^ y
+
+    def finalize(self, tag=None, tag_len=BLOCK_SIZE):
+        """Complete the operation
+
+        Args:
+            tag: When decrypting, the tag to check (of any length in
+                TAG_LENGTHS)
+            tag_len: When encrypting, the tag length in bytes
+
+        Returns:
+            The tag when encrypting, as bytes
+
+        Raises:
+            ValueError when decrypting, if the tag does not match
+        """
+        if self.decrypt:
+            if tag is None:
+                raise ValueError("A tag is required to decrypt")
+            tag = bytes(modes._as_array(tag))
+            if len(tag) not in TAG_LENGTHS:
+                raise ValueError("Invalid tag length: %d" % (len(tag),))
+            expected = self._tag()[:len(tag)].tobytes()
+            if not hmac.compare_digest(expected, tag):
+                raise ValueError("Authentication failed")
+            return None
+
+        if tag_len not in TAG_LENGTHS:
+            raise ValueError("Invalid tag length: %d" % (tag_len,))
+        return self._tag()[:tag_len].tobytes()
+
+
+def encrypt(data, key, iv, aad=b'', tag_len=BLOCK_SIZE):
+    """GCM encrypt data of any length
+
+    Args:
+        data: bytes-like object or uint8 array
+        key: Key bytes, or an AES object
+        iv: IV of any non-zero length; 12 bytes is recommended
+        aad: Additional authenticated data
+
+    Returns:
+        (ciphertext as a uint8 array, tag as bytes)
+    """
+    ctx = GCM(key, iv)
+    ctx.authenticate(aad)
+    out = ctx.update(data)
+    return out, ctx.finalize(tag_len=tag_len)
+
+
+def decrypt(data, key, iv, tag, aad=b''):
+    """GCM decrypt data and check its tag
+
+    Returns:
+        The plaintext as a uint8 array
+
+    Raises:
+        ValueError if the tag does not match
+    """
+    ctx = GCM(key, iv, decrypt=True)
+    ctx.authenticate(aad)
+    out = ctx.update(data)
+    ctx.finalize(tag)
+    return out
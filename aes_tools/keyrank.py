@@ -0,0 +1,212 @@
+"""Key rank estimation and key enumeration
+
+Side channel attacks such as CPA score each of the 256 guesses of each key
+byte. Treating the bytes as independent, the likelihood of a full key is
+the product of its byte likelihoods, so its cost, -log2(likelihood), is
+the sum of the byte costs.
+
+rank() estimates how many keys are at least as likely as a given key by
+histogram convolution (Glowacz et al., 2015): each byte's costs are binned
+into a histogram on a common bin width, the histograms are convolved into
+the distribution of full key costs, and the keys binned below the key's
+own bin are counted. Binning moves each byte cost by less than one bin, so
+the count is bracketed by bounds that are exact.
+
+enumerate_keys() yields full keys in decreasing likelihood, merging the
+byte guesses pairwise with a heap in a balanced tree.
+"""
+from __future__ import division
+
+import heapq
+import itertools
+import math
+
+import numpy as np
+
+
+KINDS = ('prob', 'log')
+
+DEFAULT_BINS = 512
+
+# Floor for zero probabilities, so every guess has a finite cost
+_MIN_PROB = 2.0 ** -64
+
+
+def log_likelihoods(scores, kind='prob'):
+    """Normalized log2-likelihoods of each guess of each key byte
+
+    Args:
+        scores: (n_bytes, 256) table
+        kind: 'prob' for non-negative scores proportional to likelihood
+            (probabilities, or e.g. absolute correlations), 'log' for
+            natural log-likelihoods
+
+    Returns:
+        (n_bytes, 256) float64 array; each row's likelihoods sum to 1
+    """
+    scores = np.asarray(scores, dtype=np.float64)
+    if scores.ndim != 2 or scores.shape[1] != 256:
+        raise ValueError("Invalid score table shape: %s" % (scores.shape,))
+
+    if kind == 'prob':
+        if (scores < 0).any():
+            raise ValueError("Probabilities must be non-negative")
+        total = scores.sum(axis=-1, keepdims=True)
+        p = np.where(total > 0, scores / np.where(total > 0, total, 1),
+                     1 / 256)
+        return np.log2(np.maximum(p, _MIN_PROB))
+    if kind == 'log':
+        log2 = scores / math.log(2)
+        log2 -= log2.max(axis=-1, keepdims=True)
+        return log2 - np.log2(np.exp2(log2).sum(axis=-1, keepdims=True))
+    raise ValueError("Invalid score kind: %r" % (kind,))
+
+
+class Rank:
+    """Estimated rank of a key, counting from 1 for the most likely key
+
+    Attributes:
+        lower: Lower bound
+        estimate: Estimated rank
+        upper: Upper bound
+    """
+
+    def __init__(self, lower, estimate, upper):
+        self.lower = lower
+        self.estimate = estimate
+        self.upper = upper
+
+    def log2(self):
+        """(lower, estimate, upper) in bits"""
+        return tuple(math.log2(x) for x in
+                     (self.lower, self.estimate, self.upper))
+
+    def __repr__(self):
+        return "Rank(2^%.2f <= 2^%.2f <= 2^%.2f)" % self.log2()
+
+
+def _convolve(hists):
+    """Convolve a list of histograms, pairwise in a balanced tree"""
+    while len(hists) > 1:
+        merged = [np.convolve(a, b) for a, b in zip(hists[::2], hists[1::2])]
+        if len(hists) % 2:
+            merged.append(hists[-1])
+        hists = merged
+    return hists[0]
+
+
+def rank(scores, key, kind='prob', bins=DEFAULT_BINS):
+    """Estimate the rank of a key from per-byte score tables
+
+    Args:
+        scores: (n_bytes, 256) score table, as for log_likelihoods()
+        key: (n_bytes,) key bytes whose rank to estimate
+        kind: Score kind, from KINDS
+        bins: Histogram bins per byte; more bins give tighter bounds
+
+    Returns:
+        A Rank
+    """
+    cost = -log_likelihoods(scores, kind)
+    key = np.asarray(key, dtype=np.intp)
+    n_bytes = len(cost)
+    if key.shape != (n_bytes,):
+        raise ValueError("Key does not match the score table: %s" %
+                         (key.shape,))
+
+    # Common bin width; bin b holds costs in [low + b * w, low + (b + 1) * w)
+    low = cost.min(axis=-1, keepdims=True)
+    width = max((cost - low).max(), 1e-12) * (1 + 1e-9) / bins
+    index = ((cost - low) / width).astype(np.intp)
+
+    hists = [np.bincount(row, minlength=bins).astype(np.float64)
+             for row in index]
+    counts = np.cumsum(_convolve(hists))
+
+    # Keys binned at least n_bytes below the key's bin sum are certainly
+    # more likely, and keys binned at least n_bytes above certainly less
+    b = int(index[np.arange(n_bytes), key].sum())
+
+    def at(j):
+        """Number of keys binned at or below j"""
+        return counts[min(j, len(counts) - 1)] if j >= 0 else 0.0
+
+    lower = at(b - n_bytes) + 1
+    upper = at(b + n_bytes - 1)
+    estimate = (at(b - 1) + at(b)) / 2 + 0.5
+    return Rank(lower, min(max(estimate, lower), upper), upper)
+
+
+class _Sorted:
+    """A lazily generated, memoized list of (cost, bytes) in cost order"""
+
+    def __init__(self, generator):
+        self._generator = generator
+        self._items = []
+
+    def get(self, i):
+        """Item i, or None past the end"""
+        while len(self._items) <= i:
+            item = next(self._generator, None)
+            if item is None:
+                return None
+            self._items.append(item)
+        return self._items[i]
+
+
+def _leaf(costs):
+    order = np.argsort(costs, kind='stable')
+    return ((float(costs[v]), (int(v),)) for v in order)
+
+
+def _merge(a, b):
+    """Sums of the items of two sorted lists, in cost order"""
+    first_a, first_b = a.get(0), b.get(0)
+    if first_a is None or first_b is None:
+        return
+    heap = [(first_a[0] + first_b[0], 0, 0)]
+    while heap:
+        cost, i, j = heapq.heappop(heap)
+        x, y = a.get(i), b.get(j)
+        yield cost, x[1] + y[1]
+
+        # Each (i, j) is pushed once: from (i - 1, 0) down the first
+        # column, and from (i, j - 1) along the rows
+        if j == 0:
+            nx = a.get(i + 1)
+            if nx is not None:
+                heapq.heappush(heap, (nx[0] + y[0], i + 1, 0))
+        ny = b.get(j + 1)
+        if ny is not None:
+            heapq.heappush(heap, (x[0] + ny[0], i, j + 1))
+
+
+def enumerate_keys(scores, kind='prob', limit=None):
+    """Yield keys in decreasing likelihood
+
+    Args:
+        scores: (n_bytes, 256) score table, as for log_likelihoods()
+        kind: Score kind, from KINDS
+        limit: Maximum number of keys
+
+    Yields:
+        (cost, key) pairs: cost in bits (-log2 likelihood) and the key as
+        an (n_bytes,) uint8 array, e.g. a round key for ops.derive_key()
+    """
+    cost = -log_likelihoods(scores, kind)
+    if len(cost) == 1:
+        root = _leaf(cost[0])
+    else:
+        # The inner nodes are read repeatedly, so memoized; the root is
+        # read once, and not kept
+        nodes = [_Sorted(_leaf(row)) for row in cost]
+        while len(nodes) > 2:
+            merged = [_Sorted(_merge(a, b))
+                      for a, b in zip(nodes[::2], nodes[1::2])]
+            if len(nodes) % 2:
+                merged.append(nodes[-1])
+            nodes = merged
+        root = _merge(*nodes)
+
+    for c, key in itertools.islice(root, limit):
+        yield c, np.array(key, dtype=np.uint8)
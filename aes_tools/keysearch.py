@@ -0,0 +1,212 @@
+"""Residual key search
+
+Enumerates the Cartesian product of per-byte candidate sets for a round
+key, inverts the key schedule and test-encrypts known plaintexts with every
+candidate, in batches. The product is never materialized: each batch decodes
+a range of product indices, so memory is bounded by the batch size.
+
+Bytes whose candidates are joint, such as the 4-byte column tuples left by
+DFA, can be given as groups: an (M, k) array of tuples per group, and the
+k key byte positions each covers. The product is then over the tuples.
+"""
+from __future__ import division
+
+import concurrent.futures
+import time
+
+import numpy as np
+
+from . import cipher
+from . import ops
+from . import ttable
+
+
+DEFAULT_BATCH_SIZE = 1 << 16
+
+
+class SearchResult:
+    """Outcome of a key search
+
+    Attributes:
+        key: The cipher key, or None if no candidate matched
+        tested: Number of candidates tested
+        total: Size of the search space
+        seconds: Wall time of the search
+    """
+
+    def __init__(self, key, tested, total, seconds):
+        self.key = key
+        self.tested = tested
+        self.total = total
+        self.seconds = seconds
+
+    @property
+    def rate(self):
+        """Keys tested per second"""
+        return self.tested / self.seconds if self.seconds else 0.0
+
+
+def _check_candidates(candidates, positions=None):
+    """Candidates as (M, k) tuple arrays, and the positions of each"""
+    if positions is None:
+        positions = [(i,) for i in range(len(candidates))]
+    positions = [tuple(int(p) for p in pos) for pos in positions]
+    if len(positions) != len(candidates):
+        raise ValueError("Expected positions for %d candidate groups" %
+                         (len(candidates),))
+    candidates = [np.unique(np.asarray(c, dtype=np.uint8).reshape(
+        -1, len(pos)), axis=0) for c, pos in zip(candidates, positions)]
+
+    key_len = sum(len(pos) for pos in positions)
+    if key_len not in cipher.KEY_LEN_TO_ROUNDS:
+        raise ValueError("Invalid key length: %d" % (key_len,))
+    if sorted(sum(positions, ())) != list(range(key_len)):
+        raise ValueError("Positions must cover each key byte once")
+    return candidates, positions
+
+
+def space_size(candidates):
+    """Number of keys in the Cartesian product of the candidate sets"""
+    return int(np.prod([len(c) for c in candidates], dtype=object))
+
+
+def subkeys(candidates, start, stop, positions=None):
+    """Decode product indices [start, stop) into an array of subkeys
+
+    The last set varies fastest.
+
+    Args:
+        candidates: Candidate values of each subkey byte, or (M, k) tuple
+            arrays with positions
+        positions: Subkey byte positions of each candidate tuple array
+    """
+    if positions is None:
+        positions = [(i,) for i in range(len(candidates))]
+    key_len = sum(len(pos) for pos in positions)
+    index = np.arange(start, stop, dtype=np.uint64)
+    result = np.empty((stop - start, key_len), dtype=np.uint8)
+    for i in reversed(range(len(candidates))):
+        values = np.asarray(candidates[i]).reshape(-1, len(positions[i]))
+        n = np.uint64(len(values))
+        result[:, positions[i]] = values[index % n]
+        index //= n
+    return result
+
+
+def _pairs(plaintexts, ciphertexts):
+    plaintexts = np.asarray(plaintexts, dtype=np.uint8).reshape(-1, 16)
+    ciphertexts = np.asarray(ciphertexts, dtype=np.uint8).reshape(-1, 16)
+    if not len(plaintexts) or len(plaintexts) != len(ciphertexts):
+        raise ValueError("Need matching plaintext/ciphertext pairs")
+    return plaintexts, ciphertexts
+
+
+def check_range(candidates, offset, plaintexts, ciphertexts, start, stop,
+                positions=None):
+    """Test the candidates with product indices [start, stop)
+
+    All candidates are checked against the first pair, and any matches
+    against the rest.
+
+    Returns:
+        The matching cipher key, or None
+    """
+    sub = subkeys(candidates, start, stop, positions)
+    key_len = sub.shape[1]
+    Nr = cipher.KEY_LEN_TO_ROUNDS[key_len]
+    w = ops.derive_key_batch(sub, offset, Nr=Nr)
+    keys = w[:, :key_len // 4].reshape(len(w), -1)
+    rk = w.reshape(len(w), Nr + 1, 16)
+
+    out = ttable.encrypt_blocks(plaintexts[:1], rk, Nr)
+    for i in np.flatnonzero((out == ciphertexts[0]).all(axis=-1)):
+        out = ttable.encrypt_blocks(plaintexts, rk[i], Nr)
+        if (out == ciphertexts).all():
+            return keys[i]
+    return None
+
+
+def _check_range(args):
+    return check_range(*args)
+
+
+def _collect(pending):
+    """Wait for at least one batch; returns (key or None, keys tested)"""
+    done, _ = concurrent.futures.wait(
+        pending, return_when=concurrent.futures.FIRST_COMPLETED)
+    key = None
+    tested = 0
+    for future in done:
+        tested += pending.pop(future)
+        result = future.result()
+        if result is not None:
+            key = result
+    return key, tested
+
+
+def search(candidates, offset, plaintexts, ciphertexts, workers=1,
+           batch_size=DEFAULT_BATCH_SIZE, on_progress=None, positions=None):
+    """Search the product of per-byte candidate sets for the cipher key
+
+    Args:
+        candidates: Candidate values of each subkey byte (16, 24 or 32
+            sets), or with positions, an (M, k) array of candidate tuples
+            per group of bytes
+        offset: Subkey offset in 32-bit words, as for ops.derive_key()
+        plaintexts: (P, 16) known plaintexts
+        ciphertexts: (P, 16) matching ciphertexts
+        workers: Number of worker processes
+        batch_size: Candidates per batch
+        on_progress: Called with (tested, total) after each batch
+        positions: Subkey byte positions of each candidate tuple array;
+            together they must cover each byte once
+
+    Returns:
+        A SearchResult; stops at the first match
+    """
+    candidates, positions = _check_candidates(candidates, positions)
+    plaintexts, ciphertexts = _pairs(plaintexts, ciphertexts)
+    total = space_size(candidates)
+    if total >= 1 << 63:
+        raise ValueError("Search space too large: %d" % (total,))
+    ranges = ((start, min(start + batch_size, total))
+              for start in range(0, total, batch_size))
+
+    start_time = time.perf_counter()
+    tested = 0
+    key = None
+
+    if workers > 1:
+        executor = concurrent.futures.ProcessPoolExecutor(workers)
+        pending = {}
+        try:
+            for r in ranges:
+                job = (candidates, offset, plaintexts, ciphertexts) + r + (
+                    positions,)
+                pending[executor.submit(_check_range, job)] = r[1] - r[0]
+                # Keep a bounded number of batches in flight
+                if len(pending) >= 2 * workers:
+                    key, n = _collect(pending)
+                    tested += n
+                    if on_progress is not None:
+                        on_progress(tested, total)
+                    if key is not None:
+                        break
+            while pending and key is None:
+                key, n = _collect(pending)
+                tested += n
+                if on_progress is not None:
+                    on_progress(tested, total)
+        finally:
+            executor.shutdown(cancel_futures=True)
+    else:
+        for r in ranges:
+            key = check_range(candidates, offset, plaintexts, ciphertexts,
+                              *r, positions=positions)
+            tested += r[1] - r[0]
+            if on_progress is not None:
+                on_progress(tested, total)
+            if key is not None:
+                break
+
+    return SearchResult(key, tested, total, time.perf_counter() - start_time)
@@ -0,0 +1,275 @@
+"""Block cipher modes of operation: ECB, CBC and CTR
+
+In-memory data is processed with the ecb_*, cbc_* and ctr functions.
+Larger inputs can be streamed in chunks with stream(), or processed
+file-to-file with process_file(), which maps both files and splits the
+independent parts (ECB, CBC decryption, CTR) across a process pool.
+
+Non-final chunks must be a multiple of the block size. ECB and CBC inputs
+must be block-aligned; no padding is applied.
+"""
+from __future__ import division
+
+import concurrent.futures
+import mmap
+import os
+import sys
+
+import numpy as np
+
+from . import cipher
+
+
+MODES = ('ecb', 'cbc', 'ctr')
+
+BLOCK_SIZE = 16
+
+DEFAULT_CHUNK_SIZE = 1 << 20
+DEFAULT_ENGINE = 'table'
+
+
+def _as_array(data):
+    if isinstance(data, np.ndarray):
+        return data.astype(np.uint8, copy=False).reshape(-1)
+    return np.frombuffer(data, dtype=np.uint8)
+
+
+def _as_blocks(data):
+    data = _as_array(data)
+    if data.size % BLOCK_SIZE:
+        raise ValueError("Data length is not a multiple of the block size: "
+                         "%d" % (data.size,))
+    return data.reshape(-1, BLOCK_SIZE)
+
+
+def _as_cipher(key, engine=DEFAULT_ENGINE):
+    if isinstance(key, cipher.AES):
+        return key
+    return cipher.AES(_as_array(key), engine)
+
+
+def _check_iv(iv):
+    iv = _as_array(iv)
+    if iv.size != BLOCK_SIZE:
+        raise ValueError("Invalid IV length: %d" % (iv.size,))
+    return iv
+
+
+def ecb_encrypt(data, key):
+    """ECB encrypt block-aligned data
+
+    Args:
+        data: bytes-like object or uint8 array
+        key: Key bytes, or an AES object
+    """
+    return _as_cipher(key).encrypt_batch(_as_blocks(data)).reshape(-1)
+
+
+def ecb_decrypt(data, key):
+    """ECB decrypt block-aligned data"""
+    return _as_cipher(key).decrypt_batch(_as_blocks(data)).reshape(-1)
+
+
+def cbc_encrypt(data, key, iv):
+    """CBC encrypt block-aligned data
+
+    Each block depends on the previous ciphertext, so this is sequential,
+    one block at a time on the scalar engine.
+    """
+    aes = _as_cipher(key)
+    data = _as_blocks(data).tobytes()
+    prev = int.from_bytes(_check_iv(iv).tobytes(), 'big')
+
+    result = bytearray(len(data))
+    for i in range(0, len(data), BLOCK_SIZE):
+        block = int.from_bytes(data[i:i + BLOCK_SIZE], 'big') ^ prev
+        out = aes.encrypt_block(block.to_bytes(BLOCK_SIZE, 'big'))
+        result[i:i + BLOCK_SIZE] = out
+        prev = int.from_bytes(out, 'big')
+
+    return np.frombuffer(result, dtype=np.uint8)
+
+
+def cbc_decrypt(data, key, iv):
+    """CBC decrypt block-aligned data"""
+    aes = _as_cipher(key)
+    blocks = _as_blocks(data)
+
+    prev = np.empty_like(blocks)
+    prev[:1] = _check_iv(iv)
+    prev[1:] = blocks[:-1]
+
+    return (aes.decrypt_batch(blocks) ^ prev).reshape(-1)
+
+
+def ctr_counters(iv, start, count):
+    """Counter blocks iv + start ... iv + start + count - 1
+
+    The whole 128-bit block is incremented as a big-endian integer, per
+    NIST SP 800-38A.
+    """
+    hi, lo = _check_iv(iv).view('>u8').astype(np.uint64)
+    with np.errstate(over='ignore'):
+        lo_n = lo + np.arange(start, start + count, dtype=np.uint64)
+        hi_n = hi + (lo_n < lo).astype(np.uint64)
+    counters = np.stack((hi_n, lo_n), axis=-1).astype('>u8')
+    return counters.view(np.uint8).reshape(count, BLOCK_SIZE)
+
+
+def ctr(data, key, iv, offset=0):
+    """CTR encrypt or decrypt data of any length
+
+    Args:
+        offset: Block offset of data into the stream
+    """
+    data = _as_array(data)
+    count = -(-data.size // BLOCK_SIZE)
+    counters = ctr_counters(iv, offset, count)
+    keystream = _as_cipher(key).encrypt_batch(counters).reshape(-1)
+    return data ^ keystream[:data.size]
+
+
+def stream(chunks, key, mode, iv=None, decrypt=False):
+    """Encrypt or decrypt an iterable of chunks, yielding output chunks
+
+    The CBC chaining value and CTR counter are carried between chunks.
+    """
+    aes = _as_cipher(key)
+    if mode not in MODES:
+        raise ValueError("Invalid mode: %r" % (mode,))
+    if mode != 'ecb':
+        iv = _check_iv(iv)
+
+    offset = 0
+    for chunk in chunks:
+        chunk = _as_array(chunk)
+        if mode == 'ecb':
+            out = (ecb_decrypt if decrypt else ecb_encrypt)(chunk, aes)
+        elif mode == 'cbc':
+            out = (cbc_decrypt if decrypt else cbc_encrypt)(chunk, aes, iv)
+            if chunk.size:
+                iv = (chunk if decrypt else out)[-BLOCK_SIZE:]
+        else:
+            out = ctr(chunk, aes, iv, offset)
+            offset += chunk.size // BLOCK_SIZE
+        yield out
+
+
+def read_chunks(buf, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Yield zero-copy views of a buffer in chunks of chunk_size bytes"""
+    view = memoryview(buf)
+    for start in range(0, len(view), chunk_size):
+        yield view[start:start + chunk_size]
+
+
+def _check_chunk_size(chunk_size):
+    if chunk_size <= 0 or chunk_size % BLOCK_SIZE:
+        raise ValueError("Chunk size must be a positive multiple of %d: %d" %
+                         (BLOCK_SIZE, chunk_size))
+
+
+def _close_map(m):
+    """Close a memory map, unless views of it are held by an error in
+    flight
+
+    Arrays referenced by the error's traceback keep the map exported, and
+    closing it would raise BufferError in place of the error. The map is
+    unmapped once they are freed.
+    """
+    try:
+        m.close()
+    except BufferError:
+        if sys.exc_info()[1] is None:
+            raise
+
+
+def _process_range(job):
+    """Process one chunk of a mapped file into the mapped output file
+
+    Runs in a worker process. The chunk's CBC chaining value is read from
+    the input file, and its CTR counter is derived from its offset.
+    """
+    src, dst, start, length, key, mode, iv, decrypt, engine = job
+    aes = cipher.AES(_as_array(key), engine)
+
+    with open(src, 'rb') as fin, open(dst, 'r+b') as fout:
+        min_ = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+        mout = mmap.mmap(fout.fileno(), 0)
+        try:
+            data = np.frombuffer(min_, dtype=np.uint8, offset=start,
+                                 count=length)
+            out = np.frombuffer(mout, dtype=np.uint8, offset=start,
+                                count=length)
+            if mode == 'ecb':
+                fn = ecb_decrypt if decrypt else ecb_encrypt
+                out[:] = fn(data, aes)
+            elif mode == 'cbc':
+                if start:
+                    iv = np.frombuffer(min_, dtype=np.uint8,
+                                       offset=start - BLOCK_SIZE,
+                                       count=BLOCK_SIZE)
+                out[:] = cbc_decrypt(data, aes, iv)
+            else:
+                out[:] = ctr(data, aes, iv, start // BLOCK_SIZE)
+            del data, out, iv
+        finally:
+            _close_map(mout)
+            _close_map(min_)
+
+    return length
+
+
+def process_file(src, dst, key, mode, iv=None, decrypt=False, workers=1,
+                 chunk_size=DEFAULT_CHUNK_SIZE, engine=DEFAULT_ENGINE):
+    """Encrypt or decrypt a file
+
+    The input is memory mapped. With more than one worker, ECB, CTR and CBC
+    decryption chunks are processed in a process pool, each worker writing
+    its chunk straight into the mapped output file. CBC encryption is always
+    sequential. The output may not be the input file.
+
+    Returns:
+        Number of bytes processed
+    """
+    _check_chunk_size(chunk_size)
+    aes = cipher.AES(_as_array(key), engine)
+    if mode not in MODES:
+        raise ValueError("Invalid mode: %r" % (mode,))
+    iv = None if mode == 'ecb' else _check_iv(iv)
+
+    size = os.path.getsize(src)
+    if mode != 'ctr' and size % BLOCK_SIZE:
+        raise ValueError("File size is not a multiple of the block size: "
+                         "%d" % (size,))
+
+    # Opening the output truncates it
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        raise ValueError("Input and output are the same file: %s" % (dst,))
+
+    with open(dst, 'wb') as fout:
+        fout.truncate(size)
+    if not size:
+        return 0
+
+    if workers > 1 and not (mode == 'cbc' and not decrypt):
+        jobs = [(src, dst, start, min(chunk_size, size - start),
+                 aes.key.tobytes(), mode,
+                 None if iv is None else iv.tobytes(), decrypt, engine)
+                for start in range(0, size, chunk_size)]
+        with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+            return sum(executor.map(_process_range, jobs))
+
+    with open(src, 'rb') as fin, open(dst, 'r+b') as fout:
+        min_ = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(min_)
+        chunks = stream(read_chunks(view, chunk_size), aes, mode, iv,
+                        decrypt)
+        try:
+            for out in chunks:
+                fout.write(out.data)
+        finally:
+            chunks.close()
+            view.release()
+            _close_map(min_)
+
+    return size
@@ -3,6 +3,7 @@ from __future__ import division
 import numpy as np
 
 from .constants import SBOX, SBOX_INV, RCON, GMUL, MIX_COLS, MIX_COLS_INV
+from .constants import SHIFT_ROWS, SHIFT_ROWS_INV
 
 
 def rot_word(word, by=1):
@@ -34,60 +35,121 @@ def key_expansion(key, Nr, Nb=4):
         key: Input key as a numpy array
         Nr: Number of cipher rounds
     """
-    Nk = key.size // Nb  # Number of words in key
-    if Nk not in (4, 6, 8):
+    key = np.asarray(key, dtype=np.uint8)
+    return key_expansion_batch(key.reshape(1, key.size), Nr, Nb)[0]
+
+
+def derive_key(sub_key, offset, Nb=4):
+    """Derive the original key given a sub key.
+
+    The sub_key must be the size of the encryption key (128, 192, or 256 bits).
+
+    Args:
+        sub_key: Input key as a numpy array, binary string, or bytearray
+        offset: Offset into the key expansion array in 32-bit words (Nb bytes)
+    """
+    sub_key = np.frombuffer(sub_key, dtype=np.uint8) if isinstance(
+        sub_key, (bytes, bytearray)) else np.asarray(sub_key, dtype=np.uint8)
+    return derive_key_batch(sub_key.reshape(1, sub_key.size), offset, Nb)[0]
+
+
+_ROT_WORD = np.array((1, 2, 3, 0), dtype=np.intp)
+
+
+def _rcon_word(i):
+    return np.array((RCON[i], 0, 0, 0), dtype=np.uint8)
+
+
+def key_expansion_batch(keys, Nr, Nb=4):
+    """Subkey expansion of many keys at once
+
+    Args:
+        keys: (M, Nk * 4) array of keys
+        Nr: Number of cipher rounds
+
+    Returns:
+        (M, Nb * (Nr + 1), Nb) key schedules
+    """
+    keys = np.asarray(keys, dtype=np.uint8)
+    Nk = keys.shape[-1] // Nb  # Number of words in key
+    if Nk not in (4, 6, 8) or keys.shape[-1] != Nk * Nb:
         raise ValueError("Invalid key length")
 
     # Allocate
-    w = np.zeros((Nb*(Nr+1), Nb), dtype=np.uint8)
+    w = np.zeros(keys.shape[:-1] + (Nb * (Nr + 1), Nb), dtype=np.uint8)
 
     # Initialize
-    w[:Nk] = key.reshape(Nk, Nb)
+    w[..., :Nk, :] = keys.reshape(keys.shape[:-1] + (Nk, Nb))
 
     # Create
-    for i in range(Nk, w.shape[0]):
-        temp = w[i-1]
+    for i in range(Nk, w.shape[-2]):
+        temp = w[..., i - 1, :]
 
         if (i % Nk) == 0:
-            temp = sub_word(rot_word(temp)) ^ rcon(i // Nk)
+            temp = SBOX[temp[..., _ROT_WORD]] ^ _rcon_word(i // Nk)
         elif Nk > 6 and (i % Nk) == 4:
-            temp = sub_word(temp)
-        w[i] = w[i-Nk] ^ temp
+            temp = SBOX[temp]
+        w[..., i, :] = w[..., i - Nk, :] ^ temp
 
     return w
 
 
-def derive_key(sub_key, offset, Nb=4):
-    """Derive the original key given a sub key.
-
-    The sub_key must be the size of the encryption key (128, 192, or 256 bits).
+def derive_key_batch(sub_keys, offset, Nb=4, Nr=None):
+    """Derive the original keys of many sub keys at once
 
     Args:
-        sub_key: Input key as a numpy array, binary string, or bytearray
-        offset: Offset into the key expansion array in 32-bit words (Nb bytes)
+        sub_keys: (M, Nk * 4) array of sub keys
+        offset: Offset into the key expansion array in 32-bit words, shared
+            by all rows or an (M,) array of per-row offsets
+        Nr: If given, return the full key schedules for Nr rounds
+
+    Returns:
+        (M, Nk * 4) array of keys, or (M, Nb * (Nr + 1), Nb) key schedules
     """
-    # Figure out key size based on input
-    Nk = sub_key.size // Nb  # Number of words in key
-    if Nk not in (4, 6, 8):
+    sub_keys = np.asarray(sub_keys, dtype=np.uint8)
+    Nk = sub_keys.shape[-1] // Nb  # Number of words in key
+    if Nk not in (4, 6, 8) or sub_keys.shape[-1] != Nk * Nb:
         raise ValueError("Invalid key length")
 
-    # Allocate
-    w = np.zeros((offset + Nk, Nb), dtype=np.uint8)
+    offset = np.asarray(offset, dtype=np.intp)
+    if offset.ndim and offset.shape != sub_keys.shape[:-1]:
+        raise ValueError("Offsets do not match the sub keys: %r" %
+                         (offset.shape,))
+    if (offset < 0).any():
+        raise ValueError("Invalid offset")
+    end = int(offset.max(initial=0))
 
-    # Initialize
-    w[-Nk:] = sub_key.reshape((Nk, Nb))
+    # Allocate, with each row's sub key at its own offset
+    w = np.zeros(sub_keys.shape[:-1] + (end + Nk, Nb), dtype=np.uint8)
 
-    # Create
-    for i in reversed(range(Nk, w.shape[0])):
-        temp = w[i-1]
+    # Initialize
+    words = sub_keys.reshape(sub_keys.shape[:-1] + (Nk, Nb))
+    if offset.ndim:
+        rows = np.arange(len(offset))[:, None]
+        w[rows, offset[:, None] + np.arange(Nk)] = words
+    else:
+        w[..., -Nk:, :] = words
+
+    # Create, walking back one word at a time for all rows together. Rows
+    # whose sub key starts below word i - Nk + 1 have nothing to derive yet.
+    for i in reversed(range(Nk, w.shape[-2])):
+        temp = w[..., i - 1, :]
 
         if (i % Nk) == 0:
-            temp = sub_word(rot_word(temp)) ^ rcon(i // Nk)
+            temp = SBOX[temp[..., _ROT_WORD]] ^ _rcon_word(i // Nk)
         elif Nk > 6 and (i % Nk) == 4:
-            temp = sub_word(temp)
-        w[i-Nk] = w[i] ^ temp
+            temp = SBOX[temp]
+        derived = w[..., i, :] ^ temp
 
-    return w[:Nk].reshape(Nk * Nb)
+        if offset.ndim:
+            derived = np.where((i < offset + Nk)[:, None], derived,
+                               w[..., i - Nk, :])
+        w[..., i - Nk, :] = derived
+
+    keys = w[..., :Nk, :].reshape(sub_keys.shape)
+    if Nr is not None:
+        return key_expansion_batch(keys, Nr, Nb)
+    return keys
 
 
 def add_round_key(state, key):
@@ -121,57 +183,85 @@ def shift_rows_inv(state):
 
 
 def gmul(a, b):
-    """Use for values of 'a' outside (1,2,3)
+    """Multiply in GF(2^8)
+
+    Accepts integers or integer arrays, broadcasting like any NumPy operation.
     """
-    p = 0
-    for counter in range(8):
-        if (b & 1) == 1:
-            p ^= a
-        hi_bit_set = (a & 0x80)
-        a <<= 1
-        a &= 0xFF
-        if hi_bit_set:
-            a ^= 0x1b
-        b >>= 1
+    return GMUL[a, b]
 
-    return p
 
+def _mix_tables(coefs):
+    """Rows of GMUL for each coefficient of a MixColumns matrix"""
+    return [[GMUL[c] for c in row] for row in coefs]
 
-def mix_column(col):
-    result = np.array(col)
-    coefs = MIX_COLS
-    for i in range(len(col)):
-        result[i] = (
-            gmul(coefs[i, 0], col[0]) ^
-            gmul(coefs[i, 1], col[1]) ^
-            gmul(coefs[i, 2], col[2]) ^
-            gmul(coefs[i, 3], col[3])
-        )
+
+_MIX_TABLES = _mix_tables(MIX_COLS)
+_MIX_TABLES_INV = _mix_tables(MIX_COLS_INV)
+
+
+def _mix(cols, tables):
+    """Multiply (..., 4) columns by a 4x4 MixColumns coefficient matrix
+
+    The matrix is given as tables from _mix_tables().
+    """
+    cols = np.asarray(cols)
+    c0, c1, c2, c3 = cols[..., 0], cols[..., 1], cols[..., 2], cols[..., 3]
+    result = np.empty_like(cols)
+    for i, (t0, t1, t2, t3) in enumerate(tables):
+        result[..., i] = t0[c0] ^ t1[c1] ^ t2[c2] ^ t3[c3]
     return result
 
 
+def mix_column(col):
+    return _mix(col, _MIX_TABLES)
+
+
 def mix_columns(state):
-    result = np.array(state.T)
-    for col in range(result.shape[0]):
-        result[col] = mix_column(result[col])
-    return result.T
+    """MixColumns on a (..., 4, 4) state, or stack of states
+    """
+    return _mix(state.swapaxes(-1, -2), _MIX_TABLES).swapaxes(-1, -2)
 
 
 def mix_column_inv(col):
-    result = np.array(col)
-    coefs = MIX_COLS_INV
-    for i in range(len(col)):
-        result[i] = (
-            gmul(coefs[i, 0], col[0]) ^
-            gmul(coefs[i, 1], col[1]) ^
-            gmul(coefs[i, 2], col[2]) ^
-            gmul(coefs[i, 3], col[3])
-        )
-    return result
+    return _mix(col, _MIX_TABLES_INV)
 
 
 def mix_columns_inv(state):
-    result = np.array(state.T)
-    for col in range(result.shape[0]):
-        result[col] = mix_column_inv(result[col])
-    return result.T
+    """InvMixColumns on a (..., 4, 4) state, or stack of states
+    """
+    return _mix(state.swapaxes(-1, -2), _MIX_TABLES_INV).swapaxes(-1, -2)
+
+
+# Batched operations
+#
+# These work on arrays of flattened states with shape (..., 16), where each
+# state is stored column-major (the byte order of the input block). All
+# leading dimensions are processed at once.
+
+def sub_bytes_batch(blocks):
+    return SBOX[blocks]
+
+
+def sub_bytes_inv_batch(blocks):
+    return SBOX_INV[blocks]
+
+
+def shift_rows_batch(blocks):
+    return blocks[..., SHIFT_ROWS]
+
+
+def shift_rows_inv_batch(blocks):
+    return blocks[..., SHIFT_ROWS_INV]
+
+
+def _mix_columns_batch(blocks, tables):
+    cols = blocks.reshape(blocks.shape[:-1] + (4, 4))
+    return _mix(cols, tables).reshape(blocks.shape)
+
+
+def mix_columns_batch(blocks):
+    return _mix_columns_batch(blocks, _MIX_TABLES)
+
+
+def mix_columns_inv_batch(blocks):
+    return _mix_columns_batch(blocks, _MIX_TABLES_INV)
@@ -0,0 +1,277 @@
+"""Opt-in instrumentation of the hot paths
+
+While enabled, calls to the ops primitives, the cipher entry points and
+engines, and the DFA stages are counted, along with the bytes of their
+data argument (the blocks, states, keys or faulty ciphertexts) and their
+wall time:
+
+    with profiling.profile() as stats:
+        dfa.stream(f)
+    print(stats.format())
+
+Instrumenting replaces the functions in their modules (and in the dispatch
+tables that refer to them) with timing wrappers, and disabling puts the
+originals back, so there is no cost while disabled. Times are inclusive:
+a function's time includes that of the instrumented functions it calls.
+Only the calling process is instrumented, not worker processes.
+"""
+from __future__ import division
+
+import contextlib
+import functools
+import inspect
+import json
+import threading
+import time
+
+import numpy as np
+
+from . import bitslice
+from . import cipher
+from . import dfa
+from . import keysearch
+from . import ops
+from . import scalar
+from . import ttable
+
+
+# (owner, attribute names) of the instrumented functions; owners are
+# modules or classes
+TARGETS = (
+    (ops, ('key_expansion', 'key_expansion_batch', 'derive_key',
+           'derive_key_batch', 'add_round_key', 'sub_bytes', 'sub_bytes_inv',
+           'shift_rows', 'shift_rows_inv', 'mix_columns', 'mix_columns_inv',
+           'sub_bytes_batch', 'sub_bytes_inv_batch', 'shift_rows_batch',
+           'shift_rows_inv_batch', 'mix_columns_batch',
+           'mix_columns_inv_batch')),
+    (cipher, ('encrypt_explicit', 'decrypt_explicit', 'encrypt_blocks',
+              'decrypt_blocks', 'evaluate')),
+    (cipher.AES, ('encrypt', 'decrypt', 'encrypt_block', 'decrypt_block',
+                  'encrypt_batch', 'decrypt_batch')),
+    (ttable, ('encrypt_blocks', 'decrypt_blocks')),
+    (bitslice, ('encrypt_blocks', 'decrypt_blocks')),
+    (scalar, ('encrypt_blocks', 'decrypt_blocks')),
+    (dfa, ('_filter', 'parse_hex', 'classify', 'column_candidates',
+           'solve_column', 'solve', 'recover')),
+    (dfa.Session, ('add',)),
+    (keysearch, ('check_range', 'search')),
+)
+
+
+# Positional index of the data argument, where it is not the first array
+_DATA_ARG = {
+    'dfa.classify': 1,
+    'dfa.column_candidates': 1,
+    'dfa.solve_column': 1,
+    'dfa.solve': 1,
+}
+
+
+def _tables():
+    """Dispatch tables holding references to instrumented functions"""
+    return (cipher._FORWARD, cipher._INVERSE, cipher.ENGINES)
+
+
+class Stats:
+    """Call counts, bytes and wall time per instrumented function
+
+    Functions are named module.function, or module.Class.method.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def add(self, name, nbytes, seconds, calls=1):
+        with self._lock:
+            entry = self._entries.setdefault(name, [0, 0, 0.0])
+            entry[0] += calls
+            entry[1] += nbytes
+            entry[2] += seconds
+
+    def merge(self, other):
+        """Add the counts of another Stats"""
+        for name, entry in other.as_dict().items():
+            self.add(name, entry['bytes'], entry['seconds'], entry['calls'])
+
+    def as_dict(self):
+        """{name: {'calls': ..., 'bytes': ..., 'seconds': ...}}"""
+        with self._lock:
+            return {name: {'calls': calls, 'bytes': nbytes,
+                           'seconds': seconds}
+                    for name, (calls, nbytes, seconds)
+                    in self._entries.items()}
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.as_dict(), **kwargs)
+
+    def format(self):
+        """A table of the entries, slowest first"""
+        entries = sorted(self.as_dict().items(),
+                         key=lambda item: -item[1]['seconds'])
+        width = max([len(name) for name, _ in entries] + [8])
+        lines = ["{name:<{w}} {calls:>9} {bytes:>12} {total:>10} "
+                 "{per_call:>10} {rate:>9}".format(
+                     name='Function', w=width, calls='Calls', bytes='Bytes',
+                     total='Total ms', per_call='us/call', rate='MB/s')]
+        for name, entry in entries:
+            seconds = entry['seconds']
+            rate = ('%.2f' % (entry['bytes'] / 1e6 / seconds)
+                    if entry['bytes'] and seconds > 0 else '-')
+            lines.append(
+                "{name:<{w}} {calls:>9} {bytes:>12} {total:>10.3f} "
+                "{per_call:>10.2f} {rate:>9}".format(
+                    name=name, w=width, calls=entry['calls'],
+                    bytes=entry['bytes'], total=seconds * 1e3,
+                    per_call=seconds / max(entry['calls'], 1) * 1e6,
+                    rate=rate))
+        return '\n'.join(lines)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def _nbytes(value):
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return len(value)
+    return 0
+
+
+def _data_nbytes(args, index=None):
+    """Size of the data argument, by default the first array-like one"""
+    if index is not None:
+        return _nbytes(args[index]) if index < len(args) else 0
+    for arg in args:
+        n = _nbytes(arg)
+        if n:
+            return n
+    return 0
+
+
+_DONE = object()
+
+
+def _wrap(fn, name):
+    index = _DATA_ARG.get(name)
+    if inspect.isgeneratorfunction(fn):
+        # Time spent producing items; bytes are those of the items
+        @functools.wraps(fn)
+        def generator(*args, **kwargs):
+            stats = _active
+            if stats is not None:
+                stats.add(name, 0, 0.0)
+            it = fn(*args, **kwargs)
+            while True:
+                start = time.perf_counter()
+                item = next(it, _DONE)
+                if stats is not None:
+                    stats.add(name, _nbytes(item),
+                              time.perf_counter() - start, calls=0)
+                if item is _DONE:
+                    return
+                yield item
+        return generator
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        stats = _active
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            if stats is not None:
+                stats.add(name, _data_nbytes(args, index),
+                          time.perf_counter() - start)
+    return wrapper
+
+
+_lock = threading.Lock()
+_active = None
+# Original function -> wrapper, while instrumented
+_wrappers = {}
+
+
+def _swap(value, mapping):
+    if isinstance(value, tuple):
+        return tuple(_swap(v, mapping) for v in value)
+    return mapping.get(value, value)
+
+
+def _patch(mapping):
+    """Replace functions throughout TARGETS and the dispatch tables"""
+    for owner, names in TARGETS:
+        for attr in names:
+            fn = owner.__dict__[attr]
+            setattr(owner, attr, mapping.get(fn, fn))
+    for table in _tables():
+        for key, value in table.items():
+            table[key] = _swap(value, mapping)
+
+
+def _install():
+    for owner, names in TARGETS:
+        prefix = owner.__name__ if inspect.ismodule(owner) else (
+            owner.__module__ + '.' + owner.__qualname__)
+        prefix = prefix[len(__package__) + 1:]
+        for attr in names:
+            fn = owner.__dict__[attr]
+            _wrappers[fn] = _wrap(fn, prefix + '.' + attr)
+    _patch(_wrappers)
+
+
+def _uninstall():
+    _patch({wrapper: fn for fn, wrapper in _wrappers.items()})
+    _wrappers.clear()
+
+
+def enable(stats=None):
+    """Instrument the hot paths, recording into stats
+
+    Returns:
+        The Stats being recorded into
+    """
+    global _active
+    with _lock:
+        if not _wrappers:
+            _install()
+        _active = Stats() if stats is None else stats
+        return _active
+
+
+def disable():
+    """Restore the original functions
+
+    Returns:
+        The Stats that was being recorded into, or None
+    """
+    global _active
+    with _lock:
+        if _wrappers:
+            _uninstall()
+        stats, _active = _active, None
+        return stats
+
+
+def active():
+    """The Stats being recorded into, or None when disabled"""
+    return _active
+
+
+@contextlib.contextmanager
+def profile():
+    """Record into a new Stats for the duration of a with block
+
+    Within an enclosing profile, the counts are also added to the outer
+    Stats on exit.
+    """
+    outer = _active
+    stats = enable()
+    try:
+        yield stats
+    finally:
+        if outer is None:
+            disable()
+        else:
+            enable(outer).merge(stats)
@@ -0,0 +1,141 @@
+"""Single-block AES on Python integers
+
+For one block, the fixed cost of each NumPy call outweighs the work, so
+this engine makes none: the state is a 128-bit integer, and each byte
+position has a table of 256 integers merging SubBytes, ShiftRows and
+MixColumns for that byte. An inner round unpacks the state to bytes and
+XORs 16 lookups and the round key. The last round applies ShiftRows with
+itemgetter and SubBytes with bytes.translate.
+
+Round keys are converted once, by round_keys(). Decryption uses the
+equivalent inverse cipher, as in the table engine.
+"""
+from __future__ import division
+
+import operator
+
+import numpy as np
+
+from . import ops
+from . import ttable
+from .constants import SBOX, SBOX_INV
+from .constants import SHIFT_ROWS, SHIFT_ROWS_INV
+
+
+def _tables(sbox, shift_rows, mix_columns):
+    """Per byte position, the state contributed by each value of that byte"""
+    state = np.zeros((16, 256, 16), dtype=np.uint8)
+    state[np.arange(16), :, np.arange(16)] = sbox
+    state = np.ascontiguousarray(mix_columns(shift_rows(state)))
+    hi, lo = state.view('>u8').reshape(-1, 2).T.tolist()
+    words = [(h << 64) | l for h, l in zip(hi, lo)]
+    return tuple(tuple(words[256 * p:256 * (p + 1)]) for p in range(16))
+
+
+# (tables, last round ShiftRows, last round S-box) for each direction
+_ENCRYPT = (_tables(SBOX, ops.shift_rows_batch, ops.mix_columns_batch),
+            operator.itemgetter(*SHIFT_ROWS.tolist()), bytes(SBOX.tolist()))
+_DECRYPT = (_tables(SBOX_INV, ops.shift_rows_inv_batch,
+                    ops.mix_columns_inv_batch),
+            operator.itemgetter(*SHIFT_ROWS_INV.tolist()),
+            bytes(SBOX_INV.tolist()))
+
+
+def round_keys(rk):
+    """(Nr + 1, 16) round keys as a tuple of integers"""
+    rk = np.asarray(rk, dtype=np.uint8).reshape(-1, 16)
+    return tuple(int.from_bytes(k.tobytes(), 'big') for k in rk)
+
+
+def _crypt(x, keys, direction):
+    """Run the rounds on a 128-bit integer state"""
+    tables, shift_rows, sbox = direction
+    (t0, t1, t2, t3, t4, t5, t6, t7,
+     t8, t9, t10, t11, t12, t13, t14, t15) = tables
+
+    x ^= keys[0]
+    for k in keys[1:-1]:
+        (a0, a1, a2, a3, a4, a5, a6, a7,
+         a8, a9, a10, a11, a12, a13, a14, a15) = x.to_bytes(16, 'big')
+        x = (t0[a0] ^ t1[a1] ^ t2[a2] ^ t3[a3] ^
+             t4[a4] ^ t5[a5] ^ t6[a6] ^ t7[a7] ^
+             t8[a8] ^ t9[a9] ^ t10[a10] ^ t11[a11] ^
+             t12[a12] ^ t13[a13] ^ t14[a14] ^ t15[a15] ^ k)
+
+    last = bytes(shift_rows(x.to_bytes(16, 'big'))).translate(sbox)
+    return int.from_bytes(last, 'big') ^ keys[-1]
+
+
+def encrypt_int(x, keys):
+    """Encrypt a block given as a 128-bit big-endian integer
+
+    Args:
+        x: Block integer
+        keys: Round keys from round_keys()
+    """
+    return _crypt(x, keys, _ENCRYPT)
+
+
+def decrypt_int(x, keys):
+    """Decrypt a block given as a 128-bit big-endian integer
+
+    Args:
+        x: Block integer
+        keys: Equivalent inverse cipher round keys, from round_keys()
+    """
+    return _crypt(x, keys, _DECRYPT)
+
+
+def encrypt_block(block, keys):
+    """Encrypt 16 bytes; returns bytes"""
+    return _crypt(int.from_bytes(block, 'big'), keys,
+                  _ENCRYPT).to_bytes(16, 'big')
+
+
+def decrypt_block(block, keys):
+    """Decrypt 16 bytes with inverse cipher round keys; returns bytes"""
+    return _crypt(int.from_bytes(block, 'big'), keys,
+                  _DECRYPT).to_bytes(16, 'big')
+
+
+def _blocks(fn, blocks, rk):
+    """Apply a block function to (N, 16) blocks with shared or per-block
+    round keys"""
+    blocks = np.ascontiguousarray(blocks, dtype=np.uint8)
+    data = blocks.tobytes()
+    out = bytearray(len(data))
+    if rk.ndim == 3:
+        for i in range(len(blocks)):
+            out[16 * i:16 * i + 16] = fn(data[16 * i:16 * i + 16],
+                                         round_keys(rk[i]))
+    else:
+        keys = round_keys(rk)
+        for i in range(0, len(data), 16):
+            out[i:i + 16] = fn(data[i:i + 16], keys)
+    return np.frombuffer(out, dtype=np.uint8).reshape(blocks.shape)
+
+
+def encrypt_blocks(blocks, rk, Nr=10):
+    """Encrypt an (N, 16) array of blocks, one at a time
+
+    Args:
+        blocks: (N, 16) uint8 array
+        rk: (Nr + 1, 16) flattened round keys, or (N, Nr + 1, 16) for a
+            different key per block
+        Nr: Number of cipher rounds
+    """
+    return _blocks(encrypt_block, blocks, np.asarray(rk))
+
+
+def decrypt_blocks(blocks, rk, Nr=10, dk=None):
+    """Decrypt an (N, 16) array of blocks, one at a time
+
+    Args:
+        blocks: (N, 16) uint8 array
+        rk: (Nr + 1, 16) flattened round keys
+        Nr: Number of cipher rounds
+        dk: Optional precomputed ttable.inverse_round_keys(rk, Nr)
+    """
+    if dk is None:
+        dk = ttable.inverse_round_keys(rk, Nr)
+    return _blocks(decrypt_block, blocks, np.asarray(dk))
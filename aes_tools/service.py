@@ -0,0 +1,322 @@
+"""Coalescing block encryption service
+
+Each call into the cipher has a fixed cost that dominates for single
+blocks, so many small concurrent requests are far slower than one batch of
+the same blocks. Batcher queues single-block requests, groups them by key
+and direction, and runs each group as one batch in a worker pool once it
+holds max_batch blocks or its oldest request has waited max_wait seconds.
+Each caller awaits its own result:
+
+    async with service.Batcher(max_batch=256, max_wait=0.002) as batcher:
+        ciphertext = await batcher.encrypt(block, key)
+
+serve() exposes a Batcher over TCP or a Unix socket. Requests are lines of
+ASCII hex,
+
+    e KEY BLOCK     encrypt a block
+    d KEY BLOCK     decrypt a block
+    stats           the metrics, once the earlier requests are answered
+
+and each is answered, in order, with a line holding the resulting block,
+the metrics, or "error MESSAGE". Clients may send any number of requests
+before reading the responses, and requests from all connections are
+batched together.
+"""
+from __future__ import division
+
+import asyncio
+import collections
+import concurrent.futures
+import json
+import time
+
+import numpy as np
+
+from . import cipher
+from . import modes
+
+
+DEFAULT_MAX_BATCH = 256
+
+# Seconds
+DEFAULT_MAX_WAIT = 0.002
+
+# Number of recent latencies kept for the percentiles
+LATENCY_WINDOW = 10000
+
+
+def _run_batch(blocks, key, decrypt, engine):
+    """Encrypt or decrypt (N, 16) blocks with one key, in the worker pool"""
+    aes = cipher.key_cache.get(key)
+    if decrypt:
+        return aes.decrypt_batch(blocks, engine)
+    return aes.encrypt_batch(blocks, engine)
+
+
+class Metrics:
+    """Queue, batch and latency statistics of a Batcher
+
+    Updated from the event loop only. Latencies run from submission to the
+    result being set, in seconds.
+
+    Attributes:
+        requests: Requests completed, including failed ones
+        batches: Batches run
+        queue_depth: Requests waiting for their group to be batched
+        max_queue_depth: Highest queue_depth seen
+        in_flight: Batches running in the pool
+        max_batch_size: Largest batch run
+    """
+
+    def __init__(self, window=LATENCY_WINDOW):
+        self.requests = 0
+        self.batches = 0
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self.in_flight = 0
+        self.max_batch_size = 0
+        self._batched = 0
+        self._latencies = collections.deque(maxlen=window)
+
+    def _queued(self):
+        self.queue_depth += 1
+        self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+
+    def _started(self, size):
+        self.queue_depth -= size
+        self.in_flight += 1
+        self.batches += 1
+        self._batched += size
+        self.max_batch_size = max(self.max_batch_size, size)
+
+    def _finished(self, latencies):
+        self.in_flight -= 1
+        self.requests += len(latencies)
+        self._latencies.extend(latencies)
+
+    def mean_batch_size(self):
+        return self._batched / self.batches if self.batches else 0.0
+
+    def latency(self, q):
+        """The q-th percentile of the recent latencies, in seconds"""
+        if not self._latencies:
+            return 0.0
+        return float(np.percentile(self._latencies, q))
+
+    def as_dict(self):
+        return {
+            'requests': self.requests,
+            'batches': self.batches,
+            'queue_depth': self.queue_depth,
+            'max_queue_depth': self.max_queue_depth,
+            'in_flight': self.in_flight,
+            'mean_batch_size': self.mean_batch_size(),
+            'max_batch_size': self.max_batch_size,
+            'p50_latency': self.latency(50),
+            'p99_latency': self.latency(99),
+        }
+
+
+class _Group:
+    """Queued requests for one key and direction"""
+
+    def __init__(self, timer):
+        self.timer = timer
+        self.blocks = []
+        self.futures = []
+        self.times = []
+
+
+class Batcher:
+    """Coalesces single-block requests into batches per key
+
+    A Batcher belongs to the event loop it is first used from.
+
+    Args:
+        max_batch: Most blocks per batch; a full group is run immediately
+        max_wait: Longest a request waits for its group to fill, in seconds
+        workers: Worker threads, if no executor is given
+        executor: A concurrent.futures executor to run the batches in, e.g.
+            a ProcessPoolExecutor; it is left running by close()
+        engine: Name of the cipher engine, from cipher.ENGINES
+
+    Attributes:
+        metrics: The Metrics of the requests so far
+    """
+
+    def __init__(self, max_batch=DEFAULT_MAX_BATCH, max_wait=DEFAULT_MAX_WAIT,
+                 workers=1, executor=None, engine=modes.DEFAULT_ENGINE):
+        if max_batch < 1:
+            raise ValueError("Invalid batch size: %d" % (max_batch,))
+        if max_wait < 0:
+            raise ValueError("Invalid wait: %r" % (max_wait,))
+        cipher._engine(engine)
+
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.engine = engine
+        self.metrics = Metrics()
+        self._own_executor = executor is None
+        self._executor = (concurrent.futures.ThreadPoolExecutor(workers)
+                          if executor is None else executor)
+        self._groups = {}
+        self._tasks = set()
+        self._closed = False
+
+    def submit(self, block, key, decrypt=False):
+        """Queue a block for encryption or decryption
+
+        Returns:
+            An asyncio future of the (16,) uint8 result
+        """
+        if self._closed:
+            raise ValueError("Batcher is closed")
+        block = modes._as_array(block)
+        if block.size != 16:
+            raise ValueError("Invalid block length: %d" % (block.size,))
+        key = modes._as_array(key)
+        if key.size not in cipher.KEY_LEN_TO_ROUNDS:
+            raise ValueError("Invalid key length: %d" % (key.size,))
+
+        loop = asyncio.get_running_loop()
+        group_key = (bool(decrypt), key.tobytes())
+        group = self._groups.get(group_key, None)
+        if group is None:
+            group = self._groups[group_key] = _Group(
+                loop.call_later(self.max_wait, self._flush, group_key))
+
+        future = loop.create_future()
+        group.blocks.append(block)
+        group.futures.append(future)
+        group.times.append(time.perf_counter())
+        self.metrics._queued()
+
+        if len(group.blocks) >= self.max_batch:
+            self._flush(group_key)
+        return future
+
+    async def encrypt(self, block, key):
+        """Encrypt one block; returns a (16,) uint8 array"""
+        return await self.submit(block, key)
+
+    async def decrypt(self, block, key):
+        """Decrypt one block; returns a (16,) uint8 array"""
+        return await self.submit(block, key, decrypt=True)
+
+    def _flush(self, group_key):
+        """Start a batch of a group's queued requests"""
+        group = self._groups.pop(group_key, None)
+        if group is None:
+            return
+        group.timer.cancel()
+        self.metrics._started(len(group.blocks))
+        task = asyncio.ensure_future(self._run(group_key, group))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, group_key, group):
+        decrypt, key = group_key
+        loop = asyncio.get_running_loop()
+        try:
+            out = await loop.run_in_executor(
+                self._executor, _run_batch, np.stack(group.blocks),
+                np.frombuffer(key, dtype=np.uint8), decrypt, self.engine)
+        except Exception as e:
+            for future in group.futures:
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            for future, block in zip(group.futures, out):
+                if not future.done():
+                    future.set_result(block)
+        finally:
+            now = time.perf_counter()
+            self.metrics._finished([now - t for t in group.times])
+
+    async def close(self):
+        """Run any queued requests, wait for all batches and stop the pool"""
+        self._closed = True
+        for group_key in list(self._groups):
+            self._flush(group_key)
+        if self._tasks:
+            await asyncio.gather(*self._tasks)
+        if self._own_executor:
+            self._executor.shutdown()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+
+def _request(batcher, line):
+    """The response to a request line: a string, a function returning
+    one, or a future of a block"""
+    parts = line.split()
+    try:
+        if parts == ['stats']:
+            return lambda: json.dumps(batcher.metrics.as_dict(),
+                                      sort_keys=True)
+        if len(parts) == 3 and parts[0] in ('e', 'd'):
+            key, block = (bytearray.fromhex(x) for x in parts[1:])
+            return batcher.submit(block, key, decrypt=parts[0] == 'd')
+        raise ValueError("Invalid request: %r" % (line.strip(),))
+    except ValueError as e:
+        return 'error %s' % (e,)
+
+
+async def _handle(batcher, reader, writer):
+    responses = asyncio.Queue()
+
+    async def respond():
+        while True:
+            response = await responses.get()
+            if response is None:
+                return
+            if callable(response):
+                response = response()
+            elif not isinstance(response, str):
+                try:
+                    response = bytes(await response).hex()
+                except Exception as e:
+                    response = 'error %s' % (e,)
+            writer.write(response.encode('ascii') + b'\n')
+            if responses.empty():
+                await writer.drain()
+
+    responder = asyncio.ensure_future(respond())
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            line = line.decode('ascii', 'replace')
+            if line.strip():
+                responses.put_nowait(_request(batcher, line))
+        responses.put_nowait(None)
+        await responder
+    finally:
+        responder.cancel()
+        writer.close()
+
+
+async def start_server(batcher, host=None, port=None, path=None):
+    """Start serving a Batcher over TCP, or a Unix socket if path is given
+
+    Returns:
+        The asyncio Server
+    """
+    async def handle(reader, writer):
+        await _handle(batcher, reader, writer)
+
+    if path is not None:
+        return await asyncio.start_unix_server(handle, path)
+    return await asyncio.start_server(handle, host, port)
+
+
+async def serve(batcher, host=None, port=None, path=None):
+    """Serve a Batcher until cancelled"""
+    server = await start_server(batcher, host, port, path)
+    async with server:
+        await server.serve_forever()
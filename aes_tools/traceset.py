@@ -0,0 +1,208 @@
+"""Binary trace-set container
+
+A trace set is a small fixed-size header followed by fixed-width records:
+
+    plaintext   16 bytes
+    ciphertext  16 bytes
+    key         key_len bytes (optional, 16, 24 or 32)
+    samples     n_samples values of a configurable dtype (optional)
+
+Header (little-endian, HEADER_SIZE bytes, zero padded):
+
+    magic       8 bytes, MAGIC
+    version     uint16
+    key_len     uint16
+    n_samples   uint32
+    dtype       16 bytes, NumPy dtype string, e.g. '<f4'
+
+The record count is implied by the file size, so records can be appended
+while other readers have the file open. Readers get NumPy views backed by
+np.memmap, without per-record copies.
+"""
+from __future__ import division
+
+import os
+import struct
+
+import numpy as np
+
+
+MAGIC = b'AESTRSET'
+VERSION = 1
+HEADER_SIZE = 64
+
+_HEADER = struct.Struct('<8sHHI16s')
+
+
+def record_dtype(key_len=0, n_samples=0, dtype='<f4'):
+    """The structured dtype of a record"""
+    if key_len not in (0, 16, 24, 32):
+        raise ValueError("Invalid key length: %d" % (key_len,))
+    fields = [('plaintext', 'u1', (16,)), ('ciphertext', 'u1', (16,))]
+    if key_len:
+        fields.append(('key', 'u1', (key_len,)))
+    if n_samples:
+        fields.append(('samples', np.dtype(dtype), (n_samples,)))
+    return np.dtype(fields)
+
+
+class TraceSet:
+    """A trace set file
+
+    Attributes:
+        path: File path
+        key_len: Key bytes per record, 0 if keys are not stored
+        n_samples: Samples per record, 0 if samples are not stored
+        sample_dtype: NumPy dtype of the samples
+        dtype: Structured record dtype
+    """
+
+    def __init__(self, path, mode='r'):
+        """Open an existing trace set
+
+        Args:
+            mode: 'r' for read-only views, 'r+' for writable views
+        """
+        if mode not in ('r', 'r+'):
+            raise ValueError("Invalid mode: %r" % (mode,))
+        self.path = path
+        self.mode = mode
+
+        with open(path, 'rb') as f:
+            header = f.read(HEADER_SIZE)
+        if len(header) != HEADER_SIZE:
+            raise ValueError("Truncated trace set header")
+
+        magic, version, key_len, n_samples, dtype = _HEADER.unpack_from(
+            header)
+        if magic != MAGIC:
+            raise ValueError("Not a trace set: %r" % (path,))
+        if version != VERSION:
+            raise ValueError("Unsupported trace set version: %d" % (version,))
+
+        self.key_len = key_len
+        self.n_samples = n_samples
+        self.sample_dtype = np.dtype(dtype.rstrip(b'\0').decode('ascii'))
+        self.dtype = record_dtype(key_len, n_samples, self.sample_dtype)
+        self._records = None
+
+    @classmethod
+    def create(cls, path, n_samples=0, dtype='<f4', key_len=0):
+        """Create an empty trace set, replacing any existing file"""
+        dtype = np.dtype(dtype)
+        record_dtype(key_len, n_samples, dtype)
+
+        header = _HEADER.pack(MAGIC, VERSION, key_len, n_samples,
+                              dtype.str.encode('ascii'))
+        with open(path, 'wb') as f:
+            f.write(header.ljust(HEADER_SIZE, b'\0'))
+
+        return cls(path, 'r+')
+
+    def __len__(self):
+        size = os.path.getsize(self.path) - HEADER_SIZE
+        return max(size, 0) // self.dtype.itemsize
+
+    @property
+    def records(self):
+        """All complete records, as a structured array backed by np.memmap
+
+        The map is refreshed when records have been appended.
+        """
+        n = len(self)
+        if self._records is None or len(self._records) != n:
+            if n:
+                self._records = np.memmap(self.path, self.dtype, self.mode,
+                                          HEADER_SIZE, (n,))
+            else:
+                self._records = np.zeros(0, self.dtype)
+        return self._records
+
+    @property
+    def plaintext(self):
+        return self.records['plaintext']
+
+    @property
+    def ciphertext(self):
+        return self.records['ciphertext']
+
+    @property
+    def key(self):
+        return self.records['key'] if self.key_len else None
+
+    @property
+    def samples(self):
+        return self.records['samples'] if self.n_samples else None
+
+    def __getitem__(self, i):
+        return self.records[i]
+
+    def chunks(self, size):
+        """Yield views of consecutive runs of at most size records"""
+        records = self.records
+        for start in range(0, len(records), size):
+            yield records[start:start + size]
+
+    def append(self, plaintext, ciphertext, key=None, samples=None):
+        """Append records to the end of the file
+
+        Args:
+            plaintext: (N, 16) array
+            ciphertext: (N, 16) array
+            key: (N, key_len) array, or a single key for all records
+            samples: (N, n_samples) array
+
+        Returns:
+            Number of records in the trace set
+        """
+        ciphertext = np.asarray(ciphertext, dtype=np.uint8).reshape(-1, 16)
+        records = np.zeros(len(ciphertext), self.dtype)
+        records['plaintext'] = plaintext
+        records['ciphertext'] = ciphertext
+        if self.key_len:
+            if key is None:
+                raise ValueError("Trace set requires keys")
+            records['key'] = key
+        if self.n_samples:
+            if samples is None:
+                raise ValueError("Trace set requires samples")
+            records['samples'] = samples
+
+        with open(self.path, 'ab') as f:
+            # Drop any partially written record before appending
+            f.truncate(HEADER_SIZE + len(self) * self.dtype.itemsize)
+            f.write(records.tobytes())
+
+        return len(self)
+
+    def to_hex(self, f, field='ciphertext'):
+        """Write one 16-byte field per line as hex, e.g. for the dfa command
+        """
+        for chunk in self.chunks(1 << 16):
+            for block in chunk[field]:
+                f.write(block.tobytes().hex())
+                f.write('\n')
+
+    @classmethod
+    def from_hex(cls, f, path, field='ciphertext', chunk_size=1 << 16):
+        """Create a trace set from a hex-line file, as read by the dfa command
+
+        Lines that are not 16-byte hex strings are skipped. Each block is
+        stored in the given field; the other fields are zero.
+        """
+        from .dfa import iter_hex
+
+        ts = cls.create(path)
+        # About chunk_size lines of 32 digits and a newline at a time
+        for blocks in iter_hex(f, chunk_size * 33):
+            if len(blocks):
+                ts._append_field(field, blocks)
+        return ts
+
+    def _append_field(self, field, blocks):
+        blocks = np.array(blocks, dtype=np.uint8)
+        zeros = np.zeros_like(blocks)
+        if field == 'plaintext':
+            self.append(blocks, zeros)
+        else:
+            self.append(zeros, blocks)
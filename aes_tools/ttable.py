@@ -0,0 +1,132 @@
+"""T-table AES engine
+
+SubBytes, ShiftRows and MixColumns are merged into four 256-entry tables of
+32-bit words, so each inner round is 16 lookups and XORs on whole columns.
+Decryption uses the equivalent inverse cipher (FIPS-197 5.3.5), with
+InvMixColumns applied to the middle round keys.
+
+Columns are packed big-endian: row 0 is the most significant byte.
+"""
+from __future__ import division
+
+import numpy as np
+
+from . import ops
+from .constants import SBOX, SBOX_INV
+from .constants import SHIFT_ROWS, SHIFT_ROWS_INV
+
+
+def _tables(sbox, mix):
+    """Build the four rotated tables for an S-box and MixColumns function
+
+    Table i holds the mixed column produced by an S-box output in row i.
+    """
+    col = np.zeros((256, 16), dtype=np.uint8)
+    col[:, 0] = sbox
+    col = mix(col)[:, :4]
+    t0 = col.copy().view('>u4').reshape(256).astype(np.uint32)
+    return (
+        t0,
+        (t0 >> 8) | (t0 << 24),
+        (t0 >> 16) | (t0 << 16),
+        (t0 >> 24) | (t0 << 8),
+    )
+
+
+TE0, TE1, TE2, TE3 = _tables(SBOX, ops.mix_columns_batch)
+TD0, TD1, TD2, TD3 = _tables(SBOX_INV, ops.mix_columns_inv_batch)
+
+
+def _to_words(blocks):
+    """(..., 16) bytes to (..., 4) big-endian column words"""
+    blocks = np.ascontiguousarray(blocks, dtype=np.uint8)
+    return blocks.view('>u4').astype(np.uint32)
+
+
+def _to_bytes(words):
+    """(..., 4) column words to (..., 16) bytes"""
+    return words.astype('>u4').view(np.uint8)
+
+
+def inverse_round_keys(rk, Nr=10):
+    """Round keys for the equivalent inverse cipher
+
+    Args:
+        rk: (..., Nr + 1, 16) flattened encryption round keys
+
+    Returns:
+        (..., Nr + 1, 16) decryption round keys, in the order they are
+        applied
+    """
+    dk = np.empty_like(rk)
+    dk[..., 0, :] = rk[..., Nr, :]
+    dk[..., 1:Nr, :] = ops.mix_columns_inv_batch(rk[..., Nr - 1:0:-1, :])
+    dk[..., Nr, :] = rk[..., 0, :]
+    return dk
+
+
+def encrypt_blocks(blocks, rk, Nr=10):
+    """Encrypt an (N, 16) array of blocks with the given round keys.
+
+    Args:
+        blocks: (N, 16) uint8 array
+        rk: (Nr + 1, 16) flattened round keys, or (N, Nr + 1, 16) for a
+            different key per block
+        Nr: Number of cipher rounds
+    """
+    w = _to_words(rk)
+    s = _to_words(blocks) ^ w[..., 0, :]
+
+    for r in range(1, Nr):
+        s0, s1, s2, s3 = s[..., 0], s[..., 1], s[..., 2], s[..., 3]
+        s = np.stack((
+            TE0[s0 >> 24] ^ TE1[(s1 >> 16) & 0xff] ^
+            TE2[(s2 >> 8) & 0xff] ^ TE3[s3 & 0xff],
+            TE0[s1 >> 24] ^ TE1[(s2 >> 16) & 0xff] ^
+            TE2[(s3 >> 8) & 0xff] ^ TE3[s0 & 0xff],
+            TE0[s2 >> 24] ^ TE1[(s3 >> 16) & 0xff] ^
+            TE2[(s0 >> 8) & 0xff] ^ TE3[s1 & 0xff],
+            TE0[s3 >> 24] ^ TE1[(s0 >> 16) & 0xff] ^
+            TE2[(s1 >> 8) & 0xff] ^ TE3[s2 & 0xff],
+        ), axis=-1)
+        s ^= w[..., r, :]
+
+    state = SBOX[_to_bytes(s)[..., SHIFT_ROWS]]
+    state ^= rk[..., Nr, :]
+
+    return state
+
+
+def decrypt_blocks(blocks, rk, Nr=10, dk=None):
+    """Decrypt an (N, 16) array of blocks with the given round keys.
+
+    Args:
+        blocks: (N, 16) uint8 array
+        rk: (Nr + 1, 16) flattened round keys
+        Nr: Number of cipher rounds
+        dk: Optional precomputed inverse_round_keys(rk, Nr)
+    """
+    if dk is None:
+        dk = inverse_round_keys(rk, Nr)
+
+    w = _to_words(dk)
+    s = _to_words(blocks) ^ w[..., 0, :]
+
+    for r in range(1, Nr):
+        s0, s1, s2, s3 = s[..., 0], s[..., 1], s[..., 2], s[..., 3]
+        s = np.stack((
+            TD0[s0 >> 24] ^ TD1[(s3 >> 16) & 0xff] ^
+            TD2[(s2 >> 8) & 0xff] ^ TD3[s1 & 0xff],
+            TD0[s1 >> 24] ^ TD1[(s0 >> 16) & 0xff] ^
+            TD2[(s3 >> 8) & 0xff] ^ TD3[s2 & 0xff],
+            TD0[s2 >> 24] ^ TD1[(s1 >> 16) & 0xff] ^
+            TD2[(s0 >> 8) & 0xff] ^ TD3[s3 & 0xff],
+            TD0[s3 >> 24] ^ TD1[(s2 >> 16) & 0xff] ^
+            TD2[(s1 >> 8) & 0xff] ^ TD3[s0 & 0xff],
+        ), axis=-1)
+        s ^= w[..., r, :]
+
+    state = SBOX_INV[_to_bytes(s)[..., SHIFT_ROWS_INV]]
+    state ^= dk[..., Nr, :]
+
+    return state
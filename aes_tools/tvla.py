@@ -0,0 +1,249 @@
+"""Test vector leakage assessment (TVLA)
+
+Welch's t-test between two groups of traces, at first and higher orders.
+Order 1 compares the means; order 2 the variances, i.e. the means of the
+squared centered traces; order d > 2 the means of the standardized traces
+raised to the power d.
+
+Traces are partitioned by the cipher model:
+
+    fixed       fixed (group 0) vs random (group 1) plaintexts
+    sbox_bit    one bit of a round 1 S-box output byte
+    last_hd     Hamming distance between a last round input byte and the
+                ciphertext byte that overwrites it: < 4 (group 0) vs > 4
+                (group 1); traces with a distance of 4 are left out
+
+Each group's central moment sums are accumulated one chunk at a time:
+a chunk's sums are taken around its own mean and merged with the pairwise
+formulas of Pebay (2008). Memory depends only on the number of samples
+and the order, and results from worker processes can be merged.
+"""
+from __future__ import division
+
+import concurrent.futures
+import math
+
+import numpy as np
+
+from . import cipher
+from . import ops
+from .constants import HW
+from .traceset import TraceSet
+
+
+TESTS = ('fixed', 'sbox_bit', 'last_hd')
+
+# Conventional pass/fail threshold on |t|
+THRESHOLD = 4.5
+
+DEFAULT_CHUNK_SIZE = 1 << 14
+
+
+class TTest:
+    """Running two-group t-test over chunks of traces
+
+    Attributes:
+        n_samples: Samples per trace
+        order: Highest order tested
+        n: Number of traces in each group
+    """
+
+    def __init__(self, n_samples, order=1):
+        if order < 1:
+            raise ValueError("Invalid order: %d" % (order,))
+        self.n_samples = n_samples
+        self.order = order
+
+        self.n = np.zeros(2, dtype=np.int64)
+        self._mean = np.zeros((2, n_samples))
+        # _m[g, p] is the sum of (x - mean) ** p; p < 2 is unused
+        self._m = np.zeros((2, 2 * order + 1, n_samples))
+
+    def update(self, traces, groups):
+        """Add a chunk of traces
+
+        Args:
+            traces: (N, n_samples) array
+            groups: (N,) group of each trace, 0 or 1; others are ignored
+        """
+        t = np.asarray(traces, dtype=np.float64)
+        if t.ndim != 2 or t.shape[1] != self.n_samples:
+            raise ValueError("Invalid trace array shape: %s" % (t.shape,))
+        groups = np.asarray(groups)
+        if groups.shape != (len(t),):
+            raise ValueError("Trace and group counts differ: %d != %d" %
+                             (len(t), groups.size))
+
+        for g in (0, 1):
+            x = t[groups == g]
+            if not len(x):
+                continue
+            mean = x.mean(axis=0)
+            d = x - mean
+            m = np.zeros_like(self._m[g])
+            power = d
+            for p in range(2, 2 * self.order + 1):
+                power = power * d
+                m[p] = power.sum(axis=0)
+            self._merge(g, len(x), mean, m)
+
+    def merge(self, other):
+        """Combine the sums of another TTest, e.g. from a worker process"""
+        if (other.n_samples, other.order) != (self.n_samples, self.order):
+            raise ValueError("Incompatible TTest")
+        for g in (0, 1):
+            if other.n[g]:
+                self._merge(g, other.n[g], other._mean[g], other._m[g])
+
+    def _merge(self, g, n_b, mean_b, m_b):
+        n_a = self.n[g]
+        if not n_a:
+            self.n[g] = n_b
+            self._mean[g] = mean_b
+            self._m[g] = m_b
+            return
+
+        n = n_a + n_b
+        m_a = self._m[g]
+        delta = mean_b - self._mean[g]
+
+        m = m_a + m_b
+        for p in range(2, m.shape[0]):
+            for k in range(1, p - 1):
+                m[p] += math.comb(p, k) * delta ** k * (
+                    (-n_b / n) ** k * m_a[p - k] + (n_a / n) ** k * m_b[p - k])
+            m[p] += (n_a * n_b / n * delta) ** p * (
+                1 / n_b ** (p - 1) - (-1 / n_a) ** (p - 1))
+
+        self._mean[g] += delta * (n_b / n)
+        self._m[g] = m
+        self.n[g] = n
+
+    def _moments(self, d):
+        """Mean and variance of the order d preprocessed traces, per group"""
+        n = self.n[:, None]
+        cm = self._m / n[:, None]
+        if d == 1:
+            return self._mean, cm[:, 2]
+        if d == 2:
+            return cm[:, 2], cm[:, 4] - cm[:, 2] ** 2
+        var = cm[:, 2]
+        return (cm[:, d] / var ** (d / 2),
+                (cm[:, 2 * d] - cm[:, d] ** 2) / var ** d)
+
+    def t(self):
+        """Welch's t-statistics of orders 1 to order
+
+        Returns:
+            (order, n_samples) array; 0 where undefined
+        """
+        result = np.zeros((self.order, self.n_samples))
+        if not self.n.all():
+            return result
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for d in range(1, self.order + 1):
+                mean, var = self._moments(d)
+                t = (mean[0] - mean[1]) / np.sqrt(
+                    var[0] / self.n[0] + var[1] / self.n[1])
+                result[d - 1] = np.nan_to_num(t, posinf=0, neginf=0)
+        return result
+
+    def leaks(self, threshold=THRESHOLD):
+        """Samples whose |t| exceeds the threshold, (order, n_samples)"""
+        return np.abs(self.t()) > threshold
+
+
+def _round_keys(records, key):
+    """Round keys for a chunk of records: shared, or from the key field"""
+    if key is not None:
+        return cipher.key_cache.get(np.asarray(key, dtype=np.uint8)).rk
+    if 'key' not in records.dtype.names:
+        raise ValueError("A key is required unless the trace set stores keys")
+    keys = records['key']
+    Nr = cipher.KEY_LEN_TO_ROUNDS[keys.shape[-1]]
+    return ops.key_expansion_batch(keys, Nr).reshape(len(keys), Nr + 1, 16)
+
+
+def partition(records, test, key=None, fixed=None, byte=0, bit=0):
+    """Group labels of a chunk of trace set records
+
+    Args:
+        records: Structured records, as from TraceSet
+        test: Partition, from TESTS
+        key: Cipher key; by default the records' key field
+        fixed: The fixed plaintext, for the 'fixed' test
+        byte: State byte index, for the 'sbox_bit' and 'last_hd' tests
+        bit: Bit index, for the 'sbox_bit' test
+
+    Returns:
+        (N,) int8 array of groups, -1 for traces left out
+    """
+    plaintext = records['plaintext']
+    ciphertext = records['ciphertext']
+
+    if test == 'fixed':
+        if fixed is None:
+            raise ValueError("The fixed test requires the fixed plaintext")
+        fixed = np.asarray(fixed, dtype=np.uint8)
+        return (plaintext != fixed).any(axis=-1).astype(np.int8)
+
+    if test == 'sbox_bit':
+        rk = _round_keys(records, key)
+        state = cipher.evaluate(plaintext, rk, (0, 'input'), (1, 's_box'))
+        return ((state[:, byte] >> bit) & 1).astype(np.int8)
+
+    if test == 'last_hd':
+        rk = _round_keys(records, key)
+        Nr = rk.shape[-2] - 1
+        state = cipher.evaluate(ciphertext, rk, (Nr, 'add_k'), (Nr, 'input'))
+        hd = HW[state[:, byte] ^ ciphertext[:, byte]].astype(np.int8)
+        return np.where(hd < 4, 0, np.where(hd > 4, 1, -1)).astype(np.int8)
+
+    raise ValueError("Invalid test: %r" % (test,))
+
+
+def _assess_range(job):
+    """t-test over a range of records of a trace set; runs in a worker"""
+    path, start, stop, order, chunk_size, params = job
+    ts = TraceSet(path)
+    if not ts.n_samples:
+        raise ValueError("Trace set has no samples")
+    result = TTest(ts.n_samples, order)
+    records = ts.records
+    for i in range(start, stop, chunk_size):
+        chunk = records[i:min(i + chunk_size, stop)]
+        result.update(chunk['samples'], partition(chunk, **params))
+    return result
+
+
+def assess(path, test, order=1, key=None, fixed=None, byte=0, bit=0,
+           workers=1, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Run a t-test over a trace set file
+
+    With more than one worker, ranges of records are tested in a process
+    pool and the results merged.
+
+    Args:
+        path: Trace set path
+        Others: As for TTest and partition()
+
+    Returns:
+        The TTest object
+    """
+    ts = TraceSet(path)
+    params = {'test': test, 'key': key, 'fixed': fixed, 'byte': byte,
+              'bit': bit}
+    n = len(ts)
+    step = -(-n // max(workers, 1)) if n else 1
+    jobs = [(path, start, min(start + step, n), order, chunk_size, params)
+            for start in range(0, n, step)]
+
+    result = TTest(ts.n_samples, order)
+    if workers > 1:
+        with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+            for part in executor.map(_assess_range, jobs):
+                result.merge(part)
+    else:
+        for job in jobs:
+            result.merge(_assess_range(job))
+    return result
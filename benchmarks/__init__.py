@@ -0,0 +1,116 @@
+"""Performance benchmarks
+
+Run a benchmark module from the repository root, e.g.:
+
+    python3 -m benchmarks.cipher
+
+Each module exposes run(), returning a list of result dicts, main(), which
+prints them, and QUICK, reduced run() arguments for a fast pass.
+
+Run the whole suite, save the results as JSON and compare them against a
+baseline with:
+
+    python3 -m benchmarks --json results.json --baseline baseline.json
+
+Timings depend on the machine and vary with its load, so no baseline is
+kept in the repository: save one with --json from the release being
+compared against, on the same machine, shortly before comparing.
+
+Each case is timed as the fastest of several short runs, and a result only
+counts as a regression if it is slower by both the relative threshold and
+an absolute time per call, as the shortest cases vary by more than the
+threshold between runs.
+"""
+import json
+import platform
+import timeit
+
+
+REPEAT = 9
+
+# Seconds, the least time of each timed run
+MIN_TIME = 0.02
+
+# Seconds per call, the least slowdown counted as a regression
+MIN_DELTA = 50e-6
+
+
+def per_call(fn, repeat=REPEAT, min_time=MIN_TIME):
+    """Best-of-repeat wall time of a single fn() call, in seconds
+
+    Each run makes enough calls to take at least min_time.
+    """
+    timer = timeit.Timer(fn)
+    number = 1
+    while True:
+        t = timer.timeit(number)
+        if t >= min_time:
+            break
+        number = max(number * 2, int(number * min_time / max(t, 1e-9)))
+    return min([t] + timer.repeat(repeat - 1, number)) / number
+
+
+def result(name, seconds, items=1, **params):
+    """A benchmark result, with the cost per item"""
+    return {
+        'name': name,
+        'params': params,
+        'seconds': seconds,
+        'per_item': seconds / items,
+    }
+
+
+def report(results, unit='block'):
+    for r in results:
+        params = ' '.join('%s=%s' % kv for kv in sorted(r['params'].items()))
+        print('%-24s %-36s %10.3f us/%s  %12.0f %ss/s' % (
+            r['name'], params, r['per_item'] * 1e6, unit,
+            1 / r['per_item'], unit))
+
+
+def _key(r):
+    return (r['benchmark'], r['name'], tuple(sorted(r['params'].items())))
+
+
+def dump(results, path):
+    """Save results as JSON, with the library and platform versions"""
+    import numpy as np
+    from aes_tools import __version__
+
+    document = {
+        'aes_tools': __version__,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'results': results,
+    }
+    with open(path, 'w') as f:
+        json.dump(document, f, indent=1, sort_keys=True)
+
+
+def load(path):
+    """Results saved by dump()"""
+    with open(path) as f:
+        return json.load(f)['results']
+
+
+def compare(results, baseline, threshold=0.25, min_delta=MIN_DELTA):
+    """Match results to a baseline by benchmark, name and parameters
+
+    Returns:
+        (result, baseline result, ratio, regressed) tuples, where ratio is
+        the per-item time over the baseline's, and regressed is True if it
+        exceeds 1 + threshold and the time per call grew by more than
+        min_delta seconds
+    """
+    base = {_key(r): r for r in baseline}
+    rows = []
+    for r in results:
+        b = base.get(_key(r), None)
+        if b is None:
+            continue
+        ratio = r['per_item'] / b['per_item']
+        regressed = (ratio > 1 + threshold and
+                     r['seconds'] - b['seconds'] > min_delta)
+        rows.append((r, b, ratio, regressed))
+    return rows
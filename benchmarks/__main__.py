@@ -0,0 +1,66 @@
+"""Run the benchmark suite
+
+    python3 -m benchmarks [MODULE ...] [--quick] [--json PATH]
+        [--baseline PATH] [--threshold FRACTION] [--min-delta SECONDS]
+
+Exits with status 1 if any result is slower than the baseline by more than
+the threshold, and by more than min-delta seconds per call.
+"""
+import importlib
+import sys
+
+import click
+
+from . import MIN_DELTA, compare, dump, load, report
+
+
+MODULES = ('ops', 'cipher', 'gcm', 'service', 'keyrank', 'dfa', 'startup')
+
+
+@click.command('benchmarks')
+@click.argument('modules', nargs=-1, type=click.Choice(MODULES))
+@click.option('--quick', is_flag=True, help='Fewer and smaller cases')
+@click.option('--json', 'json_path', type=click.Path(dir_okay=False),
+              help='Save the results as JSON')
+@click.option('--baseline', type=click.Path(exists=True, dir_okay=False),
+              help='JSON results to compare against')
+@click.option('--threshold', type=float, default=0.25, show_default=True,
+              help='Allowed slowdown over the baseline, as a fraction')
+@click.option('--min-delta', type=float, default=MIN_DELTA,
+              show_default=True,
+              help='Slowdowns of less than this many seconds per call are '
+                   'not regressions')
+def main(modules, quick, json_path, baseline, threshold, min_delta):
+    results = []
+    for name in modules or MODULES:
+        module = importlib.import_module('.' + name, __package__)
+        print('# %s' % (name,))
+        module_results = module.run(**(module.QUICK if quick else {}))
+        for r in module_results:
+            r['benchmark'] = name
+        report(module_results, unit='item')
+        results += module_results
+
+    if json_path is not None:
+        dump(results, json_path)
+
+    if baseline is not None:
+        rows = compare(results, load(baseline), threshold, min_delta)
+        regressions = [row for row in rows if row[3]]
+        print('\n# Compared %d results with %s' % (len(rows), baseline))
+        for r, b, ratio, _ in regressions:
+            params = ' '.join('%s=%s' % kv
+                              for kv in sorted(r['params'].items()))
+            print('REGRESSION %-8s %-24s %-36s %10.3f us -> %10.3f us '
+                  '(x%.2f)' % (r['benchmark'], r['name'], params,
+                               b['per_item'] * 1e6, r['per_item'] * 1e6,
+                               ratio))
+        if regressions:
+            print('%d regressions over %.0f%%' % (len(regressions),
+                                                   threshold * 100))
+            sys.exit(1)
+        print('No regressions over %.0f%%' % (threshold * 100,))
+
+
+if __name__ == '__main__':
+    main()
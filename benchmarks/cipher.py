@@ -0,0 +1,72 @@
+"""Per-block cost of the cipher engines, single-block and batched
+
+Each engine is timed for each key size. The per_key rows encrypt a batch
+with a different key per block, as in key search. The encrypt_block and
+decrypt_block rows are the single-block latency of AES.encrypt_block() on
+bytes, against the encrypt and decrypt rows of each engine.
+"""
+import numpy as np
+
+from aes_tools import cipher
+from aes_tools import ops
+
+from . import per_call, result, report
+
+
+BATCH_SIZES = (1, 100, 10000)
+KEY_SIZES = (16, 24, 32)
+
+QUICK = {'batch_sizes': (1, 1000), 'key_sizes': (16,)}
+
+
+def run(batch_sizes=BATCH_SIZES, key_sizes=KEY_SIZES):
+    rng = np.random.RandomState(0)
+    block = rng.randint(0, 256, 16).astype(np.uint8)
+    results = []
+
+    for engine in sorted(cipher.ENGINES):
+        for key_len in key_sizes:
+            key = rng.randint(0, 256, key_len).astype(np.uint8)
+            Nr = cipher.KEY_LEN_TO_ROUNDS[key_len]
+            bits = key_len * 8
+
+            for name, fn in (('encrypt', cipher.encrypt),
+                             ('decrypt', cipher.decrypt)):
+                t = per_call(lambda: fn(block, key, engine))
+                results.append(result(name, t, engine=engine, bits=bits))
+
+            for n in batch_sizes:
+                blocks = rng.randint(0, 256, (n, 16)).astype(np.uint8)
+                for name, fn in (('encrypt_batch', cipher.encrypt_batch),
+                                 ('decrypt_batch', cipher.decrypt_batch)):
+                    t = per_call(lambda: fn(blocks, key, engine))
+                    results.append(result(name, t, n, engine=engine,
+                                          bits=bits, n=n))
+
+            n = batch_sizes[-1]
+            blocks = rng.randint(0, 256, (n, 16)).astype(np.uint8)
+            keys = rng.randint(0, 256, (n, key_len)).astype(np.uint8)
+            rk = ops.key_expansion_batch(keys, Nr).reshape(n, Nr + 1, 16)
+            encrypt_fn = cipher.ENGINES[engine][0]
+            t = per_call(lambda: encrypt_fn(blocks, rk, Nr))
+            results.append(result('encrypt_per_key', t, n, engine=engine,
+                                  bits=bits, n=n))
+
+    for key_len in key_sizes:
+        aes = cipher.AES(rng.randint(0, 256, key_len).astype(np.uint8))
+        data = block.tobytes()
+        for name, fn in (('encrypt_block', aes.encrypt_block),
+                         ('decrypt_block', aes.decrypt_block)):
+            t = per_call(lambda: fn(data))
+            results.append(result(name, t, engine='scalar',
+                                  bits=key_len * 8))
+
+    return results
+
+
+def main():
+    report(run())
+
+
+if __name__ == '__main__':
+    main()
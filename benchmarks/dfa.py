@@ -0,0 +1,49 @@
+"""dfa.stream() on simulated fault logs
+
+Logs hold one reference and n faulty ciphertexts from round 9 byte faults
+(see aes_tools.faultsim), as hex lines. Timing covers parsing, solving and
+key derivation.
+"""
+import io
+
+import numpy as np
+
+from aes_tools import dfa
+from aes_tools import faultsim
+
+from . import per_call, result, report
+
+
+KEY = np.arange(16, dtype=np.uint8)
+PLAINTEXT = np.arange(16, dtype=np.uint8)[::-1].copy()
+LOG_SIZES = (100, 1000, 100000)
+
+QUICK = {'log_sizes': (100, 1000)}
+
+
+def fault_log(n, seed=0):
+    """A hex fault log of n faulty ciphertexts, as a list of lines"""
+    f = io.StringIO()
+    last = None
+    for _, ref, faulty in faultsim.simulate(n, KEY, PLAINTEXT, seed=seed):
+        last = faultsim.write_hex(f, ref, faulty, last)
+    return f.getvalue().splitlines(True)
+
+
+def run(log_sizes=LOG_SIZES):
+    results = []
+    for n in log_sizes:
+        lines = fault_log(n)
+        if dfa.stream(lines).tolist() != KEY.tolist():
+            raise RuntimeError("DFA did not recover the key")
+        t = per_call(lambda: dfa.stream(lines))
+        results.append(result('stream', t, n, n=n))
+    return results
+
+
+def main():
+    report(run(), unit='line')
+
+
+if __name__ == '__main__':
+    main()
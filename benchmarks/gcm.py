@@ -0,0 +1,65 @@
+"""AES-GCM throughput
+
+Results are per byte, so that 1 / per_item is the throughput; main() prints
+it in MB/s. The ghash rows time GHASH alone, over whole blocks, with the
+tables already built; the setup rows time a new key, including the tables.
+"""
+import numpy as np
+
+from aes_tools import cipher
+from aes_tools import gcm
+
+from . import per_call, result
+
+
+SIZES = (1 << 10, 1 << 16, 1 << 20)
+KEY_SIZES = (16, 24, 32)
+
+QUICK = {'sizes': (1 << 10, 1 << 16), 'key_sizes': (16,)}
+
+
+def run(sizes=SIZES, key_sizes=KEY_SIZES):
+    rng = np.random.RandomState(0)
+    iv = rng.randint(0, 256, 12).astype(np.uint8)
+    aad = rng.randint(0, 256, 20).astype(np.uint8)
+    results = []
+
+    for key_len in key_sizes:
+        key = rng.randint(0, 256, key_len).astype(np.uint8)
+        aes = cipher.AES(key)
+        ghash = gcm.hash_key(aes)
+        bits = key_len * 8
+
+        for size in sizes:
+            data = rng.randint(0, 256, size).astype(np.uint8)
+            ciphertext, tag = gcm.encrypt(data, aes, iv, aad)
+
+            t = per_call(lambda: gcm.encrypt(data, aes, iv, aad))
+            results.append(result('encrypt', t, size, bits=bits, size=size))
+            t = per_call(lambda: gcm.decrypt(ciphertext, aes, iv, tag, aad))
+            results.append(result('decrypt', t, size, bits=bits, size=size))
+
+            if key_len == key_sizes[0]:
+                blocks = data.reshape(-1, 16)
+                y = np.zeros(16, dtype=np.uint8)
+                t = per_call(lambda: ghash.update(y, blocks))
+                results.append(result('ghash', t, size, size=size))
+
+    key = rng.randint(0, 256, 16).astype(np.uint8)
+    t = per_call(lambda: gcm.hash_key(cipher.AES(key)))
+    results.append(result('setup', t, bits=128))
+
+    return results
+
+
+def main():
+    for r in run():
+        params = ' '.join('%s=%s' % kv for kv in sorted(r['params'].items()))
+        rate = ('%10.2f MB/s' % (1e-6 / r['per_item'],)
+                if 'size' in r['params'] else '')
+        print('%-24s %-36s %10.3f ms  %s' % (
+            r['name'], params, r['seconds'] * 1e3, rate))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+"""Key rank estimation time per call, and key enumeration rate
+
+Score tables are synthetic: Gaussian log-likelihoods with the true key
+byte shifted up by a signal level, from ranks near 2^128 down to 1.
+"""
+import numpy as np
+
+from aes_tools import keyrank
+
+from . import per_call, result, report
+
+
+BINS = (256, 512, 1024, 2048)
+SIGNALS = (0.5, 2.0, 8.0)
+ENUMERATE = 10000
+
+QUICK = {'bins': (256, 512), 'signals': (2.0,)}
+
+
+def _scores(rng, signal):
+    key = rng.integers(0, 256, 16)
+    scores = rng.normal(0, 1, (16, 256))
+    scores[np.arange(16), key] += signal
+    return scores, key
+
+
+def run(bins=BINS, signals=SIGNALS):
+    rng = np.random.default_rng(0)
+    results = []
+
+    for signal in signals:
+        scores, key = _scores(rng, signal)
+        for n in bins:
+            t = per_call(lambda: keyrank.rank(scores, key, 'log', n))
+            results.append(result('rank', t, bins=n, signal=signal))
+
+    scores, _ = _scores(rng, 2.0)
+    t = per_call(lambda: list(keyrank.enumerate_keys(scores, 'log',
+                                                     ENUMERATE)), repeat=1)
+    results.append(result('enumerate_keys', t, ENUMERATE, n=ENUMERATE))
+
+    return results
+
+
+def main():
+    results = run()
+    report([r for r in results if r['name'] == 'rank'], unit='call')
+    report([r for r in results if r['name'] != 'rank'], unit='key')
+
+
+if __name__ == '__main__':
+    main()
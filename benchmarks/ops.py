@@ -0,0 +1,83 @@
+"""Cost of the AES operations and key schedule
+
+The single-state functions work on a (4, 4) state; the batch functions on
+(n, 16) blocks. Key schedule functions are timed per key, for each key
+size, one key per call and in batches.
+"""
+import numpy as np
+
+from aes_tools import cipher
+from aes_tools import ops
+
+from . import per_call, result, report
+
+
+BATCH_SIZES = (1, 100, 10000)
+KEY_SIZES = (16, 24, 32)
+
+QUICK = {'batch_sizes': (1, 100), 'key_sizes': (16,)}
+
+STATE_OPS = (
+    ('sub_bytes', ops.sub_bytes),
+    ('shift_rows', ops.shift_rows),
+    ('mix_columns', ops.mix_columns),
+    ('mix_columns_inv', ops.mix_columns_inv),
+)
+
+BATCH_OPS = (
+    ('sub_bytes_batch', ops.sub_bytes_batch),
+    ('shift_rows_batch', ops.shift_rows_batch),
+    ('mix_columns_batch', ops.mix_columns_batch),
+    ('mix_columns_inv_batch', ops.mix_columns_inv_batch),
+)
+
+
+def run(batch_sizes=BATCH_SIZES, key_sizes=KEY_SIZES):
+    rng = np.random.RandomState(0)
+    results = []
+
+    state = rng.randint(0, 256, (4, 4)).astype(np.uint8)
+    for name, fn in STATE_OPS:
+        results.append(result(name, per_call(lambda: fn(state))))
+
+    for n in batch_sizes:
+        blocks = rng.randint(0, 256, (n, 16)).astype(np.uint8)
+        for name, fn in BATCH_OPS:
+            results.append(result(name, per_call(lambda: fn(blocks)), n, n=n))
+
+    for key_len in key_sizes:
+        Nr = cipher.KEY_LEN_TO_ROUNDS[key_len]
+        Nk = key_len // 4
+        bits = key_len * 8
+        key = rng.randint(0, 256, key_len).astype(np.uint8)
+        w = ops.key_expansion(key, Nr)
+        offset = len(w) - Nk
+        sub_key = w[offset:].reshape(-1)
+
+        t = per_call(lambda: ops.key_expansion(key, Nr))
+        results.append(result('key_expansion', t, bits=bits))
+        t = per_call(lambda: ops.derive_key(sub_key, offset))
+        results.append(result('derive_key', t, bits=bits))
+
+        for n in batch_sizes:
+            keys = rng.randint(0, 256, (n, key_len)).astype(np.uint8)
+            sub_keys = ops.key_expansion_batch(keys, Nr)[:, offset:]
+            sub_keys = sub_keys.reshape(n, key_len)
+            t = per_call(lambda: ops.key_expansion_batch(keys, Nr))
+            results.append(result('key_expansion_batch', t, n, bits=bits,
+                                  n=n))
+            t = per_call(lambda: ops.derive_key_batch(sub_keys, offset))
+            results.append(result('derive_key_batch', t, n, bits=bits, n=n))
+
+    return results
+
+
+def main():
+    results = run()
+    schedule = [r for r in results if 'bits' in r['params']]
+    report([r for r in results if r not in schedule])
+    report(schedule, unit='key')
+
+
+if __name__ == '__main__':
+    main()
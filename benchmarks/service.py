@@ -0,0 +1,58 @@
+"""Per-request cost of the coalescing service
+
+n concurrent single-block requests with one key, through a Batcher, against
+the same blocks encrypted one call at a time.
+"""
+import asyncio
+
+import numpy as np
+
+from aes_tools import cipher
+from aes_tools import modes
+from aes_tools import service
+
+from . import per_call, result, report
+
+
+REQUESTS = (100, 10000)
+MAX_BATCHES = (16, 256)
+
+QUICK = {'requests': (1000,), 'max_batches': (256,)}
+
+
+def _submit_all(blocks, key, max_batch):
+    async def run():
+        async with service.Batcher(max_batch, max_wait=0.001) as batcher:
+            await asyncio.gather(*[batcher.submit(block, key)
+                                   for block in blocks])
+    asyncio.run(run())
+
+
+def run(requests=REQUESTS, max_batches=MAX_BATCHES):
+    rng = np.random.RandomState(0)
+    key = rng.randint(0, 256, 16).astype(np.uint8)
+    results = []
+
+    for n in requests:
+        blocks = rng.randint(0, 256, (n, 16)).astype(np.uint8)
+        for max_batch in max_batches:
+            t = per_call(lambda: _submit_all(blocks, key, max_batch))
+            results.append(result('batched', t, n, max_batch=max_batch, n=n))
+
+    blocks = rng.randint(0, 256, (100, 16)).astype(np.uint8)
+
+    def direct():
+        for block in blocks:
+            cipher.encrypt(block, key, modes.DEFAULT_ENGINE)
+    t = per_call(direct)
+    results.append(result('direct', t, len(blocks)))
+
+    return results
+
+
+def main():
+    report(run(), unit='request')
+
+
+if __name__ == '__main__':
+    main()
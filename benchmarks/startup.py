@@ -0,0 +1,49 @@
+"""Command line startup time
+
+Each command runs in a fresh interpreter, as from a shell pipeline. The
+python case, an empty interpreter, is the floor the others are measured
+against.
+"""
+import os
+import subprocess
+import sys
+import time
+
+from . import result, report
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+COMMANDS = {
+    'python': ('-c', 'pass'),
+    'version': ('-m', 'aes_tools', '--version'),
+    'help': ('-m', 'aes_tools', 'dfa', '--help'),
+    'derive': ('-m', 'aes_tools', 'derive', '--skey',
+               '13111d7fe3944a17f307a78b4d2b30c5', '--offset', '40'),
+}
+REPEAT = 10
+
+QUICK = {'repeat': 3}
+
+
+def _run(args):
+    start = time.perf_counter()
+    subprocess.run((sys.executable,) + args, cwd=ROOT, check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def run(commands=tuple(COMMANDS), repeat=REPEAT):
+    results = []
+    for name in commands:
+        t = min(_run(COMMANDS[name]) for _ in range(repeat))
+        results.append(result('startup', t, command=name))
+    return results
+
+
+def main():
+    report(run(), unit='run')
+
+
+if __name__ == '__main__':
+    main()
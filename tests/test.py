@@ -1,9 +1,27 @@
 from __future__ import division
+import asyncio
+import contextlib
+import io
+import json
+import os
+import tempfile
 import unittest
+import unittest.mock
 import numpy as np
 
-from aes_tools.ops import key_expansion, derive_key
-from aes_tools.cipher import encrypt, decrypt
+from aes_tools import bitslice, bulk, cipher, cpa, dfa, faultsim, keyrank
+from aes_tools import gcm, keysearch, modes
+from aes_tools import profiling, service, tvla
+
+from aes_tools.ops import key_expansion, key_expansion_batch, gmul
+from aes_tools.ops import derive_key, derive_key_batch
+from aes_tools.ops import mix_columns, mix_columns_inv
+from aes_tools.ops import sub_bytes_batch, shift_rows_batch, mix_columns_batch
+from aes_tools.cipher import encrypt, decrypt, encrypt_batch, decrypt_batch
+from aes_tools.cipher import ENGINES, AES, KeyCache, StateTracker
+from aes_tools.cipher import encrypt_explicit, evaluate
+from aes_tools.constants import SHIFT_ROWS_INV
+from aes_tools.traceset import TraceSet
 
 
 class TestAes(unittest.TestCase):
@@ -69,3 +87,1160 @@ class TestAes(unittest.TestCase):
                 k = derive_key(subkey, word_offset)
 
                 self.assertEqual(k.data, kb.data)
+
+            # All offsets at once, one per row
+            offsets = np.arange(key_sched.shape[0] - Nk + 1)
+            subkeys = np.stack([key_sched[o:o + Nk].reshape(-1)
+                                for o in offsets])
+            keys = derive_key_batch(subkeys, offsets)
+            self.assertEqual(keys.tolist(), [kb.tolist()] * len(offsets))
+
+            scheds = derive_key_batch(subkeys, offsets, Nr=Nr)
+            self.assertEqual(scheds.shape, (len(offsets),) + key_sched.shape)
+            self.assertTrue((scheds == key_sched).all())
+
+    def test_derivation_readme(self):
+        for skey, offset, key in (
+                ("de1369676ccc5a71fa2563959674ee15"
+                 "5886ca5d2e2f31d77e0af1fa27cf73c3", 40,
+                 "603deb1015ca71be2b73aef0857d7781"
+                 "1f352c073b6108d72d9810a30914dff4"),
+                ("ac7766f319fadc2128d12941575c006e", 36,
+                 "2b7e151628aed2a6abf7158809cf4f3c")):
+            skey = np.array(bytearray.fromhex(skey))
+            self.assertEqual(derive_key(skey, offset).data.hex(), key)
+
+    def test_encrypt_batch(self):
+        rng = np.random.RandomState(0)
+        for (p, k, c) in self.AES_VECTORS:
+            kb = np.array(bytearray.fromhex(k))
+
+            blocks = rng.randint(0, 256, (8, 16)).astype(np.uint8)
+            blocks[3] = bytearray.fromhex(p)
+
+            result = encrypt_batch(blocks, kb)
+            self.assertEqual(result.shape, blocks.shape)
+            self.assertEqual(result[3].data.hex(), c)
+            for pb, cb in zip(blocks, result):
+                self.assertEqual(encrypt(pb, kb).data.hex(), cb.data.hex())
+
+            self.assertEqual(decrypt_batch(result, kb).data.hex(),
+                             blocks.data.hex())
+
+    def test_engines(self):
+        rng = np.random.RandomState(1)
+        for (p, k, c) in self.AES_VECTORS:
+            pb = np.array(bytearray.fromhex(p))
+            kb = np.array(bytearray.fromhex(k))
+            cb = np.array(bytearray.fromhex(c))
+            blocks = rng.randint(0, 256, (8, 16)).astype(np.uint8)
+            expected = encrypt_batch(blocks, kb)
+
+            for engine in ENGINES:
+                self.assertEqual(encrypt(pb, kb, engine).data.hex(), c)
+                self.assertEqual(decrypt(cb, kb, engine).data.hex(), p)
+
+                result = encrypt_batch(blocks, kb, engine)
+                self.assertEqual(result.data.hex(), expected.data.hex())
+                self.assertEqual(decrypt_batch(result, kb, engine).data.hex(),
+                                 blocks.data.hex())
+
+    def test_bitslice_lanes(self):
+        # A partial word of lanes, each block with its own key
+        rng = np.random.RandomState(2)
+        blocks = rng.randint(0, 256, (100, 16)).astype(np.uint8)
+        keys = rng.randint(0, 256, (100, 16)).astype(np.uint8)
+        rk = key_expansion_batch(keys, 10).reshape(100, 11, 16)
+
+        result = bitslice.encrypt_blocks(blocks, rk)
+        for i in (0, 63, 64, 99):
+            self.assertEqual(result[i].data.hex(),
+                             encrypt(blocks[i], keys[i]).data.hex())
+        self.assertEqual(bitslice.decrypt_blocks(result, rk).data.hex(),
+                         blocks.data.hex())
+
+    def test_evaluate(self):
+        rng = np.random.RandomState(5)
+        for (p, k, c) in self.AES_VECTORS:
+            kb = np.array(bytearray.fromhex(k))
+            aes = AES(kb)
+            Nr = aes.rounds
+            blocks = rng.randint(0, 256, (6, 16)).astype(np.uint8)
+            t = StateTracker(len(blocks), Nr)
+            result = encrypt_batch(blocks, kb, tracker=t)
+
+            self.assertEqual(evaluate(blocks, aes.rk, (0, 'input'),
+                                      (Nr, 'add_k')).tolist(),
+                             result.tolist())
+            self.assertEqual(evaluate(result, aes.rk, (Nr, 'add_k'),
+                                      (0, 'input')).tolist(),
+                             blocks.tolist())
+
+            # Round 1 S-box output, forwards from the plaintext
+            state = evaluate(blocks, aes.rk, (0, 'input'), (1, 's_box'))
+            self.assertEqual(state.reshape(-1, 4, 4).swapaxes(1, 2).tolist(),
+                             t[1].s_box.tolist())
+
+            # Last round input, backwards with only the last round key
+            state = evaluate(result, {Nr: aes.rk[Nr]}, (Nr, 'add_k'),
+                             (Nr, 'input'), Nr)
+            self.assertEqual(state.reshape(-1, 4, 4).swapaxes(1, 2).tolist(),
+                             t[Nr - 1].add_k.tolist())
+
+            # Broadcast over 256 guesses of every last round key byte
+            guesses = np.repeat(np.arange(256, dtype=np.uint8), 16)
+            state = evaluate(result, {Nr: guesses.reshape(256, 1, 16)},
+                             (Nr, 'add_k'), (Nr, 's_box'), Nr)
+            self.assertEqual(state.shape, (256, 6, 16))
+            # State byte i comes from ciphertext and key byte SHIFT_ROWS_INV[i]
+            right = state[aes.rk[Nr][SHIFT_ROWS_INV], :, np.arange(16)].T
+            self.assertEqual(right.reshape(-1, 4, 4).swapaxes(1, 2).tolist(),
+                             t[Nr].s_box.tolist())
+
+        self.assertRaises(ValueError, evaluate, blocks, aes.rk,
+                          (0, 'input'), (Nr, 'm_col'))
+        self.assertRaises(ValueError, evaluate, blocks, {}, (0, 'input'),
+                          (1, 's_box'), 10)
+
+    def test_cipher_object(self):
+        for (p, k, c) in self.AES_VECTORS:
+            pb = np.array(bytearray.fromhex(p))
+            kb = np.array(bytearray.fromhex(k))
+
+            for engine in ENGINES:
+                aes = AES(kb, engine)
+                self.assertEqual(aes.encrypt(pb).data.hex(), c)
+                self.assertEqual(aes.decrypt(aes.encrypt(pb)).data.hex(), p)
+
+    def test_encrypt_block(self):
+        for (p, k, c) in self.AES_VECTORS:
+            aes = AES(np.array(bytearray.fromhex(k)))
+            pb, cb = bytes.fromhex(p), bytes.fromhex(c)
+
+            # bytes in, bytes out; arrays in, arrays out
+            self.assertEqual(aes.encrypt_block(pb), cb)
+            self.assertEqual(aes.decrypt_block(cb), pb)
+            out = aes.encrypt_block(np.frombuffer(pb, dtype=np.uint8))
+            self.assertIsInstance(out, np.ndarray)
+            self.assertEqual(out.tobytes(), cb)
+
+        self.assertRaises(ValueError, aes.encrypt_block, pb[:15])
+
+    def test_key_cache(self):
+        cache = KeyCache(maxsize=2)
+        keys = [np.array(bytearray.fromhex(k))
+                for (_, k, _) in self.AES_VECTORS]
+
+        self.assertIs(cache.get(keys[0]), cache.get(keys[0].copy()))
+        cache.get(keys[1])
+        cache.get(keys[2])  # Evicts keys[0]
+        cache.get(keys[0])
+        self.assertEqual(cache.info(), {
+            'hits': 1, 'misses': 4, 'maxsize': 2, 'size': 2})
+
+        cache.maxsize = 1
+        self.assertEqual(len(cache), 1)
+
+        cache.clear()
+        self.assertEqual(cache.info(), {
+            'hits': 0, 'misses': 0, 'maxsize': 1, 'size': 0})
+
+    def test_state_tracker(self):
+        rng = np.random.RandomState(4)
+        kb = np.array(bytearray.fromhex(self.AES_VECTORS[0][1]))
+        blocks = rng.randint(0, 256, (6, 16)).astype(np.uint8)
+
+        t = StateTracker(len(blocks), rounds=(1, -1), stages=('s_box',))
+        result = encrypt_batch(blocks, kb, tracker=t)
+        self.assertEqual(t.states.shape, (6, 2, 1, 16))
+        self.assertEqual(t.result.tolist(), result.tolist())
+
+        for i, pb in enumerate(blocks):
+            ref = encrypt_explicit(pb, kb)
+            self.assertEqual(t[1].s_box[i].tolist(), ref[1].s_box.tolist())
+            self.assertEqual(t[10].s_box[i].tolist(), ref[10].s_box.tolist())
+        self.assertIsNone(t[1].m_col)
+        self.assertRaises(IndexError, lambda: t[2])
+
+        t = StateTracker(len(blocks))
+        self.assertRaises(ValueError, encrypt_batch, blocks, kb, 'table', t)
+
+
+class TestOps(unittest.TestCase):
+    """Test individual AES operations
+    """
+
+    @staticmethod
+    def _gmul_ref(a, b):
+        p = 0
+        for _ in range(8):
+            if b & 1:
+                p ^= a
+            a = ((a << 1) ^ (0x1b if a & 0x80 else 0)) & 0xff
+            b >>= 1
+        return p
+
+    def test_gmul(self):
+        a = np.arange(256)
+        for b in range(256):
+            expected = [self._gmul_ref(x, b) for x in range(256)]
+            self.assertEqual(gmul(a, b).tolist(), expected)
+        self.assertEqual(gmul(0x57, 0x83), 0xc1)
+
+    def test_mix_columns(self):
+        rng = np.random.RandomState(2)
+        states = rng.randint(0, 256, (5, 4, 4)).astype(np.uint8)
+
+        # FIPS-197 MixColumns example, round 1
+        state = np.array(bytearray.fromhex(
+            "d4bf5d30e0b452aeb84111f11e2798e5")).reshape(4, 4).T
+        self.assertEqual(mix_columns(state).T.tobytes().hex(),
+                         "046681e5e0cb199a48f8d37a2806264c")
+
+        mixed = mix_columns(states)
+        for s, m in zip(states, mixed):
+            self.assertEqual(mix_columns(s).tolist(), m.tolist())
+        self.assertEqual(mix_columns_inv(mixed).tolist(), states.tolist())
+
+
+class TestModes(unittest.TestCase):
+    """Test modes of operation
+    """
+
+    # NIST SP 800-38A, F.1.1, F.2.1 and F.5.1
+    KEY = "2b7e151628aed2a6abf7158809cf4f3c"
+    PLAINTEXT = (
+        "6bc1bee22e409f96e93d7e117393172a"
+        "ae2d8a571e03ac9c9eb76fac45af8e51"
+        "30c81c46a35ce411e5fbc1191a0a52ef"
+        "f69f2445df4f9b17ad2b417be66c3710"
+    )
+    VECTORS = (
+        ("ecb", None,
+         "3ad77bb40d7a3660a89ecaf32466ef97"
+         "f5d3d58503b9699de785895a96fdbaaf"
+         "43b1cd7f598ece23881b00e3ed030688"
+         "7b0c785e27e8ad3f8223207104725dd4"),
+        ("cbc", "000102030405060708090a0b0c0d0e0f",
+         "7649abac8119b246cee98e9b12e9197d"
+         "5086cb9b507219ee95db113a917678b2"
+         "73bed6b8e3c1743b7116e69e22229516"
+         "3ff1caa1681fac09120eca307586e1a7"),
+        ("ctr", "f0f1f2f3f4f5f6f7f8f9fafbfcfdfeff",
+         "874d6191b620e3261bef6864990db6ce"
+         "9806f66b7970fdff8617187bb9fffdff"
+         "5ae4df3edbd5d35e5b4f09020db03eab"
+         "1e031dda2fbe03d1792170a0f3009cee"),
+    )
+
+    def test_stream(self):
+        key = bytes.fromhex(self.KEY)
+        p = bytes.fromhex(self.PLAINTEXT)
+
+        for mode, iv, c in self.VECTORS:
+            iv = iv and bytes.fromhex(iv)
+
+            # Uneven chunking must not change the result
+            for chunk_size in (16, 32, 64):
+                chunks = modes.read_chunks(p, chunk_size)
+                out = b''.join(x.tobytes() for x in
+                               modes.stream(chunks, key, mode, iv))
+                self.assertEqual(out.hex(), c)
+
+                chunks = modes.read_chunks(bytes.fromhex(c), chunk_size)
+                out = b''.join(x.tobytes() for x in
+                               modes.stream(chunks, key, mode, iv, True))
+                self.assertEqual(out.hex(), self.PLAINTEXT)
+
+    def test_ctr_counter_carry(self):
+        iv = bytes.fromhex("00000000000000ffffffffffffffffff")
+        counters = modes.ctr_counters(iv, 0, 2)
+        self.assertEqual(counters[1].tobytes().hex(),
+                         "00000000000001000000000000000000")
+
+    def test_process_file(self):
+        key = bytes.fromhex(self.KEY)
+        data = np.random.RandomState(3).bytes(16 * 200 + 5)
+
+        with tempfile.TemporaryDirectory() as d:
+            src = os.path.join(d, 'src')
+            enc = os.path.join(d, 'enc')
+            dec = os.path.join(d, 'dec')
+
+            for mode, iv, _ in self.VECTORS:
+                iv = iv and bytes.fromhex(iv)
+                size = len(data) if mode == 'ctr' else 16 * 200
+                with open(src, 'wb') as f:
+                    f.write(data[:size])
+
+                modes.process_file(src, enc, key, mode, iv, workers=2,
+                                   chunk_size=1024)
+                with open(enc, 'rb') as f:
+                    expected = b''.join(
+                        x.tobytes() for x in modes.stream(
+                            [data[:size]], key, mode, iv))
+                    self.assertEqual(f.read(), expected)
+
+                modes.process_file(enc, dec, key, mode, iv, decrypt=True,
+                                   workers=2, chunk_size=1024)
+                with open(dec, 'rb') as f:
+                    self.assertEqual(f.read(), data[:size])
+
+            iv = bytes(16)
+            with open(src, 'wb') as f:
+                f.write(data)
+            link = os.path.join(d, 'link')
+            os.symlink(src, link)
+            self.assertRaises(ValueError, modes.process_file, src, link, key,
+                              'ctr', iv)
+            with open(src, 'rb') as f:
+                self.assertEqual(f.read(), data)
+
+            # An error mid-stream is raised, not hidden by unmapping the input
+            ctr = modes.ctr
+            calls = []
+
+            def failing_ctr(*args):
+                calls.append(args)
+                if len(calls) > 1:
+                    raise RuntimeError("Injected")
+                return ctr(*args)
+
+            with unittest.mock.patch.object(modes, 'ctr', failing_ctr):
+                with self.assertRaisesRegex(RuntimeError, "Injected"):
+                    modes.process_file(src, enc, key, 'ctr', iv,
+                                       chunk_size=1024)
+
+
+class TestGcm(unittest.TestCase):
+    """Test AES-GCM
+    """
+
+    # The GCM specification (McGrew and Viega), test cases 2, 4, 6, 10 and 16
+    # key, IV, plaintext, AAD, ciphertext, tag tuples
+    KEY = "feffe9928665731c6d6a8f9467308308"
+    PLAINTEXT = (
+        "d9313225f88406e5a55909c5aff5269a"
+        "86a7a9531534f7da2e4c303d8a318a72"
+        "1c3c0c95956809532fcf0e2449a6b525"
+        "b16aedf5aa0de657ba637b39"
+    )
+    AAD = "feedfacedeadbeeffeedfacedeadbeefabaddad2"
+    VECTORS = (
+        ("0" * 32, "000000000000000000000000", "0" * 32, "",
+         "0388dace60b6a392f328c2b971b2fe78",
+         "ab6e47d42cec13bdf53a67b21257bddf"),
+        (KEY, "cafebabefacedbaddecaf888", PLAINTEXT, AAD,
+         "42831ec2217774244b7221b784d0d49c"
+         "e3aa212f2c02a4e035c17e2329aca12e"
+         "21d514b25466931c7d8f6a5aac84aa05"
+         "1ba30b396a0aac973d58e091",
+         "5bc94fbc3221a5db94fae95ae7121a47"),
+        (KEY, "9313225df88406e555909c5aff5269aa"
+              "6a7a9538534f7da1e4c303d2a318a728"
+              "c3c0c95156809539fcf0e2429a6b5254"
+              "16aedbf5a0de6a57a637b39b",
+         PLAINTEXT, AAD,
+         "8ce24998625615b603a033aca13fb894"
+         "be9112a5c3a211a8ba262a3cca7e2ca7"
+         "01e4a9a4fba43c90ccdcb281d48c7c6f"
+         "d62875d2aca417034c34aee5",
+         "619cc5aefffe0bfa462af43c1699d050"),
+        (KEY + KEY[:16], "cafebabefacedbaddecaf888", PLAINTEXT, AAD,
+         "3980ca0b3c00e841eb06fac4872a2757"
+         "859e1ceaa6efd984628593b40ca1e19c"
+         "7d773d00c144c525ac619d18c84a3f47"
+         "18e2448b2fe324d9ccda2710",
+         "2519498e80f1478f37ba55bd6d27618c"),
+        (KEY + KEY, "cafebabefacedbaddecaf888", PLAINTEXT, AAD,
+         "522dc1f099567d07f47f37a32a84427d"
+         "643a8cdcbfe5c0c97598a2bd2555d1aa"
+         "8cb08e48590dbb3da7b08b1056828838"
+         "c5f61e6393ba7a0abcc9f662",
+         "76fc6ece0f4e1768cddf8853bb2d551b"),
+    )
+
+    def test_vectors(self):
+        for key, iv, p, aad, c, tag in self.VECTORS:
+            key, iv, p, aad, c, tag = (
+                bytes.fromhex(x) for x in (key, iv, p, aad, c, tag))
+            out, t = gcm.encrypt(p, key, iv, aad)
+            self.assertEqual(out.tobytes(), c)
+            self.assertEqual(t, tag)
+            self.assertEqual(gcm.decrypt(c, key, iv, tag, aad).tobytes(), p)
+
+            # Truncated tags
+            _, t = gcm.encrypt(p, key, iv, aad, tag_len=12)
+            self.assertEqual(t, tag[:12])
+            gcm.decrypt(c, key, iv, tag[:12], aad)
+
+    def test_stream(self):
+        key = bytes.fromhex(self.KEY)
+        iv = bytes.fromhex("cafebabefacedbaddecaf888")
+        data = np.random.RandomState(4).bytes(16 * 300 + 7)
+        aad = data[:37]
+        expected, tag = gcm.encrypt(data, key, iv, aad)
+
+        # Uneven pieces and small batches must not change the result
+        ctx = gcm.GCM(key, iv, batch_size=5)
+        ctx.authenticate(aad[:20])
+        ctx.authenticate(aad[20:])
+        cuts = (0, 3, 1003, 1003, 2000, len(data))
+        out = np.concatenate([ctx.update(data[a:b])
+                              for a, b in zip(cuts, cuts[1:])])
+        self.assertEqual(out.tobytes(), expected.tobytes())
+        self.assertEqual(ctx.finalize(), tag)
+
+        ctx = gcm.GCM(key, iv, decrypt=True)
+        ctx.authenticate(aad)
+        self.assertEqual(ctx.update(expected).tobytes(), data)
+        ctx.finalize(tag)
+
+        # Tampering with the ciphertext, AAD or tag is detected
+        tampered = expected.copy()
+        tampered[100] ^= 1
+        for args in ((tampered, key, iv, tag, aad),
+                     (expected, key, iv, tag, aad[1:]),
+                     (expected, key, iv, tag[:15] + b'\0', aad)):
+            with self.assertRaises(ValueError):
+                gcm.decrypt(*args)
+
+    def test_ghash(self):
+        ghash = gcm.GHashKey(np.random.RandomState(5).randint(
+            256, size=16).astype(np.uint8))
+        blocks = np.random.RandomState(6).randint(
+            256, size=(gcm.STRIDE ** 2 + 2 * gcm.STRIDE + 3, 16)
+        ).astype(np.uint8)
+
+        # One block at a time, as in the specification
+        y = np.zeros(16, dtype=np.uint8)
+        expected = []
+        for block in blocks:
+            y = ghash.multiply(y ^ block)[0]
+            expected.append(y)
+
+        for n in (1, gcm.STRIDE, gcm.STRIDE + 1, len(blocks)):
+            y = ghash.update(np.zeros(16, dtype=np.uint8), blocks[:n])
+            self.assertEqual(y.tobytes(), expected[n - 1].tobytes())
+
+
+class TestService(unittest.TestCase):
+    """Test the coalescing encryption service
+    """
+
+    def setUp(self):
+        rng = np.random.RandomState(7)
+        self.keys = [rng.randint(256, size=n).astype(np.uint8)
+                     for n in (16, 32)]
+        self.blocks = rng.randint(256, size=(100, 16)).astype(np.uint8)
+
+    def test_batcher(self):
+        async def run():
+            async with service.Batcher(max_batch=16, max_wait=0.01) as b:
+                futures = [b.submit(block, key, decrypt)
+                           for key in self.keys
+                           for decrypt in (False, True)
+                           for block in self.blocks]
+                out = await asyncio.gather(*futures)
+
+                # A lone request is run after max_wait
+                single = await b.encrypt(self.blocks[0], self.keys[0])
+                with self.assertRaises(ValueError):
+                    b.submit(self.blocks[0], self.keys[0][:15])
+            return np.array(out), single, b.metrics
+
+        out, single, metrics = asyncio.run(run())
+        expected = np.concatenate([fn(self.blocks, key, 'table')
+                                   for key in self.keys
+                                   for fn in (encrypt_batch, decrypt_batch)])
+        self.assertEqual(out.tolist(), expected.tolist())
+        self.assertEqual(single.tolist(), expected[0].tolist())
+
+        # 4 groups of 100 requests: 6 full batches and one partial each
+        self.assertEqual(metrics.requests, 401)
+        self.assertEqual(metrics.batches, 4 * 7 + 1)
+        self.assertEqual(metrics.max_batch_size, 16)
+        self.assertEqual(metrics.queue_depth, 0)
+        self.assertEqual(metrics.in_flight, 0)
+        self.assertGreater(metrics.latency(99), 0)
+
+    def test_server(self):
+        key = self.keys[0]
+        lines = ['e %s %s\n' % (key.tobytes().hex(), block.tobytes().hex())
+                 for block in self.blocks]
+        lines.insert(10, 'x 00\n')
+        lines.append('stats\n')
+
+        async def run(path):
+            async with service.Batcher(max_batch=32, max_wait=0.01) as b:
+                server = await service.start_server(b, path=path)
+                async with server:
+                    reader, writer = await asyncio.open_unix_connection(path)
+                    writer.write(''.join(lines).encode('ascii'))
+                    writer.write_eof()
+                    responses = (await reader.read()).decode('ascii')
+                    writer.close()
+            return responses.splitlines()
+
+        with tempfile.TemporaryDirectory() as d:
+            responses = asyncio.run(run(os.path.join(d, 'aes.sock')))
+
+        self.assertEqual(len(responses), len(lines))
+        self.assertTrue(responses.pop(10).startswith('error '))
+        stats = json.loads(responses.pop())
+        self.assertEqual(stats['requests'], len(self.blocks))
+        self.assertEqual(stats['batches'], 4)
+        expected = encrypt_batch(self.blocks, key, 'table')
+        self.assertEqual(responses, [x.tobytes().hex() for x in expected])
+
+
+class TestCpa(unittest.TestCase):
+    """Test correlation power analysis
+    """
+
+    KEY = np.array(bytearray.fromhex("2b7e151628aed2a6abf7158809cf4f3c"))
+
+    def _chunks(self, target, model, rng, n=500, count=4):
+        true = self.KEY if target == 'first' else AES(self.KEY).rk[10]
+        for _ in range(count):
+            p = rng.randint(0, 256, (n, 16)).astype(np.uint8)
+            texts = p if target == 'first' else encrypt_batch(p, self.KEY)
+            h = cpa.hypotheses(texts, model, target)
+            traces = rng.normal(0, 1, (n, 20))
+            traces[:, 2:18] += h[np.arange(n)[:, None], np.arange(16), true]
+            yield traces, texts
+
+    def test_correlation(self):
+        rng = np.random.RandomState(5)
+        chunks = list(self._chunks('first', 'hw', rng, n=50, count=3))
+        c = cpa.run(chunks, 20)
+
+        traces = np.concatenate([t for t, _ in chunks])
+        h = cpa.hypotheses(np.concatenate([p for _, p in chunks]))
+        expected = np.corrcoef(h[:, 7, 0x42], traces[:, 9])[0, 1]
+        self.assertAlmostEqual(c.correlation()[7, 0x42, 9], expected)
+
+    def test_key_recovery(self):
+        rng = np.random.RandomState(6)
+        for target in cpa.TARGETS:
+            for model in cpa.MODELS:
+                c = cpa.run(self._chunks(target, model, rng), 20, model,
+                            target)
+                self.assertEqual(c.n, 2000)
+                self.assertEqual(c.master_key().tolist(), self.KEY.tolist())
+
+
+class TestTraceSet(unittest.TestCase):
+    """Test the binary trace-set container
+    """
+
+    def test_append_and_read(self):
+        rng = np.random.RandomState(7)
+        p = rng.randint(0, 256, (10, 16)).astype(np.uint8)
+        k = rng.randint(0, 256, 16).astype(np.uint8)
+        c = encrypt_batch(p, k)
+        samples = rng.normal(size=(10, 8)).astype(np.float32)
+
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'traces.bin')
+            ts = TraceSet.create(path, n_samples=8, key_len=16)
+            self.assertEqual(len(ts), 0)
+            ts.append(p[:4], c[:4], k, samples[:4])
+            self.assertEqual(len(ts.records), 4)
+            ts.append(p[4:], c[4:], k, samples[4:])
+
+            ts = TraceSet(path)
+            self.assertEqual(len(ts), 10)
+            self.assertIsInstance(ts.records, np.memmap)
+            self.assertTrue(np.shares_memory(ts.samples, ts.records))
+            self.assertEqual(ts.ciphertext.tolist(), c.tolist())
+            self.assertEqual(ts.key[3].tolist(), k.tolist())
+            self.assertEqual(ts[7]['samples'].tolist(), samples[7].tolist())
+            self.assertEqual([len(x) for x in ts.chunks(4)], [4, 4, 2])
+
+    def test_hex_lines(self):
+        lines = ["69c4e0d86a7b0430d8cdb78070b4c55a", "not hex",
+                 "8ea2b7ca516745bfeafc49904b496089", "00"]
+
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'traces.bin')
+            ts = TraceSet.from_hex(lines, path)
+            self.assertEqual(len(ts), 2)
+
+            out = io.StringIO()
+            ts.to_hex(out)
+            self.assertEqual(out.getvalue().split(), [lines[0], lines[2]])
+
+
+class TestDfa(unittest.TestCase):
+    """Test the last round DFA solver
+    """
+
+    KEY = np.array(bytearray.fromhex("000102030405060708090a0b0c0d0e0f"))
+    PLAINTEXT = np.array(bytearray.fromhex("00112233445566778899aabbccddeeff"))
+
+    def _faulty(self, pos, value, fault_round=9):
+        """Ciphertext with a fault XORed in before MixColumns of a round"""
+        rk = AES(self.KEY).rk
+        state = self.PLAINTEXT.reshape(1, 16) ^ rk[0]
+        for r in range(1, 11):
+            state = shift_rows_batch(sub_bytes_batch(state))
+            if r == fault_round:
+                state[:, pos] ^= value
+            if r != 10:
+                state = mix_columns_batch(state)
+            state ^= rk[r]
+        return state[0]
+
+    def test_solve(self):
+        ref = encrypt(self.PLAINTEXT, self.KEY)
+        last = AES(self.KEY).rk[10]
+        faulty = [self._faulty(pos, 0x5a + pos) for pos in range(16)]
+
+        solution = dfa.solve(ref, faulty[::4])
+        candidates = solution.candidates()
+        self.assertEqual(solution.used, [1, 1, 1, 1])
+        self.assertEqual(solution.count(),
+                         np.prod([c.size for c in solution.columns]))
+        for pos in range(16):
+            self.assertIn(last[pos], candidates[pos])
+        self.assertIsNone(solution.key())
+
+        solution = dfa.solve(ref, faulty, workers=2)
+        self.assertEqual(solution.used, [2, 2, 2, 2])
+        self.assertEqual(solution.key().tolist(), last.tolist())
+
+    def test_bad_fault(self):
+        ref = encrypt(self.PLAINTEXT, self.KEY)
+        last = AES(self.KEY).rk[10]
+        good = [self._faulty(pos, value)
+                for value in (0x11, 0x5a, 0xc3) for pos in range(16)]
+        # Differs in the bytes of column 0, but not by a single-byte fault
+        bad = ref.copy()
+        bad[dfa.GROUPS[0]] ^= np.array([1, 2, 3, 4], dtype=np.uint8)
+        bad_codes = dfa.column_candidates(ref, bad, 0)
+        self.assertGreater(bad_codes.size, 0)
+        self.assertNotIn(last[dfa.GROUPS[0]].tolist(),
+                         dfa.decode(bad_codes).tolist())
+
+        for faulty in ([bad] + good, good + [bad]):
+            solution = dfa.solve(ref, faulty)
+            self.assertEqual(solution.key().tolist(), last.tolist())
+
+            session = dfa.Session(ref)
+            for ciphertext in faulty:
+                session.add(ciphertext)
+                if session.done:
+                    break
+            self.assertEqual(session.master_key().tolist(),
+                             self.KEY.tolist())
+
+    def test_recover_search(self):
+        batches = list(faultsim.simulate(7, self.KEY, self.PLAINTEXT,
+                                         seed=27))
+        ref = batches[0][1][0]
+        faulty = np.concatenate([batch[2] for batch in batches])
+        solution = dfa.solve(ref, faulty)
+        # Partly solved: two columns left with joint candidates
+        sizes = sorted(c.size for c in solution.columns)
+        self.assertEqual(sizes[:2], [1, 1])
+        self.assertGreater(sizes[2], 1)
+        self.assertLess(solution.count(), 1 << 12)
+
+        recovery = dfa.recover(ref, faulty)
+        self.assertIsNone(recovery.key)
+        self.assertIsNone(recovery.search)
+
+        recovery = dfa.recover(ref, faulty, plaintext=self.PLAINTEXT)
+        self.assertEqual(recovery.key.tolist(), self.KEY.tolist())
+        self.assertEqual(recovery.search.total, solution.count())
+        self.assertLessEqual(recovery.search.tested, solution.count())
+
+        recovery = dfa.recover(ref, faulty, plaintext=self.PLAINTEXT[::-1])
+        self.assertIsNone(recovery.key)
+        self.assertEqual(recovery.search.tested, solution.count())
+
+    def test_stream(self):
+        lines = [encrypt(self.PLAINTEXT, self.KEY).tobytes().hex(), "junk"]
+        lines += [self._faulty(pos, 0x11, 8).tobytes().hex()
+                  for pos in (3, 9)]
+        # Bytes outside a single column are ignored
+        lines += [self._faulty(0, 0x11, 10).tobytes().hex()]
+
+        self.assertEqual(dfa.stream(lines).tolist(), self.KEY.tolist())
+        self.assertRaises(ValueError, dfa.stream, lines[:3])
+
+    def test_parse_hex(self):
+        block = "00112233445566778899aabbccddeeff"
+        lines = [block, block.upper(), "  %s \r" % block, "\t%s" % block,
+                 " ".join(block[i:i + 2] for i in range(0, 32, 2)),
+                 block[:31], block + "0", block[:5] + "g" + block[6:],
+                 block[:3] + " " + block[3:], block + " 00", "", "junk",
+                 "INFO a long line of text that is not hexadecimal at all"]
+        text = "\n".join(lines * 3)
+        expected = np.array(list(dfa._filter(text.split("\n"))))
+        self.assertEqual(len(expected), 15)
+
+        self.assertEqual(dfa.parse_hex(text).tolist(), expected.tolist())
+        self.assertEqual(dfa.parse_hex(text.replace("\n", "\r\n")).tolist(),
+                         expected.tolist())
+        for f in (io.StringIO(text), io.BytesIO(text.encode('ascii'))):
+            # Chunks split lines
+            self.assertEqual(dfa.read_hex(f, chunk_size=50).tolist(),
+                             expected.tolist())
+        self.assertEqual(dfa.parse_hex("").shape, (0, 16))
+
+    def test_key_sizes(self):
+        rng = np.random.default_rng(5)
+        for key_len, Nr in cipher.KEY_LEN_TO_ROUNDS.items():
+            key = rng.integers(0, 256, key_len, dtype=np.uint8)
+            aes = AES(key)
+            plaintexts = np.tile(self.PLAINTEXT, (40, 1))
+            ref, faulty = faultsim.inject(plaintexts, key, Nr - 2, rng=rng)
+
+            last = dfa.solve(ref[0], faulty).key()
+            self.assertEqual(last.tolist(), aes.rk[Nr].tolist())
+            equivalent = dfa.solve_penultimate(ref[0], faulty, last).key()
+            self.assertEqual(mix_columns_batch(equivalent).tolist(),
+                             aes.rk[Nr - 1].tolist())
+
+            lines = [c.tobytes().hex() for c in [ref[0]] + list(faulty)]
+            self.assertEqual(dfa.stream(lines, key_len=key_len).tolist(),
+                             key.tolist())
+
+        # Faults a round too late determine only the last round key
+        ref, faulty = faultsim.inject(plaintexts, key, Nr - 1, rng=rng)
+        lines = [c.tobytes().hex() for c in [ref[0]] + list(faulty)]
+        self.assertRaises(ValueError, dfa.stream, lines, key_len=32)
+
+    def _lines(self):
+        lines = [encrypt(self.PLAINTEXT, self.KEY).tobytes().hex()]
+        lines += [self._faulty(pos, 0x20 + pos).tobytes().hex()
+                  for pos in (0, 4, 8, 12, 1, 5, 9, 13, 2, 6, 10, 14)]
+        return lines
+
+    def test_session(self):
+        lines = self._lines()
+        session = dfa.Session()
+        progress = []
+
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'faults.txt')
+            with open(path, 'w') as f:
+                f.write('\n'.join(lines) + '\n')
+
+            with open(path) as f:
+                key = session.feed(dfa.follow(f),
+                                   lambda s: progress.append(s.progress()))
+
+        self.assertEqual(key.tolist(), self.KEY.tolist())
+        self.assertEqual(progress[-1]['resolved_bytes'], 16)
+        self.assertEqual(progress[-1]['candidates'], 1)
+        self.assertGreater(progress[0]['candidates'], 1)
+        # Stops as soon as the key is unique
+        self.assertEqual(session.seen, 8)
+
+        # A pipe is followed until it is closed
+        read_fd, write_fd = os.pipe()
+        with open(read_fd) as r, open(write_fd, 'w') as w:
+            w.write('\n'.join(lines[:3]) + '\n' + lines[3])
+            w.close()
+            self.assertEqual(list(dfa.follow(r, interval=10)),
+                             [line + '\n' for line in lines[:3]] +
+                             [lines[3]])
+
+    def test_session_socket(self):
+        lines = self._lines()
+
+        async def run(path):
+            session = dfa.Session()
+            server = asyncio.ensure_future(session.serve(path=path))
+            while not os.path.exists(path):
+                await asyncio.sleep(0.01)
+            # An idle client is disconnected once the key is found
+            idle_reader, idle_writer = await asyncio.open_unix_connection(
+                path)
+            _, writer = await asyncio.open_unix_connection(path)
+            for line in lines:
+                writer.write(line.encode('ascii') + b'\n')
+            await writer.drain()
+            key = await asyncio.wait_for(server, 10)
+            self.assertEqual(await asyncio.wait_for(idle_reader.read(), 10),
+                             b'')
+            writer.close()
+            idle_writer.close()
+            return key
+
+        with tempfile.TemporaryDirectory() as d:
+            key = asyncio.run(run(os.path.join(d, 'dfa.sock')))
+        self.assertEqual(key.tolist(), self.KEY.tolist())
+
+
+class TestBulk(unittest.TestCase):
+    """Test the multi-target DFA runner
+    """
+
+    PLAINTEXT = np.arange(16, dtype=np.uint8)
+
+    def _write_log(self, path, key, seed):
+        with open(path, 'w') as f:
+            last = None
+            for _, ref, faulty in faultsim.simulate(
+                    40, key, self.PLAINTEXT, seed=seed):
+                last = faultsim.write_hex(f, ref, faulty, last)
+
+    def test_run(self):
+        keys = {'a': np.arange(16, dtype=np.uint8),
+                'b': np.arange(16, 32, dtype=np.uint8)}
+
+        with tempfile.TemporaryDirectory() as d:
+            logs = os.path.join(d, 'logs')
+            out = os.path.join(d, 'results')
+            os.mkdir(logs)
+            for seed, (name, key) in enumerate(sorted(keys.items())):
+                self._write_log(os.path.join(logs, name + '.txt'), key, seed)
+            with open(os.path.join(logs, 'c.txt'), 'w') as f:
+                f.write("junk\n")
+
+            paths = bulk.find_logs([logs])
+            self.assertEqual([bulk.target_name(p) for p in paths],
+                             ['a', 'b', 'c'])
+            self.assertEqual(bulk.find_logs([os.path.join(logs, '[ab].*')]),
+                             paths[:2])
+
+            results = {r['target']: r for r in bulk.run(paths, out,
+                                                        workers=2)}
+            for name, key in keys.items():
+                self.assertEqual(results[name]['status'], 'recovered')
+                self.assertEqual(results[name]['key'], key.tobytes().hex())
+                self.assertEqual(results[name]['ciphertexts'], 41)
+                self.assertGreater(results[name]['faults'], 0)
+            self.assertEqual(results['c']['status'], 'error')
+            self.assertFalse(any(r['skipped'] for r in results.values()))
+
+            with open(os.path.join(out, 'a.json')) as f:
+                saved = json.load(f)
+            self.assertEqual(saved['key'], results['a']['key'])
+            self.assertEqual(saved['sha256'],
+                             bulk.file_hash(os.path.join(logs, 'a.txt')))
+
+            # The changed log, and the failed one, are attacked again
+            self._write_log(os.path.join(logs, 'b.txt'), keys['b'], 5)
+            results = {r['target']: r for r in bulk.run(paths, out)}
+            self.assertEqual([results[n]['skipped'] for n in 'abc'],
+                             [True, False, False])
+            self.assertEqual(results['a']['key'], keys['a'].tobytes().hex())
+
+            # As is a log attacked with different parameters
+            result, = bulk.run(paths[:1], out, key_len=32)
+            self.assertFalse(result['skipped'])
+            self.assertEqual(result['key_len'], 32)
+            self.assertNotEqual(result['key'], keys['a'].tobytes().hex())
+            for _ in range(2):
+                result, = bulk.run(paths[:1], out, plaintext=self.PLAINTEXT)
+                self.assertEqual(result['key'], keys['a'].tobytes().hex())
+                self.assertEqual(result['plaintext'],
+                                 self.PLAINTEXT.tobytes().hex())
+            self.assertTrue(result['skipped'])
+            result, = bulk.run(paths[:1], out)
+            self.assertFalse(result['skipped'])
+
+            for skipped in (False, True):
+                result, = bulk.run(paths[:1], out, fmt='csv')
+                self.assertEqual(result['skipped'], skipped)
+            saved = bulk.read_result(os.path.join(out, 'a.csv'), 'csv')
+            self.assertEqual(saved['key'], keys['a'].tobytes().hex())
+            self.assertEqual(saved['status'], 'recovered')
+            self.assertEqual(saved['key_len'], '16')
+            self.assertRaises(ValueError, list,
+                              bulk.run(paths + [paths[0]], out))
+
+
+class TestKeySearch(unittest.TestCase):
+    """Test the residual key search
+    """
+
+    def test_search(self):
+        rng = np.random.RandomState(8)
+        for (p, k, c) in TestAes.AES_VECTORS:
+            kb = np.array(bytearray.fromhex(k))
+            pb = np.array(bytearray.fromhex(p))
+            cb = np.array(bytearray.fromhex(c))
+
+            # Last round key, plus the end of the previous for longer keys
+            w = key_expansion(kb, len(kb) // 4 + 6)
+            offset = len(w) - len(kb) // 4
+            subkey = w[offset:].reshape(-1)
+
+            candidates = [[b] for b in subkey]
+            for i in (0, 5, 9):
+                candidates[i] = np.append(rng.randint(0, 256, 7), subkey[i])
+
+            for workers in (1, 2):
+                result = keysearch.search(candidates, offset, pb, cb,
+                                          workers, batch_size=64)
+                self.assertEqual(result.key.tolist(), kb.tolist())
+                self.assertLessEqual(result.tested, result.total)
+
+            # Joint candidates for the first four bytes
+            tuples = np.append(rng.randint(0, 256, (5, 4)), [subkey[:4]],
+                               axis=0)
+            result = keysearch.search([tuples] + candidates[4:], offset,
+                                      pb, cb, batch_size=64,
+                                      positions=[(0, 1, 2, 3)] + [
+                                          (i,) for i in range(4, len(kb))])
+            self.assertEqual(result.key.tolist(), kb.tolist())
+            self.assertEqual(result.total, 6 * 8 * 8)
+
+            cb = cb.copy()
+            cb[0] ^= 1
+            result = keysearch.search(candidates, offset, pb, cb)
+            self.assertIsNone(result.key)
+            self.assertEqual(result.tested, result.total)
+        self.assertRaises(ValueError, keysearch.search, [[0, 1]] * 16, 40,
+                          pb, cb, positions=[(0,)] * 16)
+
+
+class TestFaultSim(unittest.TestCase):
+    """Test the fault injection simulator
+    """
+
+    KEY = TestDfa.KEY
+    PLAINTEXT = TestDfa.PLAINTEXT
+
+    def test_inject(self):
+        rng = np.random.default_rng(0)
+        plaintexts = rng.integers(0, 256, (50, 16), dtype=np.uint8)
+
+        ref, faulty = faultsim.inject(plaintexts, self.KEY, 10, 'input',
+                                      'bit', position=5, rng=rng)
+        self.assertEqual(ref.tolist(), encrypt_batch(plaintexts,
+                                                     self.KEY).tolist())
+        # Position 5 (row 1, column 1) moves to column 0 in ShiftRows
+        self.assertTrue(((ref != faulty).sum(axis=-1) == 1).all())
+        self.assertTrue((ref[:, 1] != faulty[:, 1]).all())
+
+        ref, faulty = faultsim.inject(plaintexts, self.KEY, 9, 's_row',
+                                      rng=rng)
+        self.assertTrue(dfa.classify(ref[0], faulty[:1]).any())
+        self.assertRaises(ValueError, faultsim.inject, plaintexts, self.KEY,
+                          10, 'm_col')
+
+    def test_simulate(self):
+        batches = list(faultsim.simulate(300, self.KEY, seed=5,
+                                         batch_size=128))
+        self.assertEqual([len(b[0]) for b in batches], [128, 128, 44])
+
+        parallel = faultsim.simulate(300, self.KEY, seed=5, workers=2,
+                                     batch_size=128)
+        for batch, other in zip(batches, parallel):
+            for a, b in zip(batch, other):
+                self.assertEqual(a.tolist(), b.tolist())
+
+        plaintext = faultsim.random_plaintext(5)
+        self.assertEqual(plaintext.shape, (16,))
+        self.assertEqual(plaintext.tolist(),
+                         faultsim.random_plaintext(5).tolist())
+
+    def test_dfa(self):
+        f = io.StringIO()
+        last = None
+        for _, ref, faulty in faultsim.simulate(
+                100, self.KEY, self.PLAINTEXT, seed=1, batch_size=64):
+            last = faultsim.write_hex(f, ref, faulty, last)
+
+        lines = f.getvalue().splitlines()
+        self.assertEqual(len(lines), 101)
+        self.assertEqual(dfa.stream(lines).tolist(), self.KEY.tolist())
+
+
+class TestTvla(unittest.TestCase):
+    """Test the leakage assessment t-tests
+    """
+
+    KEY = TestDfa.KEY
+
+    def test_moments(self):
+        rng = np.random.default_rng(6)
+        traces = rng.normal(1e4, 3, (3000, 5))
+        groups = rng.integers(0, 2, 3000)
+        traces[groups == 1, 1] += 1
+        traces[groups == 1, 3] = 1e4 + (traces[groups == 1, 3] - 1e4) * 2
+
+        chunked = tvla.TTest(5, 3)
+        for start in range(0, 3000, 700):
+            chunked.update(traces[start:start + 700],
+                           groups[start:start + 700])
+        whole = tvla.TTest(5, 3)
+        whole.update(traces[:1000], groups[:1000])
+        rest = tvla.TTest(5, 3)
+        rest.update(traces[1000:], groups[1000:])
+        whole.merge(rest)
+        np.testing.assert_allclose(chunked.t(), whole.t())
+
+        a, b = traces[groups == 0], traces[groups == 1]
+        expected = (a.mean(axis=0) - b.mean(axis=0)) / np.sqrt(
+            a.var(axis=0) / len(a) + b.var(axis=0) / len(b))
+        np.testing.assert_allclose(chunked.t()[0], expected)
+
+        # Mean shift at sample 1 (order 1), variance at sample 3 (order 2)
+        leaks = chunked.leaks()
+        self.assertEqual(np.flatnonzero(leaks[0]).tolist(), [1])
+        self.assertEqual(np.flatnonzero(leaks[1]).tolist(), [3])
+
+    def test_assess(self):
+        rng = np.random.default_rng(7)
+        n = 4000
+        plaintext = rng.integers(0, 256, (n, 16), dtype=np.uint8)
+        ciphertext = encrypt_batch(plaintext, self.KEY)
+        state = evaluate(plaintext, AES(self.KEY).rk, (0, 'input'),
+                         (1, 's_box'))
+        samples = rng.normal(0, 1, (n, 10)).astype(np.float32)
+        samples[:, 4] += (state[:, 2] >> 5) & 1
+
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'traces.trs')
+            ts = TraceSet.create(path, n_samples=10, key_len=16)
+            ts.append(plaintext, ciphertext, self.KEY, samples)
+
+            records = ts.records
+            groups = tvla.partition(records, 'sbox_bit', byte=2, bit=5)
+            self.assertEqual(groups.tolist(),
+                             ((state[:, 2] >> 5) & 1).tolist())
+
+            for workers in (1, 2):
+                result = tvla.assess(path, 'sbox_bit', 2, byte=2, bit=5,
+                                     workers=workers, chunk_size=512)
+                self.assertEqual(result.n.sum(), n)
+                self.assertEqual(np.flatnonzero(result.leaks()[0]).tolist(),
+                                 [4])
+
+            result = tvla.assess(path, 'last_hd', key=self.KEY, byte=7)
+            self.assertFalse(result.leaks().any())
+            self.assertRaises(ValueError, tvla.assess, path, 'fixed')
+
+
+class TestKeyRank(unittest.TestCase):
+    """Test key rank estimation and enumeration
+    """
+
+    def test_rank(self):
+        rng = np.random.default_rng(9)
+        for _ in range(5):
+            # Two bytes, small enough to rank exactly
+            scores = rng.random((2, 256)) ** 4
+            cost = -keyrank.log_likelihoods(scores)
+            total = (cost[0][:, None] + cost[1][None, :]).reshape(-1)
+            key = rng.integers(0, 256, 2)
+            exact = (total < cost[0, key[0]] + cost[1, key[1]]).sum() + 1
+
+            r = keyrank.rank(scores, key, bins=256)
+            self.assertLessEqual(r.lower, exact)
+            self.assertLessEqual(exact, r.upper)
+            self.assertLessEqual(r.lower, r.estimate)
+            self.assertLessEqual(r.estimate, r.upper)
+
+        key = rng.integers(0, 256, 16)
+        scores = rng.normal(0, 1, (16, 256))
+        r = keyrank.rank(scores, key, 'log')
+        self.assertGreater(r.log2()[0], 100)
+        self.assertLess(r.log2()[2], 128)
+
+        scores[np.arange(16), key] += 10
+        self.assertEqual(keyrank.rank(scores, key, 'log').upper, 1)
+
+    def test_enumerate(self):
+        rng = np.random.default_rng(10)
+        scores = rng.random((2, 256))
+        cost = -keyrank.log_likelihoods(scores)
+        total = (cost[0][:, None] + cost[1][None, :]).reshape(-1)
+
+        keys = list(keyrank.enumerate_keys(scores, limit=300))
+        np.testing.assert_allclose([c for c, _ in keys], np.sort(total)[:300])
+        for c, k in keys:
+            self.assertAlmostEqual(c, cost[0, k[0]] + cost[1, k[1]])
+
+        # A last round key two bytes away from the top
+        rk = AES(TestDfa.KEY).rk[10]
+        scores = np.full((16, 256), 0.1)
+        scores[np.arange(16), rk] = 1.0
+        scores[3, rk[3] ^ 1] = scores[8, rk[8] ^ 1] = 1.0
+        keys = [k for _, k in keyrank.enumerate_keys(scores, limit=4)]
+        self.assertIn(rk.tolist(), [k.tolist() for k in keys])
+        self.assertEqual(derive_key(keys[0], 40).size, 16)
+
+
+class TestProfiling(unittest.TestCase):
+
+    def test_profile(self):
+        from aes_tools import ops
+        sub_bytes = ops.sub_bytes_batch
+        engines = dict(ENGINES)
+        blocks = np.zeros((100, 16), dtype=np.uint8)
+
+        with profiling.profile() as outer:
+            with profiling.profile() as stats:
+                encrypt_batch(blocks, TestDfa.KEY, engine='table')
+                evaluate(blocks, AES(TestDfa.KEY).rk, (0, 'input'),
+                         (2, 's_box'))
+            ref, faulty = faultsim.inject(
+                np.tile(TestDfa.PLAINTEXT, (10, 1)), TestDfa.KEY,
+                rng=np.random.default_rng(0))
+            dfa.solve(ref[0], faulty)
+
+        s = stats.as_dict()
+        self.assertEqual(s['cipher.AES.encrypt_batch']['calls'], 1)
+        self.assertEqual(s['ttable.encrypt_blocks']['bytes'], blocks.nbytes)
+        self.assertEqual(s['ops.sub_bytes_batch']['calls'], 2)
+        self.assertNotIn('dfa.solve', s)
+
+        s = outer.as_dict()
+        self.assertEqual(s['ttable.encrypt_blocks']['calls'], 1)
+        self.assertEqual(s['dfa.solve']['calls'], 1)
+        self.assertEqual(s['dfa.solve']['bytes'], 10 * 16)
+        self.assertGreaterEqual(s['dfa.column_candidates']['calls'], 4)
+        self.assertEqual(json.loads(outer.to_json()), s)
+        self.assertIn('dfa.solve', outer.format())
+
+        # Disabled: the original functions are back in place
+        self.assertIsNone(profiling.active())
+        self.assertIs(ops.sub_bytes_batch, sub_bytes)
+        self.assertIs(cipher._FORWARD['s_box'], sub_bytes)
+        self.assertEqual(ENGINES, engines)
+
+
+class TestCli(unittest.TestCase):
+
+    def test_choices(self):
+        from aes_tools import __main__ as cli
+        self.assertEqual(cli.MODES, modes.MODES)
+        self.assertEqual(cli.CHUNK_SIZE, modes.DEFAULT_CHUNK_SIZE)
+        self.assertEqual(cli.FAULTS, faultsim.FAULTS)
+        self.assertEqual(cli.POINTS, faultsim.POINTS)
+        self.assertEqual(cli.TESTS, tvla.TESTS)
+        self.assertEqual(cli.THRESHOLD, tvla.THRESHOLD)
+        self.assertEqual(cli.TRACE_CHUNK_SIZE, tvla.DEFAULT_CHUNK_SIZE)
+        self.assertEqual(cli.RESULT_FORMATS, bulk.FORMATS)
+        self.assertEqual(cli.MAX_BATCH, service.DEFAULT_MAX_BATCH)
+        self.assertEqual(cli.MAX_WAIT, service.DEFAULT_MAX_WAIT)
+
+    def test_standard_streams(self):
+        from aes_tools import __main__ as cli
+        key = '000102030405060708090a0b0c0d0e0f'
+
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout), \
+                contextlib.redirect_stderr(io.StringIO()):
+            # One random plaintext, so one reference for dfa
+            cli.cli.main(['faultsim', '-o', '-', '-n', '20', '--seed', '1',
+                          '--key', key], standalone_mode=False)
+        self.assertFalse(stdout.closed)
+        self.assertEqual(len(stdout.getvalue().split()), 21)
+
+        stdin = io.StringIO(stdout.getvalue())
+        stdout = io.StringIO()
+        with unittest.mock.patch('sys.stdin', stdin), \
+                contextlib.redirect_stdout(stdout):
+            cli.cli.main(['dfa', '-f', '-'], standalone_mode=False)
+        self.assertFalse(stdin.closed)
+        self.assertIn(key, stdout.getvalue())